@@ -15,21 +15,30 @@
 
 import logging
 import signal
+import time
+
+import adaptdl.env
 
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 def get_exit_flag():
     return EXIT_FLAG
 
 
+def get_signal_time():
+    # Time when the first exit signal was received, or None.
+    return SIGNAL_TIME
+
+
 def _handler(signum, frame):
-    global EXIT_FLAG
+    global EXIT_FLAG, SIGNAL_TIME
     EXIT_FLAG = True
-    LOG.debug("Got signal {}...".format(signum))
+    if SIGNAL_TIME is None:
+        SIGNAL_TIME = time.time()
+    LOG.debug("Got signal %s...", signum)
     if signum == signal.SIGINT:
         LOG.info("Got SIGINT, exiting gracefully... "
                  "Send signal again to force exit.")
@@ -37,6 +46,7 @@ def _handler(signum, frame):
 
 
 EXIT_FLAG = False
+SIGNAL_TIME = None
 SIGINT_HANDLER = signal.getsignal(signal.SIGINT)
 signal.signal(signal.SIGTERM, _handler)
 signal.signal(signal.SIGINT, _handler)
@@ -20,22 +20,59 @@ how to save/load any state to/from persistent storage, so it can be restored
 after the current job restarts and resumed from where it left off.
 """
 
+import contextlib
+import gzip
+import io
+import json
 import os
 import shutil
 import logging
+import tempfile
+import time
+import weakref
+import zlib
 
-from adaptdl.env import checkpoint_path, replica_rank, num_restarts, from_ray
+from adaptdl.env import (checkpoint_path, checkpoint_codec,
+                         checkpoint_generations, replica_rank, num_restarts,
+                         from_ray, log_level)
+import adaptdl.metrics_sink
+import adaptdl.trace
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(log_level())
 
 CKPT_DIR_PREFIX = "checkpoint-"
-
-# FIXME: Keeping global state like this will result in memory leaks for
-# applications which do not restart too often.
-_STATES_TO_NAMES = {}
-_NAMES_TO_STATES = {}
+# Metadata about each checkpoint, e.g. how long it took to save and the size
+# and checksum of each state file, is written to this file alongside the state
+# files.
+MANIFEST_NAME = ".adaptdl-manifest.json"
+
+# States are only weakly referenced, so states which are no longer used by the
+# application (e.g. dataloaders from previous epochs) are released and left out
+# of subsequent checkpoints.
+_STATES_TO_NAMES = weakref.WeakKeyDictionary()
+_NAMES_TO_STATES = weakref.WeakValueDictionary()
+# Stack of open state scopes, each a list of weak references to the states
+# created inside it. A None entry shields new states from enclosing scopes.
+_STATE_SCOPES = []
+
+# Compressed state files begin with this header followed by the codec name and
+# a newline. Uncompressed state files have no header, so checkpoints written
+# before codecs were introduced can still be loaded.
+_CODEC_HEADER = b"\x00adaptdl-codec:"
+# Serialized states are spooled in memory up to this size before spilling to
+# a temporary file, when they need to be buffered before compression.
+_SPOOL_SIZE = 64 * 2 ** 20
+# Size of the serialized prefix used to benchmark codecs in auto mode.
+_SAMPLE_SIZE = 2 ** 20
+# Writes smaller than this are dominated by latency rather than bandwidth, so
+# they are not used to estimate the storage bandwidth.
+_MIN_BANDWIDTH_BYTES = 2 ** 16
+_STORAGE_BANDWIDTH = None  # Estimated storage write bandwidth (bytes/sec).
+_STATE_STATS = {}  # State name -> dict of byte counts and timings.
+_READ_SIZE = 2 ** 20  # Chunk size used when verifying state file checksums.
+_INVALID_CKPT_DIRS = set()  # Checkpoints which failed verification.
+_VALID_CKPT_DIRS = set()  # Checkpoints which passed verification.
 
 
 class State(object):
@@ -48,8 +85,10 @@ class State(object):
     def __init__(self, name):
         """
         Initialize the state object with a unique identifier `name`, which is
-        used to refer to the saved object in persistent storage. No two `State`
-        objects may share the same `name`.
+        used to refer to the saved object in persistent storage. No two live
+        `State` objects may share the same `name`. The state is registered
+        until it is garbage collected, passed to `unregister_state`, or the
+        enclosing `state_scope` exits.
 
         Arguments:
             name (str): Unique name of this `State` object.
@@ -61,6 +100,8 @@ class State(object):
             raise ValueError("State '{}' already exists".format(name))
         _NAMES_TO_STATES[name] = self
         _STATES_TO_NAMES[self] = name
+        if _STATE_SCOPES and _STATE_SCOPES[-1] is not None:
+            _STATE_SCOPES[-1].append(weakref.ref(self))
 
     def save(self, fileobj):
         """
@@ -69,7 +110,8 @@ class State(object):
         state into persistent storage.
 
         Arguments:
-            fileobj (BinaryIO): A binary writable file object.
+            fileobj (BinaryIO): A binary writable file object, which may not be
+                seekable if a checkpoint codec is used.
         """
         pass
 
@@ -94,6 +136,399 @@ class State(object):
         pass
 
 
+def unregister_state(state):
+    """
+    Unregisters a `State` object, so it is no longer saved as part of future
+    checkpoints and its name may be used by a new `State` object. Does nothing
+    if the state is not registered.
+
+    Arguments:
+        state (State): The `State` object to unregister.
+    """
+    name = _STATES_TO_NAMES.pop(state, None)
+    if name is not None:
+        _NAMES_TO_STATES.pop(name, None)
+        _STATE_STATS.pop(name, None)
+
+
+@contextlib.contextmanager
+def state_scope():
+    """
+    Context manager which unregisters every `State` object created inside of
+    it once it exits. For example, to limit the states of dataloaders and
+    accumulators created in each epoch to that epoch:
+
+    .. code-block:: python
+
+        for epoch in adaptdl.torch.remaining_epochs_until(30):
+            with adaptdl.checkpoint.state_scope():
+                dataloader = adaptdl.torch.AdaptiveDataLoader(dataset)
+                ...
+    """
+    refs = []
+    _STATE_SCOPES.append(refs)
+    try:
+        yield
+    finally:
+        _STATE_SCOPES.pop()
+        for ref in refs:
+            state = ref()
+            if state is not None:
+                unregister_state(state)
+
+
+@contextlib.contextmanager
+def _global_scope():
+    # States created inside are not unregistered by any enclosing state_scope,
+    # used for process-wide states which are created lazily.
+    _STATE_SCOPES.append(None)
+    try:
+        yield
+    finally:
+        _STATE_SCOPES.pop()
+
+
+class Codec(object):
+    """
+    A stream codec used to compress the state files of a checkpoint. Should be
+    sub-classed and registered using :func:`register_codec` to support
+    additional compression formats, which can then be selected by name using
+    the ``ADAPTDL_CHECKPOINT_CODEC`` environment variable.
+
+    Arguments:
+        name (str): Unique name of this codec.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def available(self):
+        """
+        Whether this codec can be used, e.g. if its optional dependencies are
+        installed. Unavailable codecs are skipped in auto mode.
+        """
+        return True
+
+    def writer(self, fileobj):
+        """
+        This method should be overridden by subclasses to define how data is
+        compressed. Closing the returned object must flush all compressed data
+        to `fileobj` without closing `fileobj`.
+
+        Arguments:
+            fileobj (BinaryIO): A binary writable file object.
+
+        Returns:
+            BinaryIO: A binary writable file object which compresses its input.
+        """
+        raise NotImplementedError
+
+    def reader(self, fileobj):
+        """
+        This method should be overridden by subclasses to define how data is
+        decompressed. Closing the returned object must not close `fileobj`.
+
+        Arguments:
+            fileobj (BinaryIO): A binary readable file object.
+
+        Returns:
+            BinaryIO: A binary readable file object of the decompressed data.
+        """
+        raise NotImplementedError
+
+
+class _CountingWriter(io.RawIOBase):
+    # Forwards writes to another file object and counts the bytes written.
+    # Closing this object does not close the underlying file object.
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._fileobj.write(b)
+        nbytes = memoryview(b).nbytes
+        self.count += nbytes
+        return nbytes
+
+    def tell(self):
+        return self.count
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+class _ChecksumWriter(object):
+    # Wraps a writable file object and computes the CRC32 of all data written
+    # through it. Seeking invalidates the checksum, in which case it must be
+    # computed from the file after it is written. Also accumulates the time
+    # spent in writes to the underlying file object, excluding the time spent
+    # producing the data (e.g. compressing it).
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.crc32 = 0
+        self.valid = True
+        self.write_time = 0.0
+
+    def write(self, b):
+        self.crc32 = zlib.crc32(b, self.crc32)
+        start = time.time()
+        try:
+            return self._fileobj.write(b)
+        finally:
+            self.write_time += time.time() - start
+
+    def writelines(self, lines):
+        for b in lines:
+            self.write(b)
+
+    def seek(self, *args):
+        self.valid = False
+        return self._fileobj.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+def _file_crc32(path):
+    crc32 = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b""):
+            crc32 = zlib.crc32(chunk, crc32)
+    return crc32
+
+
+class _NoneCodec(Codec):
+    def __init__(self):
+        super().__init__("none")
+
+    def writer(self, fileobj):
+        return _CountingWriter(fileobj)
+
+    def reader(self, fileobj):
+        return fileobj
+
+
+class _GzipCodec(Codec):
+    def __init__(self):
+        super().__init__("gzip")
+
+    def writer(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=1)
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+
+class _ZstdCodec(Codec):
+    def __init__(self):
+        super().__init__("zstd")
+
+    def available(self):
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def writer(self, fileobj):
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(fileobj,
+                                                        closefd=False)
+
+    def reader(self, fileobj):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj,
+                                                          closefd=False)
+
+
+class _Lz4Codec(Codec):
+    def __init__(self):
+        super().__init__("lz4")
+
+    def available(self):
+        try:
+            import lz4.frame  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def writer(self, fileobj):
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fileobj, mode="wb")
+
+    def reader(self, fileobj):
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fileobj, mode="rb")
+
+
+_CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Registers a `Codec` so it can be selected by name for saving checkpoints,
+    and used to load state files which were compressed using it.
+
+    Arguments:
+        codec (Codec): The `Codec` object to register.
+
+    Raises:
+        ValueError: If the codec name is reserved or already registered.
+    """
+    if codec.name == "auto" or codec.name in _CODECS:
+        raise ValueError("Codec '{}' already exists".format(codec.name))
+    _CODECS[codec.name] = codec
+
+
+for _codec in (_NoneCodec(), _GzipCodec(), _ZstdCodec(), _Lz4Codec()):
+    register_codec(_codec)
+
+
+def _get_codec(name):
+    if name not in _CODECS:
+        raise ValueError("Unknown checkpoint codec '{}'".format(name))
+    if not _CODECS[name].available():
+        raise RuntimeError("Checkpoint codec '{}' is not available".format(
+            name))
+    return _CODECS[name]
+
+
+def _select_codec(rawfile, raw_bytes):
+    # Pick the codec which is estimated to finish writing the state the
+    # soonest, by compressing a prefix of the serialized state with each codec
+    # and comparing against the measured storage bandwidth.
+    best_codec = _CODECS["none"]
+    if _STORAGE_BANDWIDTH is None or raw_bytes == 0:
+        # Write uncompressed to measure the storage bandwidth first.
+        return best_codec
+    best_time = raw_bytes / _STORAGE_BANDWIDTH
+    sample = rawfile.read(_SAMPLE_SIZE)
+    for codec in _CODECS.values():
+        if codec is best_codec or not codec.available():
+            continue
+        buf = io.BytesIO()
+        start = time.time()
+        with codec.writer(buf) as writer:
+            writer.write(sample)
+        elapsed = max(time.time() - start, 1e-9)
+        ratio = buf.tell() / len(sample)
+        est_time = (raw_bytes * elapsed / len(sample) +
+                    raw_bytes * ratio / _STORAGE_BANDWIDTH)
+        if est_time < best_time:
+            best_codec, best_time = codec, est_time
+    return best_codec
+
+
+def _update_storage_bandwidth(nbytes, elapsed):
+    global _STORAGE_BANDWIDTH
+    if nbytes < _MIN_BANDWIDTH_BYTES:
+        return
+    bandwidth = nbytes / max(elapsed, 1e-9)
+    if _STORAGE_BANDWIDTH is None:
+        _STORAGE_BANDWIDTH = bandwidth
+    else:  # Exponential moving average to smooth out noisy measurements.
+        _STORAGE_BANDWIDTH = 0.5 * _STORAGE_BANDWIDTH + 0.5 * bandwidth
+
+
+def _write_header(fileobj, codec):
+    if codec.name != "none":
+        fileobj.write(_CODEC_HEADER + codec.name.encode() + b"\n")
+
+
+def _read_header(fileobj):
+    header = fileobj.read(len(_CODEC_HEADER))
+    if header != _CODEC_HEADER:
+        fileobj.seek(0)
+        return _CODECS["none"]
+    return _get_codec(fileobj.readline().rstrip(b"\n").decode())
+
+
+def _save_state_file(state, name, state_file):
+    codec_name = checkpoint_codec()
+    start = time.time()
+    with open(state_file, "wb") as rawf:
+        f = _ChecksumWriter(rawf)
+        if codec_name == "auto":
+            # Buffer the serialized state to benchmark codecs against it.
+            with tempfile.SpooledTemporaryFile(_SPOOL_SIZE) as rawfile:
+                state.save(rawfile)
+                raw_bytes = rawfile.seek(0, os.SEEK_END)
+                rawfile.seek(0)
+                codec = _select_codec(rawfile, raw_bytes)
+                rawfile.seek(0)
+                _write_header(f, codec)
+                with codec.writer(f) as writer:
+                    shutil.copyfileobj(rawfile, writer)
+                # Only the raw writes and the sync are timed, so the time
+                # spent compressing is not mistaken for slow storage.
+                sync_start = time.time()
+                f.flush()
+                os.fsync(f.fileno())
+                _update_storage_bandwidth(
+                    f.tell(), f.write_time + time.time() - sync_start)
+        elif codec_name == "none":
+            codec = _CODECS["none"]
+            state.save(f)
+            raw_bytes = None  # Same as the stored bytes.
+        else:
+            codec = _get_codec(codec_name)
+            _write_header(f, codec)
+            with codec.writer(f) as writer:
+                counter = _CountingWriter(writer)
+                state.save(counter)
+                raw_bytes = counter.count
+    # States may seek back while saving, so the size is taken from the file
+    # rather than from the final write position.
+    stored_bytes = os.path.getsize(state_file)
+    if raw_bytes is None:
+        raw_bytes = stored_bytes
+    crc32 = f.crc32 if f.valid else _file_crc32(state_file)
+    _STATE_STATS.setdefault(name, {}).update(
+        codec=codec.name, raw_bytes=raw_bytes, stored_bytes=stored_bytes,
+        crc32=crc32, save_time=time.time() - start)
+    LOG.debug("saved state %s with codec %s: %s", name, codec.name,
+              _STATE_STATS[name])
+
+
+def _load_state_file(state, name, state_file):
+    start = time.time()
+    with open(state_file, "rb") as f:
+        codec = _read_header(f)
+        if codec.name == "none":
+            state.load(f)
+        else:
+            # Many loaders (e.g. torch.load) require a seekable file object.
+            with tempfile.SpooledTemporaryFile(_SPOOL_SIZE) as rawfile:
+                with codec.reader(f) as reader:
+                    shutil.copyfileobj(reader, rawfile)
+                rawfile.seek(0)
+                state.load(rawfile)
+        stored_bytes = f.tell()
+    _STATE_STATS.setdefault(name, {}).update(
+        load_codec=codec.name, load_bytes=stored_bytes,
+        load_time=time.time() - start)
+
+
+def state_stats():
+    """
+    Byte counts and timings recorded for each `State` saved or loaded by the
+    current process. For saved states, includes the codec used (``codec``),
+    the serialized size (``raw_bytes``), the size written to storage
+    (``stored_bytes``), its checksum (``crc32``), and the time taken
+    (``save_time``). For loaded states,
+    includes ``load_codec``, ``load_bytes``, and ``load_time``.
+
+    Returns:
+        dict: map from state names to their recorded statistics.
+    """
+    return {name: dict(stats) for name, stats in _STATE_STATS.items()}
+
+
 def _get_tmp_ckpt_dir(checkpoint_path):
     if checkpoint_path is None:
         return None
@@ -107,8 +542,18 @@ def save_all_states():
     """
     Invokes `save_state` on all `State` objects for which `State.skip` is True.
     This function can be used to trigger a global checkpoint and save every
-    `State` in the current job.
+    live `State` in the current job. The buffered metrics records (see
+    :mod:`adaptdl.metrics_sink`) and the step timeline of the current replica,
+    if tracing is enabled (see :mod:`adaptdl.trace`), are also flushed.
     """
+    with adaptdl.trace.span("checkpoint", "checkpoint"):
+        checkpoint_dir = _save_all_states()
+    adaptdl.metrics_sink.flush_all()
+    adaptdl.trace.flush()
+    return checkpoint_dir
+
+
+def _save_all_states():
     if from_ray():
         from ray.tune.trainable import TrainableUtil
         checkpoint_dir = TrainableUtil.make_checkpoint_dir("/tmp",
@@ -116,20 +561,34 @@ def save_all_states():
                                                            override=True)
     else:
         checkpoint_dir = checkpoint_path()
-    for state in _STATES_TO_NAMES:
+    start = time.time()
+    # Copy the states, since the weak registry may change while iterating.
+    states = list(_STATES_TO_NAMES)
+    for state in states:
         save_state(state, checkpoint_dir)
+    for name in list(_STATE_STATS):
+        if name not in _NAMES_TO_STATES:
+            del _STATE_STATS[name]  # Statistics of states which were released.
 
     # Prevent corrupting original state files in case the process got killed
-    # during state file writing.
+    # during state file writing. The most recent checkpoints are kept, so a
+    # corrupted checkpoint can fall back to the previous one when loading.
     if replica_rank() == 0 and checkpoint_dir is not None:
         tmp_ckpt_dir = _get_tmp_ckpt_dir(checkpoint_dir)
-        ckpt_dir = os.path.join(checkpoint_dir,
-                                f"{CKPT_DIR_PREFIX}{num_restarts()}")
+        manifest = {
+            "save_time": time.time() - start,
+            "states": {_STATES_TO_NAMES[state]:
+                       _STATE_STATS.get(_STATES_TO_NAMES[state], {})
+                       for state in states},
+        }
+        with open(os.path.join(tmp_ckpt_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        ckpt_dir = _next_ckpt_dir(checkpoint_dir)
         os.rename(tmp_ckpt_dir, ckpt_dir)  # atomic, rename(src, dst)
-        for dir_name in os.listdir(checkpoint_dir):
-            dir_path = os.path.join(checkpoint_dir, dir_name)
-            if dir_name.startswith(CKPT_DIR_PREFIX) and dir_path != ckpt_dir:
-                shutil.rmtree(dir_path)
+        for dir_path in _ckpt_dirs(checkpoint_dir)[checkpoint_generations():]:
+            shutil.rmtree(dir_path)
         return checkpoint_dir
 
 
@@ -139,7 +598,8 @@ def save_state(state, checkpoint_dir, sync=True):
     all replicas if `sync` is `True` (default), and then invokes `State.save`
     on the replica of rank 0 only. Note that we save state to a temporary
     folder first. Then, it will be renamed to the formal checkpoint folder
-    after all states are saved.
+    after all states are saved. The state file is compressed using the codec
+    selected by ``ADAPTDL_CHECKPOINT_CODEC``.
 
     Arguments:
         state (State): The `State` object to save to persistent storage.
@@ -152,15 +612,17 @@ def save_state(state, checkpoint_dir, sync=True):
         name = _STATES_TO_NAMES[state]
         state_file = os.path.join(_get_tmp_ckpt_dir(checkpoint_dir), name)
 
-        with open(state_file, "wb") as f:
-            state.save(f)
+        _save_state_file(state, name, state_file)
 
 
 def load_state(state):
     """
     Load the given `State` object from persistent storage. If the object was
     previously saved, then State.load will be invoked with a readable file
-    object to load from.
+    object to load from. Every state file of a checkpoint is verified against
+    the checksum recorded when it was saved before any state is loaded from it.
+    If verification fails, all states are loaded from the newest valid older
+    checkpoint instead, so states are never loaded from different checkpoints.
 
     Arguments:
         state (State): `State` object to load from persistent storage.
@@ -169,38 +631,141 @@ def load_state(state):
         `True` if state was previously saved and `State.load` was invoked,
         `False` otherwise.
     """
+    name = _STATES_TO_NAMES[state]
+    ckpt_dir = _latest_ckpt_dir()
+    if ckpt_dir is None:
+        return False
+    state_file = os.path.join(ckpt_dir, name)
+    if not os.path.isfile(state_file):
+        LOG.warning(f"Cannot find state file {state_file}.")
+        return False
+
+    _load_state_file(state, name, state_file)
+
+    return True
+
+
+def load_manifest():
+    """
+    Load the manifest of the latest valid checkpoint, which records how long
+    the checkpoint took to save (``save_time``) and the statistics of each
+    saved state (``states``, see :func:`state_stats`).
+
+    Returns:
+        dict: the manifest, or ``None`` if there is no checkpoint or it was
+        saved without a manifest.
+    """
+    ckpt_dir = _latest_ckpt_dir()
+    if ckpt_dir is None:
+        return None
+    try:
+        return _read_manifest(ckpt_dir)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_manifest(ckpt_dir):
+    manifest_file = os.path.join(ckpt_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def _ckpt_generation(dir_name):
+    # Checkpoints are named checkpoint-{restart}, or checkpoint-{restart}.{n}
+    # if n checkpoints were already saved since that restart. Returns a tuple
+    # which orders checkpoints from oldest to newest, or None for other names.
+    if not dir_name.startswith(CKPT_DIR_PREFIX):
+        return None
+    try:
+        return tuple(int(part) for part in
+                     dir_name[len(CKPT_DIR_PREFIX):].split("."))
+    except ValueError:
+        return None
+
+
+def _ckpt_dirs(checkpoint_dir):
+    # All checkpoints in checkpoint_dir, from newest to oldest.
+    generations = []
+    for dir_name in os.listdir(checkpoint_dir):
+        generation = _ckpt_generation(dir_name)
+        if generation is not None:
+            generations.append((generation, dir_name))
+    return [os.path.join(checkpoint_dir, dir_name)
+            for _, dir_name in sorted(generations, reverse=True)]
+
+
+def _next_ckpt_dir(checkpoint_dir):
+    restart = num_restarts()
+    count = 0
+    for ckpt_dir in _ckpt_dirs(checkpoint_dir):
+        generation = _ckpt_generation(os.path.basename(ckpt_dir))
+        if generation[0] == restart:
+            count = max(count, sum(generation[1:]) + 1)
+    suffix = f".{count}" if count else ""
+    return os.path.join(checkpoint_dir,
+                        f"{CKPT_DIR_PREFIX}{restart}{suffix}")
+
+
+def _check_ckpt_dir(ckpt_dir):
+    # Checks that every state file in the manifest has its recorded size and
+    # checksum, before any state is loaded from the checkpoint. Sizes are
+    # checked first, since truncated checkpoints can be detected cheaply.
+    try:
+        manifest = _read_manifest(ckpt_dir)
+    except (OSError, ValueError) as exc:
+        LOG.warning(f"Cannot read manifest of {ckpt_dir}: {exc}")
+        return False
+    if manifest is None:
+        return True  # Saved before manifests were introduced.
+    for name, stats in manifest.get("states", {}).items():
+        state_file = os.path.join(ckpt_dir, name)
+        if "stored_bytes" in stats and (
+                not os.path.isfile(state_file) or
+                os.path.getsize(state_file) != stats["stored_bytes"]):
+            LOG.warning(f"State file {state_file} is missing or truncated.")
+            return False
+    for name, stats in manifest.get("states", {}).items():
+        state_file = os.path.join(ckpt_dir, name)
+        if "crc32" in stats and _file_crc32(state_file) != stats["crc32"]:
+            LOG.warning(f"State file {state_file} is corrupted.")
+            return False
+    return True
+
+
+def _latest_ckpt_dir():
     if from_ray():
         from ray.tune import session
         checkpoint_dir = session.get_session().get_checkpoint()
     else:
         checkpoint_dir = checkpoint_path()
     if checkpoint_dir is None:
-        return False
+        return None
 
-    ckpt_dirs = os.listdir(checkpoint_dir)
+    ckpt_dirs = _ckpt_dirs(checkpoint_dir)
     if not ckpt_dirs:
         LOG.info(f"No checkpoint found in {checkpoint_dir}.")
-        return False
+        return None
 
-    latest_restart_id = 0
-    for dir_name in ckpt_dirs:
-        if dir_name.startswith(CKPT_DIR_PREFIX):
-            restart_id = int(dir_name[len(CKPT_DIR_PREFIX):])
-            latest_restart_id = max(latest_restart_id, restart_id)
+    for ckpt_dir in ckpt_dirs:
+        if ckpt_dir in _VALID_CKPT_DIRS:
+            break
+        if ckpt_dir in _INVALID_CKPT_DIRS:
+            continue
+        if _check_ckpt_dir(ckpt_dir):
+            _VALID_CKPT_DIRS.add(ckpt_dir)
+            break
+        LOG.warning(f"Checkpoint {ckpt_dir} is invalid. "
+                    "Falling back to the previous checkpoint.")
+        _INVALID_CKPT_DIRS.add(ckpt_dir)
+    else:
+        LOG.warning(f"No valid checkpoint found in {checkpoint_dir}.")
+        return None
 
-    if latest_restart_id != num_restarts() - 1:
+    restart_id = _ckpt_generation(os.path.basename(ckpt_dir))[0]
+    if restart_id != num_restarts() - 1:
         LOG.warning("Cannot find checkpoint from the last restart. "
-                    f"Loading checkpoint from restart {latest_restart_id}.")
-
-    ckpt_dir = os.path.join(checkpoint_dir,
-                            f"{CKPT_DIR_PREFIX}{latest_restart_id}")
-    name = _STATES_TO_NAMES[state]
-    state_file = os.path.join(ckpt_dir, name)
-    if not os.path.isfile(state_file):
-        LOG.warning(f"Cannot find state file {state_file}.")
-        return False
-
-    with open(state_file, "rb") as f:
-        state.load(f)
+                    f"Loading checkpoint from restart {restart_id}.")
 
-    return True
+    return ckpt_dir
@@ -68,3 +68,255 @@ def test_save_load():
         assert state_2.value == 20
     else:
         assert False
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip", "zstd", "lz4", "auto"])
+@elastic_multiprocessing
+def test_save_load_codec(codec):
+    import os
+    import pickle
+    import torch
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    state_stats, _get_codec)
+    from adaptdl.env import num_restarts
+
+    if codec not in ("none", "auto"):
+        try:
+            _get_codec(codec)
+        except RuntimeError:
+            return 0  # Optional dependency is not installed.
+
+    class TestState(State):
+        def save(self, fileobj):
+            pickle.dump(self.value, fileobj)
+            torch.save(self.tensor, fileobj)
+
+        def load(self, fileobj):
+            self.value = pickle.load(fileobj)
+            self.tensor = torch.load(fileobj)
+
+    state = TestState("state")
+    if num_restarts() == 0:
+        os.environ["ADAPTDL_CHECKPOINT_CODEC"] = codec
+        state.value = list(range(100000))
+        state.tensor = torch.zeros(100000)
+        save_all_states()
+        stats = state_stats()["state"]
+        assert stats["raw_bytes"] > 0
+        if stats["codec"] != "none":
+            assert stats["stored_bytes"] < stats["raw_bytes"]
+        return 2
+    elif num_restarts() == 1:
+        assert load_state(state)
+        assert state.value == list(range(100000))
+        assert torch.equal(state.tensor, torch.zeros(100000))
+        assert state_stats()["state"]["load_time"] >= 0.0
+
+
+@pytest.mark.parametrize("codec", ["none", "auto"])
+@elastic_multiprocessing
+def test_save_load_seek(codec):
+    import os
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    state_stats)
+    from adaptdl.env import num_restarts
+
+    class TestState(State):
+        def save(self, fileobj):
+            # Patches earlier bytes, leaving the position before the end.
+            fileobj.write(b"0" * 100)
+            fileobj.seek(0)
+            fileobj.write(b"1")
+
+        def load(self, fileobj):
+            self.data = fileobj.read()
+
+    state = TestState("state")
+    if num_restarts() == 0:
+        os.environ["ADAPTDL_CHECKPOINT_CODEC"] = codec
+        save_all_states()
+        assert state_stats()["state"]["raw_bytes"] == 100
+        return 1
+    elif num_restarts() == 1:
+        assert load_state(state)
+        assert state.data == b"1" + b"0" * 99
+
+
+def test_select_codec(monkeypatch):
+    import io
+    import adaptdl.checkpoint
+    from adaptdl.checkpoint import _select_codec
+
+    data = b"adaptdl" * 2 ** 18  # Highly compressible.
+    rawfile = io.BytesIO(data)
+    # Bandwidth is unknown until an uncompressed state has been written.
+    monkeypatch.setattr(adaptdl.checkpoint, "_STORAGE_BANDWIDTH", None)
+    assert _select_codec(rawfile, len(data)).name == "none"
+    # Compression is not worth its CPU time on fast storage.
+    monkeypatch.setattr(adaptdl.checkpoint, "_STORAGE_BANDWIDTH", 1e15)
+    rawfile.seek(0)
+    assert _select_codec(rawfile, len(data)).name == "none"
+    # Compressible states are compressed on slow storage.
+    monkeypatch.setattr(adaptdl.checkpoint, "_STORAGE_BANDWIDTH", 1e3)
+    rawfile.seek(0)
+    assert _select_codec(rawfile, len(data)).name != "none"
+
+
+def test_storage_bandwidth(monkeypatch, tmp_path):
+    import time
+    import adaptdl.checkpoint
+    from adaptdl.checkpoint import Codec, _CountingWriter, _save_state_file
+
+    class SlowWriter(_CountingWriter):
+        def write(self, b):
+            time.sleep(0.2)  # E.g. compressing.
+            return super().write(b)
+
+    class SlowCodec(Codec):
+        # Passes data through unchanged, but takes a long time to do it.
+        def writer(self, fileobj):
+            return SlowWriter(fileobj)
+
+    class TestState(object):
+        def save(self, fileobj):
+            fileobj.write(b"0" * 2 ** 20)
+
+    codec = SlowCodec("slow")
+    monkeypatch.setitem(adaptdl.checkpoint._CODECS, "slow", codec)
+    monkeypatch.setattr(adaptdl.checkpoint, "_select_codec",
+                        lambda rawfile, raw_bytes: codec)
+    monkeypatch.setattr(adaptdl.checkpoint, "_STORAGE_BANDWIDTH", None)
+    monkeypatch.setattr(adaptdl.checkpoint, "_STATE_STATS", {})
+    monkeypatch.setenv("ADAPTDL_CHECKPOINT_CODEC", "auto")
+    _save_state_file(TestState(), "state", str(tmp_path / "state"))
+    assert adaptdl.checkpoint.state_stats()["state"]["save_time"] > 0.2
+    # Time spent compressing is not counted as time spent writing.
+    assert adaptdl.checkpoint._STORAGE_BANDWIDTH > 2 ** 20 / 0.2
+
+
+@elastic_multiprocessing
+def test_release_states():
+    import gc
+    import os
+    import pickle
+    import tracemalloc
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    state_scope, unregister_state,
+                                    _NAMES_TO_STATES)
+    from adaptdl.env import checkpoint_path, num_restarts
+
+    class TestState(State):
+        def __init__(self, name, value=0):
+            super().__init__(name)
+            self.value = value
+
+        def save(self, fileobj):
+            pickle.dump(self.value, fileobj)
+
+        def load(self, fileobj):
+            self.value = pickle.load(fileobj)
+
+    def checkpoint_size():
+        ckpt_dir = [name for name in os.listdir(checkpoint_path())
+                    if name.startswith("checkpoint-")][0]
+        ckpt_dir = os.path.join(checkpoint_path(), ckpt_dir)
+        return sum(os.path.getsize(os.path.join(ckpt_dir, name))
+                   for name in os.listdir(ckpt_dir))
+
+    persistent = TestState("persistent")
+    if num_restarts() == 0:
+        tracemalloc.start()
+        for epoch in range(1000):
+            # Dropped at the end of each iteration.
+            dropped = TestState(  # noqa: F841
+                "dropped-{}".format(epoch), [0] * 100)
+            unregistered = TestState("unregistered-{}".format(epoch))
+            unregister_state(unregistered)
+            with state_scope():
+                scoped = TestState("scoped-{}".format(epoch))  # noqa: F841
+            save_all_states()
+            if epoch == 10:
+                gc.collect()
+                memory = tracemalloc.get_traced_memory()[0]
+                size = checkpoint_size()
+            del dropped
+        gc.collect()
+        assert tracemalloc.get_traced_memory()[0] - memory < 2 ** 18
+        tracemalloc.stop()
+        assert list(_NAMES_TO_STATES) == ["persistent"]
+        assert checkpoint_size() < 2 * size
+        # Names of released states can be reused.
+        reused = TestState("dropped-999")  # noqa: F841
+        # Only live states are saved.
+        persistent.value = 1
+        save_all_states()
+        return 1
+    elif num_restarts() == 1:
+        assert load_state(persistent) and persistent.value == 1
+        assert not load_state(TestState("dropped-0"))
+        assert not load_state(TestState("unregistered-999"))
+        assert not load_state(TestState("scoped-999"))
+
+
+@elastic_multiprocessing
+def test_corrupted_fallback():
+    import os
+    import pickle
+    from adaptdl.checkpoint import State, save_all_states, load_state
+    from adaptdl.env import checkpoint_path, num_restarts
+
+    os.environ["ADAPTDL_CHECKPOINT_GENERATIONS"] = "3"
+
+    class TestState(State):
+        def save(self, fileobj):
+            pickle.dump(self.value, fileobj)
+
+        def load(self, fileobj):
+            self.value = pickle.load(fileobj)
+
+    state_a = TestState("state_a")
+    state_b = TestState("state_b")
+
+    def ckpt_file(dir_name, name):
+        return os.path.join(checkpoint_path(), dir_name, name)
+
+    if num_restarts() == 0:
+        for value in range(1, 5):
+            state_a.value = state_b.value = value
+            save_all_states()
+        assert sorted(name for name in os.listdir(checkpoint_path())
+                      if name.startswith("checkpoint-")) == \
+            ["checkpoint-0.1", "checkpoint-0.2", "checkpoint-0.3"]
+        # Flip the last byte of a state file in the latest checkpoint.
+        with open(ckpt_file("checkpoint-0.3", "state_a"), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        return 1
+    elif num_restarts() == 1:
+        assert load_state(state_a) and state_a.value == 3
+        assert load_state(state_b) and state_b.value == 3
+        state_a.value = state_b.value = 5
+        save_all_states()
+        # Truncate a state file in the latest checkpoint.
+        with open(ckpt_file("checkpoint-1", "state_b"), "r+b") as f:
+            f.truncate(1)
+        return 1
+    elif num_restarts() == 2:
+        assert load_state(state_a) and state_a.value == 3
+        assert load_state(state_b) and state_b.value == 3
+        for value in (6, 7):
+            state_a.value = state_b.value = value
+            save_all_states()
+        # Corrupt the second state loaded from the latest checkpoint, neither
+        # state should be loaded from it.
+        with open(ckpt_file("checkpoint-2.1", "state_b"), "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        return 1
+    elif num_restarts() == 3:
+        assert load_state(state_a) and state_a.value == 6
+        assert load_state(state_b) and state_b.value == 6
@@ -18,6 +18,7 @@ environment variables, or their defaults if unset.
 """
 
 import os
+import socket
 
 
 def checkpoint_path():
@@ -33,6 +34,109 @@ def checkpoint_path():
     return os.getenv("ADAPTDL_CHECKPOINT_PATH")
 
 
+def checkpoint_codec():
+    """
+    Name of the codec used to compress checkpointed state files. Determined by
+    the environment variable ``ADAPTDL_CHECKPOINT_CODEC``, or ``none`` if
+    unset. Can be ``none``, ``gzip``, ``zstd``, ``lz4``, or ``auto``, which
+    selects whichever codec is estimated to finish saving each state first.
+
+    Returns:
+        str: checkpoint codec name, or ``none``.
+    """
+    return os.getenv("ADAPTDL_CHECKPOINT_CODEC", "none")
+
+
+def checkpoint_generations():
+    """
+    Number of most recent checkpoints kept in the checkpoint path, so loading
+    can fall back to an older checkpoint if the latest one is found to be
+    corrupted. Determined by the environment variable
+    ``ADAPTDL_CHECKPOINT_GENERATIONS``, or 2 if unset. Always at least 1.
+
+    Returns:
+        int: number of checkpoints to keep, or 2.
+    """
+    return max(int(os.getenv("ADAPTDL_CHECKPOINT_GENERATIONS", "2")), 1)
+
+
+def trace_steps():
+    """
+    Number of most recent training steps whose phases are kept in the step
+    timeline, which is written as a Chrome trace for each replica. Determined
+    by the environment variable ``ADAPTDL_TRACE_STEPS``, or 0 if unset, which
+    disables tracing.
+
+    Returns:
+        int: number of traced steps, or 0.
+    """
+    return max(int(os.getenv("ADAPTDL_TRACE_STEPS", "0")), 0)
+
+
+def tensorboard_logdir():
+    """
+    Path to the TensorBoard log directory of the current job. Determined by
+    the environment variable ``ADAPTDL_TENSORBOARD_LOGDIR``.
+
+    Returns:
+        str: path to the TensorBoard log directory, or ``None``.
+    """
+    return os.getenv("ADAPTDL_TENSORBOARD_LOGDIR")
+
+
+def metrics_port():
+    """
+    Port on which each replica serves its training metrics over HTTP, in the
+    Prometheus text format, at the path ``/metrics``. Determined by the
+    environment variable ``ADAPTDL_METRICS_PORT``, or 0 if unset, which
+    disables the metrics endpoint.
+
+    Returns:
+        int: port of the metrics endpoint, or 0.
+    """
+    return int(os.getenv("ADAPTDL_METRICS_PORT", "0"))
+
+
+def metrics_format():
+    """
+    Format of the files the training and validation metrics reported by the
+    job are written to. Determined by the environment variable
+    ``ADAPTDL_METRICS_FORMAT``, or ``json`` if unset. Can be ``json``, which
+    writes one JSON object per line, or ``parquet``, which requires pyarrow.
+
+    Returns:
+        str: metrics format name, or ``json``.
+    """
+    return os.getenv("ADAPTDL_METRICS_FORMAT", "json")
+
+
+def overhead_budget():
+    """
+    Fraction of the training time which per-step bookkeeping of the trainer,
+    such as profiling, gradient noise scale estimation, and synchronizing the
+    exit signal between replicas, is allowed to take. Determined by the
+    environment variable ``ADAPTDL_OVERHEAD_BUDGET``, or 0 if unset, which
+    does the bookkeeping on every step. Otherwise, it is only done on steps
+    sampled at an interval chosen to stay within the budget.
+
+    Returns:
+        float: overhead budget, or 0.
+    """
+    return max(float(os.getenv("ADAPTDL_OVERHEAD_BUDGET", "0")), 0.0)
+
+
+def log_level():
+    """
+    Level of the messages logged by AdaptDL. Determined by the environment
+    variable ``ADAPTDL_LOG_LEVEL``, or ``INFO`` if unset. Messages logged on
+    every training step are only formatted at the ``DEBUG`` level.
+
+    Returns:
+        str: name of the log level, or ``INFO``.
+    """
+    return os.getenv("ADAPTDL_LOG_LEVEL", "INFO").upper()
+
+
 def share_path():
     """
     Path to a directory shared by all AdaptDL job replicas, which can be used
@@ -115,6 +219,19 @@ def num_nodes():
     return int(os.getenv("ADAPTDL_NUM_NODES", num_replicas()))
 
 
+def node_name():
+    """
+    Name of the node the current replica is running on, used to identify
+    nodes which are persistently slower than others. Determined by the
+    environment variable ``ADAPTDL_NODE_NAME``, or the hostname if unset.
+    Automatically set in AdaptDL-scheduled clusters.
+
+    Returns:
+        str: name of the current node.
+    """
+    return os.getenv("ADAPTDL_NODE_NAME") or socket.gethostname()
+
+
 def num_replicas():
     """
     Total number of replicas, required for distributed training. For example,
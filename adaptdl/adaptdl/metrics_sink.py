@@ -0,0 +1,303 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module writes streams of metrics records reported by the job, such as the
+training and validation loss after each epoch, to files in the checkpoint path.
+Records are buffered in memory and written in batches, so reporting does not
+compete with checkpoint I/O on the shared storage every time it is called. The
+buffered records are written whenever a checkpoint is saved and when the
+replica exits. Each stream is split into numbered segment files which are
+rotated once they reach a maximum size, and only the most recent segments are
+kept. Segments are written as JSON lines, or as Parquet files if the
+environment variable ``ADAPTDL_METRICS_FORMAT`` is set to ``parquet``.
+"""
+
+import atexit
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import adaptdl.env
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(adaptdl.env.log_level())
+
+# Number of records buffered in memory before they are written.
+_BUFFER_RECORDS = 256
+# Records are also written once this many seconds passed since they were last
+# written, so the files do not lag far behind when reports are rare.
+_FLUSH_INTERVAL = 60.0
+# A new segment is started once the current one is at least this many bytes.
+_MAX_BYTES = 16 * 2 ** 20
+# Number of most recent segments kept for each stream.
+_MAX_SEGMENTS = 64
+
+_SINKS = {}  # Stream name -> MetricsSink.
+_SINKS_LOCK = threading.Lock()
+
+
+class MetricsSink(object):
+    """
+    Base class of sinks which buffer the records of one stream and write them
+    in batches to numbered segment files named ``<name>-<number><suffix>``.
+    Subclasses define the suffix and implement ``_append``.
+
+    Arguments:
+        path (str): Directory to write the segment files to.
+        name (str): Name of the stream of records.
+        buffer_records (int): Number of buffered records which triggers a
+            write.
+        flush_interval (float): Seconds since the last write after which a
+            new record triggers a write.
+        max_bytes (int): Size at which a new segment is started.
+        max_segments (int): Number of most recent segments to keep.
+
+    Raises:
+        ValueError: If ``buffer_records``, ``max_bytes``, or ``max_segments``
+            is not positive.
+    """
+    suffix = None
+
+    def __init__(self, path, name, buffer_records=_BUFFER_RECORDS,
+                 flush_interval=_FLUSH_INTERVAL, max_bytes=_MAX_BYTES,
+                 max_segments=_MAX_SEGMENTS):
+        if buffer_records <= 0:
+            raise ValueError("buffer_records must be positive")
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        if max_segments <= 0:
+            raise ValueError("max_segments must be positive")
+        self.path = path
+        self.name = name
+        self.buffer_records = buffer_records
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self._records = []
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        """
+        Buffers a record, and writes all buffered records including it if
+        there are enough of them or they were last written long enough ago.
+
+        Arguments:
+            record (dict): JSON-serializable record to write.
+        """
+        with self._lock:
+            self._records.append(record)
+            if len(self._records) < self.buffer_records and \
+                    time.time() - self._flushed_at < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered records to the current segment, starting a new
+        segment and removing the oldest ones if needed.
+        """
+        with self._lock:
+            records, self._records = self._records, []
+            self._flushed_at = time.time()
+            if not records:
+                return
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                segments = _segments(self.path, self.name, self.suffix)
+                number = segments[-1][0] if segments else 0
+                filename = self._filename(number)
+                if os.path.exists(filename) and \
+                        os.path.getsize(filename) >= self.max_bytes:
+                    number += 1
+                    filename = self._filename(number)
+                    segments.append((number, filename))
+                self._append(filename, records)
+                for _, old in segments[:-self.max_segments]:
+                    os.remove(old)
+            except Exception as exc:
+                LOG.warning("Dropped %s %s records, failed to write them: %s",
+                            len(records), self.name, exc)
+
+    def _filename(self, number):
+        return os.path.join(self.path, "{}-{:05d}{}".format(
+            self.name, number, self.suffix))
+
+    def _append(self, filename, records):
+        raise NotImplementedError
+
+
+class JsonSink(MetricsSink):
+    """
+    Sink which writes each record as one line of JSON.
+    """
+    suffix = ".jsonl"
+
+    def _append(self, filename, records):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with open(filename, "a") as f:
+            f.write(lines)  # A single write per batch.
+
+
+class ParquetSink(MetricsSink):
+    """
+    Sink which writes records as rows of Parquet files, with one column for
+    each key of the records. Requires pyarrow.
+    """
+    suffix = ".parquet"
+
+    def _append(self, filename, records):
+        import pyarrow
+        import pyarrow.parquet
+        # Parquet files cannot be appended to, so the current segment is
+        # rewritten together with the new records. Segments are small, and
+        # batches are written rarely.
+        columns = {}
+        num_rows = 0
+        if os.path.exists(filename):
+            columns = pyarrow.parquet.read_table(filename).to_pydict()
+            num_rows = len(next(iter(columns.values()), []))
+        for record in records:
+            for key in record:
+                columns.setdefault(key, [None] * num_rows)
+            for key, values in columns.items():
+                values.append(record.get(key))
+            num_rows += 1
+        table = pyarrow.table(columns)
+        # Write to a temporary file and rename it, so a segment is never left
+        # partially written if the replica is killed while writing.
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        try:
+            pyarrow.parquet.write_table(table, tmpname)
+            os.replace(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _segments(path, name, suffix=None):
+    # Returns the sorted (number, filename) of the existing segments.
+    suffixes = [suffix] if suffix else [JsonSink.suffix, ParquetSink.suffix]
+    pattern = re.compile(r"{}-(\d+)({})$".format(
+        re.escape(name), "|".join(map(re.escape, suffixes))))
+    segments = []
+    if not os.path.isdir(path):
+        return segments
+    for entry in os.listdir(path):
+        match = pattern.match(entry)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(path, entry)))
+    return sorted(segments)
+
+
+def _create_sink(name):
+    path = adaptdl.env.checkpoint_path()
+    if path is None:
+        return None
+    metrics_format = adaptdl.env.metrics_format()
+    if metrics_format == "parquet":
+        if _has_pyarrow():
+            return ParquetSink(path, name)
+        LOG.warning("pyarrow is not installed, writing %s metrics as JSON",
+                    name)
+    elif metrics_format != "json":
+        raise ValueError("unsupported metrics format {}"
+                         .format(metrics_format))
+    return JsonSink(path, name)
+
+
+def get_sink(name):
+    """
+    Returns the sink of a stream of records in the checkpoint path, in the
+    format determined by ``ADAPTDL_METRICS_FORMAT``. All sinks are flushed
+    when a checkpoint is saved and when the replica exits.
+
+    Arguments:
+        name (str): Name of the stream of records, e.g. ``train``.
+
+    Returns:
+        MetricsSink: The sink of the stream, or ``None`` if the checkpoint
+            path is unset.
+
+    Raises:
+        ValueError: If the metrics format is not supported.
+    """
+    with _SINKS_LOCK:
+        if name not in _SINKS:
+            if not _SINKS:
+                atexit.register(flush_all)
+            _SINKS[name] = _create_sink(name)
+        return _SINKS[name]
+
+
+def flush_all():
+    """
+    Writes the buffered records of all sinks.
+    """
+    with _SINKS_LOCK:
+        sinks = [sink for sink in _SINKS.values() if sink is not None]
+    for sink in sinks:
+        sink.flush()
+
+
+def read_metrics(path, name):
+    """
+    Reads all records of a stream written to a directory, in the order they
+    were written, including records written by older versions of AdaptDL to
+    ``<name>.txt``. Reading Parquet segments requires pyarrow.
+
+    Arguments:
+        path (str): Directory the segment files were written to.
+        name (str): Name of the stream of records.
+
+    Returns:
+        list: The records of the stream, as dicts.
+    """
+    records = []
+    filenames = [os.path.join(path, name + ".txt")]
+    filenames += [filename for _, filename in _segments(path, name)]
+    for filename in filenames:
+        if filename.endswith(".parquet"):
+            import pyarrow.parquet
+            columns = pyarrow.parquet.read_table(filename).to_pydict()
+            for values in zip(*columns.values()):
+                records.append({key: value for key, value
+                                in zip(columns, values) if value is not None})
+            continue
+        try:
+            with open(filename) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # Partially written line.
+    return records
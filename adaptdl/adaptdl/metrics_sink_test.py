@@ -0,0 +1,106 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import pytest
+
+import adaptdl.metrics_sink
+from adaptdl.metrics_sink import JsonSink, ParquetSink, read_metrics
+
+
+def test_buffering(tmp_path):
+    sink = JsonSink(str(tmp_path), "train", buffer_records=3)
+    sink.write({"epoch": 0})
+    sink.write({"epoch": 1})
+    assert not list(tmp_path.iterdir())
+    sink.write({"epoch": 2})
+    assert [r["epoch"] for r in read_metrics(str(tmp_path), "train")] == \
+        [0, 1, 2]
+    sink.write({"epoch": 3})
+    sink.flush()
+    assert [r["epoch"] for r in read_metrics(str(tmp_path), "train")] == \
+        [0, 1, 2, 3]
+    with pytest.raises(ValueError):
+        JsonSink(str(tmp_path), "train", buffer_records=0)
+
+
+def test_flush_interval(monkeypatch, tmp_path):
+    sink = JsonSink(str(tmp_path), "train", flush_interval=0.0)
+    sink.write({"epoch": 0})
+    sink.write({"epoch": 1})
+    assert len(read_metrics(str(tmp_path), "train")) == 2
+    # Rare records are written as soon as they are reported.
+    now = 1000.0
+    monkeypatch.setattr(adaptdl.metrics_sink.time, "time", lambda: now)
+    sink = JsonSink(str(tmp_path), "valid", flush_interval=60.0)
+    sink.write({"epoch": 0})
+    now += 30.0
+    sink.write({"epoch": 1})
+    assert not read_metrics(str(tmp_path), "valid")
+    now += 40.0
+    sink.write({"epoch": 2})
+    assert len(read_metrics(str(tmp_path), "valid")) == 3
+    now += 600.0
+    sink.write({"epoch": 3})
+    assert len(read_metrics(str(tmp_path), "valid")) == 4
+
+
+def test_rotation(tmp_path):
+    # Records written by older versions are read first.
+    with open(str(tmp_path / "valid.txt"), "w") as f:
+        json.dump({"epoch": -1}, f)
+        f.write("\n")
+    sink = JsonSink(str(tmp_path), "valid", buffer_records=1, max_bytes=1,
+                    max_segments=3)
+    for epoch in range(5):
+        sink.write({"epoch": epoch})
+    # Every segment is full after one record, only the latest 3 are kept.
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ["valid-00002.jsonl", "valid-00003.jsonl", "valid-00004.jsonl",
+         "valid.txt"]
+    assert [r["epoch"] for r in read_metrics(str(tmp_path), "valid")] == \
+        [-1, 2, 3, 4]
+
+
+def test_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    sink = ParquetSink(str(tmp_path), "train", buffer_records=2)
+    sink.write({"epoch": 0, "loss": 1.0})
+    sink.write({"epoch": 1, "loss": 0.5})
+    sink.write({"epoch": 2, "loss": 0.25, "accuracy": 0.9})
+    sink.flush()
+    assert [p.name for p in tmp_path.iterdir()] == ["train-00000.parquet"]
+    assert read_metrics(str(tmp_path), "train") == [
+        {"epoch": 0, "loss": 1.0}, {"epoch": 1, "loss": 0.5},
+        {"epoch": 2, "loss": 0.25, "accuracy": 0.9}]
+
+
+def test_get_sink(monkeypatch, tmp_path):
+    monkeypatch.setattr(adaptdl.metrics_sink, "_SINKS", {})
+    monkeypatch.delenv("ADAPTDL_CHECKPOINT_PATH", raising=False)
+    assert adaptdl.metrics_sink.get_sink("train") is None
+    monkeypatch.setattr(adaptdl.metrics_sink, "_SINKS", {})
+    monkeypatch.setenv("ADAPTDL_CHECKPOINT_PATH", str(tmp_path))
+    monkeypatch.setenv("ADAPTDL_METRICS_FORMAT", "csv")
+    with pytest.raises(ValueError):
+        adaptdl.metrics_sink.get_sink("train")
+    monkeypatch.setenv("ADAPTDL_METRICS_FORMAT", "json")
+    sink = adaptdl.metrics_sink.get_sink("valid")
+    assert adaptdl.metrics_sink.get_sink("valid") is sink
+    sink.write({"epoch": 0})
+    assert not read_metrics(str(tmp_path), "valid")
+    adaptdl.metrics_sink.flush_all()
+    assert read_metrics(str(tmp_path), "valid") == [{"epoch": 0}]
@@ -22,7 +22,6 @@ import traceback
 import sys
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -15,7 +15,10 @@
 
 import json
 import logging
+import random
 import requests
+import threading
+import time
 from collections import OrderedDict
 from adaptdl.goodput import PerfParams
 import adaptdl.env
@@ -23,7 +26,7 @@ from types import MappingProxyType
 
 
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 # make immutable proxies of globals
@@ -41,23 +44,138 @@ SCHED_HINTS = MappingProxyType({'initBatchSize': 0,
                                 'epoch': None,
                                 'batchSize': None,
                                 'new_profile': None,
-                                'new_goodput_profile': None})
+                                'new_goodput_profile': None,
+                                'restartTimes': None,
+                                'inputBound': False,
+                                'slowNodes': None})
+
+
+class SchedHintsClient(object):
+    """
+    Client which posts scheduling hints of a job to the supervisor. It keeps a
+    persistent connection, bounds the time spent on each request, and retries
+    failed requests with jittered exponential backoff. Hints posted while a
+    previous one is still being sent are coalesced, so only the latest one is
+    sent next. After the first request, only the fields which changed since
+    the last successful request are sent, except for a full update every
+    ``full_interval`` requests.
+
+    Arguments:
+        url (str): URL of the supervisor.
+        job_key (str): Key of the job, i.e. ``namespace/name``.
+        timeout (tuple): Connect and read timeouts of each request in seconds.
+        retries (int): Number of times to retry each failed request.
+        backoff (float): Seconds to wait before the first retry, doubled for
+            each later retry.
+        full_interval (int): Number of requests between full updates.
+    """
+    def __init__(self, url, job_key, timeout=(3.0, 10.0), retries=3,
+                 backoff=0.5, full_interval=10):
+        self.url = f"{url}/hints/{job_key}"
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.full_interval = full_interval
+        self._session = requests.Session()
+        self._session.headers["Content-Type"] = "application/json"
+        self._lock = threading.Lock()
+        self._pending = None  # Latest hints which were not sent yet.
+        self._sending = False  # Whether some thread is sending hints.
+        self._last_sent = None  # Hints sent in the last successful request.
+        self._num_requests = 0
+        self.sent = 0  # Number of hints sent successfully.
+        self.dropped = 0  # Number of hints replaced by newer hints.
+        self.failed = 0  # Number of hints which failed to be sent.
+
+    @property
+    def counters(self):
+        """
+        A dict of the number of hints which were sent, dropped, or failed.
+        """
+        return {"sent": self.sent, "dropped": self.dropped,
+                "failed": self.failed}
+
+    def post(self, sched_hints):
+        """
+        Post the given scheduling hints. If hints are already being sent by
+        another thread, returns immediately and the latest hints are sent by
+        that thread afterwards.
+
+        Arguments:
+            sched_hints (dict): Scheduling hints.
+        """
+        with self._lock:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = dict(sched_hints)
+            if self._sending:
+                return
+            self._sending = True
+        try:
+            while True:
+                with self._lock:
+                    sched_hints, self._pending = self._pending, None
+                    if sched_hints is None:
+                        return
+                self._send(sched_hints)
+        finally:
+            with self._lock:
+                self._sending = False
+
+    def _payload(self, sched_hints):
+        if self._last_sent is None or \
+                self._num_requests % self.full_interval == 0:
+            return sched_hints
+        return {k: v for k, v in sched_hints.items()
+                if k not in self._last_sent or self._last_sent[k] != v}
+
+    def _send(self, sched_hints):
+        payload = self._payload(sched_hints)
+        if not payload:
+            return  # Nothing changed.
+        data = json.dumps(payload)
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1) *
+                           random.uniform(0.5, 1.5))
+                with self._lock:
+                    if self._pending is not None:
+                        # Newer hints will be sent instead.
+                        self.dropped += 1
+                        return
+            try:
+                response = self._session.put(self.url, data=data,
+                                             timeout=self.timeout)
+            except requests.RequestException as exc:
+                LOG.warning(f"Failed to post hints: {exc}")
+                continue
+            if response.status_code == 200:
+                self._num_requests += 1
+                self._last_sent = sched_hints
+                self.sent += 1
+                return
+            LOG.warning(f"Received {response.status_code}")
+            if 400 <= response.status_code < 500 and \
+                    response.status_code != 429:
+                break  # Not worth retrying.
+        self.failed += 1
+        # The supervisor state is unknown, send all fields next time.
+        self._last_sent = None
+
+
+_CLIENT = None
 
 
 def post_sched_hints(sched_hints, job_key):
+    global _CLIENT
     url = adaptdl.env.supervisor_url()
     if not url or url == "":
         return  # skip
-    headers = {"Content-Type": "application/json"}
     try:
         for k in sched_hints:
             assert k in SCHED_HINTS  # validate
-
-        response = \
-            requests.put(url=f"{url}/hints/{job_key}",
-                         data=json.dumps(sched_hints),
-                         headers=headers)
-        if response.status_code != 200:
-            LOG.warning(f"Received {response.status_code}")
+        if _CLIENT is None or _CLIENT.url != f"{url}/hints/{job_key}":
+            _CLIENT = SchedHintsClient(url, job_key)
+        _CLIENT.post(sched_hints)
     except Exception as e:
         LOG.warning(f"{e}")
@@ -0,0 +1,99 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import http.server
+import json
+import threading
+
+import pytest
+
+from adaptdl.sched_hints import SchedHintsClient
+
+
+@pytest.fixture
+def supervisor():
+    requests = []  # (path, hints) of each request received.
+    statuses = []  # Status codes to respond with, then 200.
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_PUT(self):
+            length = int(self.headers["Content-Length"])
+            requests.append((self.path, json.loads(self.rfile.read(length))))
+            self.send_response(statuses.pop(0) if statuses else 200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", requests, statuses
+    server.shutdown()
+
+
+def test_client_diffs(supervisor):
+    url, requests, _ = supervisor
+    client = SchedHintsClient(url, "ns/job", full_interval=3)
+    client.post({"epoch": 0, "maxBatchSize": 128})
+    client.post({"epoch": 1, "maxBatchSize": 128})
+    client.post({"epoch": 1, "maxBatchSize": 128})  # Nothing to send.
+    client.post({"epoch": 2, "maxBatchSize": 128})
+    client.post({"epoch": 3, "maxBatchSize": 128})  # Full update.
+    assert requests == [
+        ("/hints/ns/job", {"epoch": 0, "maxBatchSize": 128}),
+        ("/hints/ns/job", {"epoch": 1}),
+        ("/hints/ns/job", {"epoch": 2}),
+        ("/hints/ns/job", {"epoch": 3, "maxBatchSize": 128}),
+    ]
+    assert client.counters == {"sent": 4, "dropped": 0, "failed": 0}
+
+
+def test_client_retries(supervisor):
+    url, requests, statuses = supervisor
+    client = SchedHintsClient(url, "ns/job", backoff=0.01)
+    client.post({"epoch": 0, "maxBatchSize": 128})
+    # Retried after server errors.
+    statuses.extend([500, 503])
+    client.post({"epoch": 1, "maxBatchSize": 128})
+    assert len(requests) == 4
+    assert client.counters == {"sent": 2, "dropped": 0, "failed": 0}
+    # Client errors are not retried, and all fields are sent next time.
+    statuses.append(400)
+    client.post({"epoch": 2, "maxBatchSize": 128})
+    assert len(requests) == 5
+    assert client.counters == {"sent": 2, "dropped": 0, "failed": 1}
+    client.post({"epoch": 2, "maxBatchSize": 128})
+    assert requests[-1][1] == {"epoch": 2, "maxBatchSize": 128}
+    # Unreachable supervisor.
+    client = SchedHintsClient("http://127.0.0.1:1", "ns/job", retries=1,
+                              backoff=0.01)
+    client.post({"epoch": 0})
+    assert client.counters == {"sent": 0, "dropped": 0, "failed": 1}
+
+
+def test_client_coalesce(supervisor):
+    url, requests, statuses = supervisor
+    client = SchedHintsClient(url, "ns/job")
+    # Hints posted while sending are coalesced into the latest one.
+    client._sending = True
+    client.post({"epoch": 0})
+    client.post({"epoch": 1})
+    assert requests == []
+    client._sending = False
+    client.post({"epoch": 2})
+    assert requests == [("/hints/ns/job", {"epoch": 2})]
+    assert client.counters == {"sent": 1, "dropped": 2, "failed": 0}
@@ -24,6 +24,7 @@ if "darwin" in sys.platform.lower():
 import logging
 import portpicker
 import requests
+import time
 import torch.distributed
 import pkg_resources
 
@@ -31,13 +32,17 @@ import adaptdl.collective
 import adaptdl.env
 import semver
 from .epoch import current_epoch, finished_epochs, remaining_epochs_until
-from .data import current_dataloader, AdaptiveDataLoader, ElasticSampler
+from .data import (current_dataloader, AdaptiveDataLoader,
+                   AdaptiveBucketDataLoader, AdaptiveShardedDataLoader,
+                   ElasticSampler)
 from .parallel import AdaptiveDataParallel
 from .accumulator import Accumulator
+from .cache import CachedDataset
+from ._metrics import profile_restart_phase
+from ._exporter import start_server as _start_metrics_server
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 def version_check(version):
@@ -95,12 +100,14 @@ def init_process_group(backend,
     elif url:
         key = adaptdl.env.job_id()
         group = adaptdl.env.num_restarts()
+        start = time.time()
         while True:
             response = requests.get(url=f"{url}/discover/{key}/{group}")
             if response.status_code != 408:  # Timeout.
                 break
         response.raise_for_status()
         master_addr = response.json()[0]
+        profile_restart_phase("discover", start)
         sched_version = adaptdl.env.adaptdl_sched_version()
         trainer_version = pkg_resources.get_distribution("adaptdl").version
         if version_check(sched_version) and version_check(trainer_version):
@@ -114,20 +121,27 @@ def init_process_group(backend,
         master_addr = adaptdl.env.master_addr()
 
     # Initialize collective module.
+    start = time.time()
     adaptdl.collective.initialize(master_addr,
                                   master_port,
                                   rank,
                                   world_size)
+    profile_restart_phase("collective_init", start)
 
     # Initialize torch.distributed.
+    start = time.time()
     torch_port = adaptdl.collective.broadcast(portpicker.pick_unused_port())
     init_method = "tcp://{}:{}?rank={}&world_size={}".format(
             master_addr, torch_port, rank, world_size)
     LOG.info("Initializing torch.distributed using %s", init_method)
     torch.distributed.init_process_group(backend, init_method)
+    profile_restart_phase("torch_init", start)
 
     LOG.info("torch.distributed initialized")
 
+    if adaptdl.env.metrics_port():
+        _start_metrics_server(adaptdl.env.metrics_port())
+
 
 __all__ = [
     "init_process_group",
@@ -136,7 +150,10 @@ __all__ = [
     "remaining_epochs_until",
     "current_dataloader",
     "AdaptiveDataLoader",
+    "AdaptiveBucketDataLoader",
+    "AdaptiveShardedDataLoader",
     "ElasticSampler",
     "AdaptiveDataParallel",
     "Accumulator",
+    "CachedDataset",
 ]
@@ -0,0 +1,162 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import adaptdl.env
+from adaptdl.torch import _metrics
+from adaptdl.torch.data import AdaptiveDataLoaderHelper
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(adaptdl.env.log_level())
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Name, type, and help text of each exported metric. Every sample is labeled
+# only with the job and replica rank, to keep the label cardinality bounded.
+# The job label should be kept when scraping (honor_labels in Prometheus).
+_METRICS = [
+    ("adaptdl_steps_total", "counter",
+     "Number of training steps profiled by this replica since it started."),
+    ("adaptdl_step_seconds_total", "counter",
+     "Total duration of the profiled training steps."),
+    ("adaptdl_sync_seconds_total", "counter",
+     "Total time spent synchronizing gradients between replicas."),
+    ("adaptdl_data_wait_seconds_total", "counter",
+     "Total time spent waiting for input data."),
+    ("adaptdl_goodput", "gauge",
+     "Predicted goodput of the current configuration, in samples/sec."),
+    ("adaptdl_gain", "gauge",
+     "Predicted statistical gain of the current batch size."),
+    ("adaptdl_batch_size", "gauge",
+     "Current total batch size across all replicas."),
+    ("adaptdl_local_batch_size", "gauge",
+     "Current local batch size of each replica."),
+    ("adaptdl_accumulation_steps", "gauge",
+     "Current number of gradient accumulation steps."),
+    ("adaptdl_progress", "gauge",
+     "Training progress in scale-invariant iterations."),
+    ("adaptdl_replicas", "gauge",
+     "Current number of replicas of the job."),
+]
+
+
+def _collect():
+    # Returns the current value of each metric, or None if it is unknown.
+    values = {
+        "adaptdl_steps_total": _metrics._STEP_TOTALS["steps"],
+        "adaptdl_step_seconds_total": _metrics._STEP_TOTALS["step_time"],
+        "adaptdl_sync_seconds_total": _metrics._STEP_TOTALS["sync_time"],
+        "adaptdl_data_wait_seconds_total":
+            _metrics._STEP_TOTALS["data_wait_time"],
+        "adaptdl_replicas": adaptdl.env.num_replicas(),
+    }
+    # Never create the metrics state from the server thread, since it may be
+    # loaded from a checkpoint. It exists once the first step was profiled.
+    state = _metrics._METRICS_STATE
+    dataloader = AdaptiveDataLoaderHelper._training
+    if state is None or dataloader is None or \
+            dataloader.current_local_bsz is None:
+        return values
+    values["adaptdl_progress"] = state.progress
+    atomic_bsz = dataloader.current_local_bsz
+    accum_steps = dataloader.accumulation_steps
+    batch_size = dataloader.current_batch_size
+    values["adaptdl_batch_size"] = batch_size
+    values["adaptdl_local_batch_size"] = dataloader.local_bsz
+    values["adaptdl_accumulation_steps"] = accum_steps
+    goodput_fn = _metrics.get_goodput_fn()
+    init_batch_size = state.init_batch_size
+    if goodput_fn is not None and batch_size >= init_batch_size:
+        values["adaptdl_goodput"] = goodput_fn(
+            adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
+            atomic_bsz, accum_steps)
+        values["adaptdl_gain"] = (goodput_fn.efficiency(batch_size) *
+                                  batch_size / init_batch_size)
+    return values
+
+
+def render():
+    """
+    Renders the current metrics of this replica in the Prometheus text format.
+
+    Returns:
+        str: The rendered metrics.
+    """
+    labels = '{{job="{}",replica="{}"}}'.format(
+        _escape(adaptdl.env.job_id() or ""), adaptdl.env.replica_rank())
+    values = _collect()
+    lines = []
+    for name, metric_type, help_text in _METRICS:
+        value = values.get(name)
+        if value is None:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        lines.append("{}{} {}".format(name, labels, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return (value.replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render().encode()
+        except Exception:
+            LOG.exception("failed to render metrics")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Don't log every scrape.
+
+
+def start_server(port):
+    """
+    Serves the metrics of this replica at ``/metrics`` in a background thread.
+    Scrapes only read values which are already tracked by the trainer, so the
+    training loop is never blocked by them.
+
+    Arguments:
+        port (int): Port to listen on, or 0 to pick any free port.
+
+    Returns:
+        HTTPServer: The running server, or ``None`` if it failed to start.
+    """
+    try:
+        server = HTTPServer(("", port), _Handler)
+    except OSError as exc:
+        LOG.warning("Failed to serve metrics on port %s: %s", port, exc)
+        return None
+    thread = threading.Thread(target=server.serve_forever,
+                              name="adaptdl-exporter", daemon=True)
+    thread.start()
+    LOG.info("Serving metrics on port %s", server.server_address[1])
+    return server
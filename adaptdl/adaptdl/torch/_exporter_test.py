@@ -0,0 +1,79 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from adaptdl.conftest import elastic_multiprocessing
+
+
+def _parse(text):
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+@elastic_multiprocessing
+def test_metrics_endpoint():
+    import os
+    import requests
+    from adaptdl.torch._exporter import start_server
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_sync_time, profile_step_commit)
+    os.environ["ADAPTDL_JOB_ID"] = "test/job"
+    server = start_server(0)
+    url = "http://localhost:{}".format(server.server_address[1])
+    labels = '{job="test/job",replica="0"}'
+    response = requests.get(url + "/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    samples = _parse(response.text)
+    assert samples["adaptdl_steps_total" + labels] == 0.0
+    assert samples["adaptdl_replicas" + labels] == 1.0
+    # Batch sizes are unknown without a training dataloader.
+    assert "adaptdl_batch_size" + labels not in samples
+    profile_step_start(4, data_wait_time=0.5)
+    profile_sync_time(1.0)
+    profile_step_commit(0)
+    samples = _parse(requests.get(url + "/metrics").text)
+    assert samples["adaptdl_steps_total" + labels] == 1.0
+    assert samples["adaptdl_sync_seconds_total" + labels] == 1.0
+    assert samples["adaptdl_data_wait_seconds_total" + labels] == 0.5
+    assert samples["adaptdl_step_seconds_total" + labels] > 0.0
+    assert requests.get(url + "/other").status_code == 404
+    server.shutdown()
+    return 0
+
+
+@elastic_multiprocessing
+def test_metrics_dataloader():
+    from torch.utils.data import TensorDataset
+    import torch
+    import adaptdl.collective
+    from adaptdl.torch.data import AdaptiveDataLoader
+    from adaptdl.torch._exporter import render
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.rand(64, 2))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=8)
+    dataloader._elastic.train()  # Normally done by AdaptiveDataParallel.
+    for _ in dataloader:
+        samples = _parse(render())
+        break
+    labels = '{job="tmpjob",replica="0"}'  # Set by elastic_multiprocessing.
+    assert samples["adaptdl_batch_size" + labels] == 8.0
+    assert samples["adaptdl_local_batch_size" + labels] == 8.0
+    assert samples["adaptdl_accumulation_steps" + labels] == 0.0
+    assert samples["adaptdl_progress" + labels] == 0.0
+    return 0
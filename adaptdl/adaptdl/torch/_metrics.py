@@ -13,31 +13,90 @@
 # limitations under the License.
 
 
-import collections
+import logging
 import pickle
+import threading
 import time
-import json
 
 import numpy as np
 
 import adaptdl.checkpoint
 import adaptdl.collective
 import adaptdl.env
+import adaptdl.metrics_sink
 from adaptdl.goodput import GoodputFunction, fit_perf_params
 from adaptdl.sched_hints import SCHED_HINTS, PERF_PARAMS, post_sched_hints
-
-
-def profile_step_start(atomic_bsz):
+from adaptdl._signal import get_signal_time
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(adaptdl.env.log_level())
+
+
+# A configuration is considered input-bound if at least this fraction of its
+# training time is spent waiting for the input pipeline.
+_INPUT_BOUND_FRACTION = 0.2
+
+
+# Decay factor applied to the local compute time and samples after each step,
+# so the measured throughput follows changes in the speed of this replica.
+_LOCAL_DECAY = 0.99
+# Decayed sums of the compute time and samples of this replica only. Not
+# checkpointed, since replicas may be placed differently after restarting.
+_LOCAL_COMPUTE = {"time": 0.0, "samples": 0.0}
+# Cumulative number and durations of the steps profiled by this process, which
+# are exported as counters by the metrics endpoint (see _exporter.py).
+_STEP_TOTALS = {"steps": 0, "step_time": 0.0, "sync_time": 0.0,
+                "data_wait_time": 0.0}
+# Time spent on per-step bookkeeping outside of the dataloader, e.g. updating
+# the gradient noise scale, since it was last taken by the dataloader. Used to
+# stay within the overhead budget (see adaptdl.env.overhead_budget).
+_OVERHEAD = {"time": 0.0}
+
+# Per-replica timings are gathered from all replicas once every this many
+# optimizer steps, to detect nodes which are slower than the others.
+_STRAGGLER_STEPS = 100
+# A node is considered slow if its compute throughput is below this fraction
+# of the median throughput of all nodes used by the job.
+_STRAGGLER_FRACTION = 0.8
+# Number of consecutive gathers a node must be slow in before it is reported
+# to the scheduler, so that transient slowdowns are ignored.
+_STRAGGLER_PERSISTENCE = 3
+# Seconds a node stays reported as slow after it was last detected, so it can
+# be tried again later in case the cause of its slowness went away.
+_SLOW_NODE_TTL = 3600.0
+# Number of optimizer steps, pending gather, step totals at the last gather,
+# and number of consecutive gathers each node was slow in.
+_STRAGGLERS = {"steps": 0, "future": None, "totals": None, "counts": {}}
+
+
+def profile_step_start(atomic_bsz, data_wait_time=0.0, local_bsz=None):
+    # The step time is measured from now until the step is committed. The time
+    # spent blocked on the data iterator before this step is profiled
+    # separately so it is not mistaken for compute time. The local batch size
+    # of this replica may differ from atomic_bsz, which is the average across
+    # all replicas.
     state = _metrics_state()
     state.atomic_bsz = atomic_bsz
+    state.local_bsz = atomic_bsz if local_bsz is None else local_bsz
     state.step_start = time.time()
     state.sync_time = 0.0
+    state.data_wait_time = data_wait_time
 
 
 def profile_sync_time(sync_time):
     _metrics_state().sync_time += sync_time
 
 
+def profile_overhead(overhead_time):
+    _OVERHEAD["time"] += overhead_time
+
+
+def take_overhead():
+    # Returns and resets the overhead time profiled since the last call.
+    overhead_time, _OVERHEAD["time"] = _OVERHEAD["time"], 0.0
+    return overhead_time
+
+
 _PREV_REPORT = None
 
 
@@ -49,24 +108,144 @@ def profile_step_commit(epoch, accumulation_step=False):
     num_replicas = adaptdl.env.num_replicas()
     key = (num_nodes, num_replicas, state.atomic_bsz)
     if accumulation_step:
-        state.profile[key]["accum_step_time"] += step_time
-        state.profile[key]["accum_count"] += 1
+        state.profile.add(key, accum_step_time=step_time, accum_count=1,
+                          data_wait_time=state.data_wait_time)
     else:
-        state.profile[key]["optim_step_time"] += step_time
-        state.profile[key]["optim_sync_time"] += state.sync_time
-        state.profile[key]["optim_count"] += 1
+        state.profile.add(key, optim_step_time=step_time,
+                          optim_sync_time=state.sync_time, optim_count=1,
+                          data_wait_time=state.data_wait_time)
+    _LOCAL_COMPUTE["time"] = (_LOCAL_DECAY * _LOCAL_COMPUTE["time"] +
+                              step_time - state.sync_time)
+    _LOCAL_COMPUTE["samples"] = (_LOCAL_DECAY * _LOCAL_COMPUTE["samples"] +
+                                 state.local_bsz)
+    _STEP_TOTALS["steps"] += 1
+    _STEP_TOTALS["step_time"] += step_time
+    _STEP_TOTALS["sync_time"] += state.sync_time
+    _STEP_TOTALS["data_wait_time"] += state.data_wait_time
     del state.atomic_bsz
+    del state.local_bsz
     del state.step_start
     del state.sync_time
+    del state.data_wait_time
     if not accumulation_step:
+        _check_stragglers()
         if _PREV_REPORT is None:
             _PREV_REPORT = time.time()
         if adaptdl.env.replica_rank() == 0 and time.time() - _PREV_REPORT > 5:
-            _fit_perf_params()
             _report_sched_hints(epoch)
             _PREV_REPORT = time.time()
 
 
+def profiled_atomic_bszs(num_nodes, num_replicas):
+    # Sorted atomic batch sizes which were profiled using the given number of
+    # nodes and replicas.
+    profile = _metrics_state().profile
+    mask = np.all(profile.configs[:, :2] == (num_nodes, num_replicas), axis=1)
+    return sorted(set(profile.configs[mask, 2].tolist()))
+
+
+def local_throughput():
+    # Samples per second of compute on this replica, excluding time spent
+    # synchronizing gradients with other replicas, or None if not profiled.
+    if _LOCAL_COMPUTE["time"] <= 0.0:
+        return None
+    return _LOCAL_COMPUTE["samples"] / _LOCAL_COMPUTE["time"]
+
+
+def _check_stragglers():
+    # Invoked after each optimizer step on all replicas, which start gathering
+    # their timings since the last gather every _STRAGGLER_STEPS steps. The
+    # gather is asynchronous, and its result is only used at the next gather.
+    if adaptdl.env.num_nodes() < 2:
+        return  # No other nodes to compare with.
+    _STRAGGLERS["steps"] += 1
+    if _STRAGGLERS["steps"] % _STRAGGLER_STEPS != 0:
+        return
+    if _STRAGGLERS["future"] is not None:
+        _update_slow_nodes(_STRAGGLERS["future"].result())
+    prev = _STRAGGLERS["totals"] or dict.fromkeys(_STEP_TOTALS, 0)
+    steps = max(_STEP_TOTALS["steps"] - prev["steps"], 1)
+    step_time = (_STEP_TOTALS["step_time"] - prev["step_time"]) / steps
+    sync_time = (_STEP_TOTALS["sync_time"] - prev["sync_time"]) / steps
+    timings = {
+        "node": adaptdl.env.node_name(),
+        "step_time": step_time,
+        "compute_time": step_time - sync_time,
+        "throughput": local_throughput(),
+    }
+    _STRAGGLERS["totals"] = dict(_STEP_TOTALS)
+    # Lists are concatenated by the default reduce_fn.
+    _STRAGGLERS["future"] = adaptdl.collective.allreduce_async([timings])
+
+
+def _update_slow_nodes(timings):
+    # Compares the compute throughputs of all nodes, which excludes the time
+    # spent waiting on other replicas and accounts for heterogeneous local
+    # batch sizes. Nodes which were slow in enough consecutive gathers are
+    # added to the slow nodes reported to the scheduler.
+    throughputs = {}
+    for replica_timings in timings:
+        if replica_timings["throughput"] is not None:
+            throughputs.setdefault(replica_timings["node"], []).append(
+                replica_timings["throughput"])
+    if len(throughputs) < 2:
+        return
+    throughputs = {node: min(vals) for node, vals in throughputs.items()}
+    median = np.median(list(throughputs.values()))
+    counts = _STRAGGLERS["counts"]
+    for node, throughput in throughputs.items():
+        if throughput < _STRAGGLER_FRACTION * median:
+            counts[node] = counts.get(node, 0) + 1
+        else:
+            counts.pop(node, None)
+    state = _metrics_state()
+    for node in [node for node in counts
+                 if counts[node] >= _STRAGGLER_PERSISTENCE]:
+        if node not in state.slow_nodes:
+            LOG.warning("Node %s is slow, %.1f samples/sec vs. median %.1f: "
+                        "%s", node, throughputs[node], median, timings)
+        state.slow_nodes[node] = time.time()
+    for node, detected in list(state.slow_nodes.items()):
+        if time.time() - detected > _SLOW_NODE_TTL:
+            del state.slow_nodes[node]
+
+
+# Time when the last restart phase in this process ended, or None after the
+# first step since (re)starting has been profiled.
+_RESTART_MARK = None
+
+
+def profile_restart_phase(phase, start):
+    # Record the duration of a restart phase which started at the given time
+    # and ends now. Each phase keeps its duration from the latest restart.
+    global _RESTART_MARK
+    _RESTART_MARK = time.time()
+    _metrics_state().restart_times[phase] = _RESTART_MARK - start
+
+
+def profile_restart_signal():
+    # Record the time between receiving an exit signal and the step boundary
+    # at which the checkpoint is saved.
+    signal_time = get_signal_time()
+    if signal_time is not None:
+        profile_restart_phase("signal", signal_time)
+
+
+def profile_first_step():
+    # Record the time taken to load states and to finish the first training
+    # step after initialization, if not already recorded in this process.
+    global _RESTART_MARK
+    if _RESTART_MARK is None:
+        return
+    state = _metrics_state()
+    load_time = sum(stats.get("load_time", 0.0) for stats in
+                    adaptdl.checkpoint.state_stats().values())
+    state.restart_times["load_state"] = load_time
+    state.restart_times["first_step"] = max(
+        time.time() - _RESTART_MARK - load_time, 0.0)
+    _RESTART_MARK = None
+
+
 _GRAD_PARAM_DICT = {}
 
 
@@ -104,19 +283,21 @@ def get_goodput_fn():
 
 def _fit_perf_params():
     state = _metrics_state()
-    profile = {k: v for k, v in state.profile.items() if v.get("optim_count")}
-    # Convert profile into numpy arrays.
-    num_nodes, num_replicas, atomic_bsz = (
-        np.array(k) for k in zip(*profile.keys()))
-    accum_step_time = np.array([v.get("accum_step_time", 0.0)
-                                for v in profile.values()])
-    accum_count = np.array([v.get("accum_count", 0) for v in profile.values()])
-    optim_step_time = np.array([v.get("optim_step_time", 0.0)
-                                for v in profile.values()])
-    optim_sync_time = np.array([v.get("optim_sync_time", 0.0)
-                                for v in profile.values()])
-    optim_count = np.array([v.get("optim_count", 0) for v in profile.values()])
-    assert np.all(optim_count > 0)
+    state.perf_params = _fit_profile(state.profile)
+
+
+def _fit_profile(profile):
+    # Only compute and sync times are fitted. Time spent waiting for input data
+    # does not shrink with more replicas in the same way, and is reported to
+    # the scheduler separately (see _input_bound).
+    mask = profile.column("optim_count") > 0
+    num_nodes, num_replicas, atomic_bsz = profile.configs[mask].T
+    # Fancy indexing copies, so the profile itself is not modified below.
+    accum_step_time = profile.column("accum_step_time")[mask]
+    accum_count = profile.column("accum_count")[mask]
+    optim_step_time = profile.column("optim_step_time")[mask]
+    optim_sync_time = profile.column("optim_sync_time")[mask]
+    optim_count = profile.column("optim_count")[mask]
     # Non-sync time during optimization steps should be approximately equal to
     # accumulation step time, combine those data points.
     assert np.all(optim_step_time >= optim_sync_time)
@@ -124,8 +305,24 @@ def _fit_perf_params():
     accum_count += optim_count
     accum_step_time /= accum_count
     optim_step_time /= optim_count
-    state.perf_params = fit_perf_params(num_nodes, num_replicas, atomic_bsz,
-                                        accum_step_time, optim_step_time)
+    return fit_perf_params(num_nodes, num_replicas, atomic_bsz,
+                           accum_step_time, optim_step_time)
+
+
+def _input_bound():
+    # Whether the current configuration spends a large fraction of its time
+    # waiting for input data. Only reported in the job status, and not used
+    # by the scheduler, since each replica runs its own input pipeline.
+    profile = _metrics_state().profile
+    mask = np.all(profile.configs[:, :2] == (adaptdl.env.num_nodes(),
+                                             adaptdl.env.num_replicas()),
+                  axis=1)
+    wait_time = profile.column("data_wait_time")[mask].sum()
+    step_time = (profile.column("accum_step_time")[mask].sum() +
+                 profile.column("optim_step_time")[mask].sum())
+    if wait_time + step_time <= 0.0:
+        return False
+    return wait_time / (wait_time + step_time) >= _INPUT_BOUND_FRACTION
 
 
 def _get_sched_hints():
@@ -137,13 +334,14 @@ def _get_sched_hints():
 
 
 def _report_sched_hints(epoch):
+    # Submits a snapshot of the profile and scheduling hints to the metrics
+    # worker, which fits the perf params and posts the hints without blocking
+    # the training loop. The perfParams hint is filled in by the worker.
     assert adaptdl.env.replica_rank() == 0
     state = _metrics_state()
+    profile = state.profile.copy()
     # Scheduling hints
     sched_hints = SCHED_HINTS.copy()
-    sched_hints["perfParams"] = {k: v for (k, v) in
-                                 zip(PERF_PARAMS.keys(),
-                                 state.perf_params)}
     sched_hints["maxBatchSize"] = state.max_batch_size
     sched_hints["localBszBounds"] = state.local_bsz_bounds
     sched_hints["initBatchSize"] = state.init_batch_size
@@ -151,16 +349,190 @@ def _report_sched_hints(epoch):
         sched_hints["gradParams"] = {}
         sched_hints["gradParams"]["norm"] = state.grad_params[0]
         sched_hints["gradParams"]["var"] = state.grad_params[1]
-    sched_hints["maxProfiledReplicas"] = max(key[1] for key in state.profile)
+    sched_hints["maxProfiledReplicas"] = int(state.profile.configs[:, 1].max())
     sched_hints["epoch"] = epoch
     sched_hints["gradientAccumulation"] = state.gradient_accumulation
-    post_sched_hints(sched_hints, adaptdl.env.job_id())
+    sched_hints["restartTimes"] = dict(state.restart_times) or None
+    sched_hints["inputBound"] = _input_bound()
+    sched_hints["slowNodes"] = sorted(
+        node for node, detected in state.slow_nodes.items()
+        if time.time() - detected <= _SLOW_NODE_TTL) or None
+    _metrics_worker().submit(profile, sched_hints)
+
+
+class _MetricsWorker(threading.Thread):
+    # Background thread which fits the perf params and posts scheduling hints.
+    # Only the latest submitted snapshot is processed, older pending ones are
+    # replaced. New perf params are published by a single attribute
+    # assignment, so get_goodput_fn never observes a partial update.
+
+    def __init__(self):
+        super().__init__(name="adaptdl-metrics", daemon=True)
+        self._cond = threading.Condition()
+        self._pending = None
+        self.processed = 0  # Number of snapshots processed so far.
+
+    def submit(self, profile, sched_hints):
+        with self._cond:
+            self._pending = (profile, sched_hints)
+            self._cond.notify()
+
+    def wait(self, count):
+        # Wait until at least count snapshots have been processed.
+        with self._cond:
+            self._cond.wait_for(lambda: self.processed >= count)
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                profile, sched_hints = self._pending
+                self._pending = None
+            try:
+                perf_params = _fit_profile(profile)
+                _metrics_state().perf_params = perf_params
+                sched_hints["perfParams"] = dict(zip(PERF_PARAMS.keys(),
+                                                     perf_params))
+                post_sched_hints(sched_hints, adaptdl.env.job_id())
+            except Exception:
+                LOG.exception("failed to fit perf params or report hints")
+            with self._cond:
+                self.processed += 1
+                self._cond.notify_all()
+
+
+_METRICS_WORKER = None
+
+
+def _metrics_worker():
+    global _METRICS_WORKER
+    if _METRICS_WORKER is None:
+        _METRICS_WORKER = _MetricsWorker()
+        _METRICS_WORKER.start()
+    return _METRICS_WORKER
+
+
+# Maximum number of configurations kept in the profile.
+_PROFILE_MAX_CONFIGS = 64
+# Decay applied to the profile of a configuration each time it is updated, so
+# that recent measurements dominate its average step times.
+_PROFILE_DECAY = 0.995
+
+
+class _ProfileStore(object):
+    # Profiled step times, as exponentially decayed sums of each field in
+    # FIELDS for each configuration (num_nodes, num_replicas, atomic_bsz).
+    # Decaying a whole row keeps the ratios between its sums, e.g. the average
+    # step time, but weights them towards recent steps. Configurations are
+    # stored as rows of NumPy arrays, which can be used directly for fitting.
+    # At most max_configs are kept, evicting the least recently updated.
+    # Supports read access like a dict of dicts, e.g. profile[key][field].
+
+    FIELDS = ("accum_step_time", "accum_count", "optim_step_time",
+              "optim_sync_time", "optim_count", "data_wait_time")
+    _COLUMNS = {name: idx for idx, name in enumerate(FIELDS)}
+
+    def __init__(self, max_configs=_PROFILE_MAX_CONFIGS,
+                 decay=_PROFILE_DECAY):
+        self.max_configs = max_configs
+        self.decay = decay
+        self.configs = np.zeros((0, 3), dtype=np.int64)
+        self.sums = np.zeros((0, len(self.FIELDS)))
+        self._updated = np.zeros(0, dtype=np.int64)  # Clock at last update.
+        self._clock = 0
+        self._rows = {}  # Configuration -> row index.
+
+    @classmethod
+    def from_dict(cls, profile):
+        store = cls()
+        for key, val in profile.items():
+            row = store._row(key)
+            for name, value in val.items():
+                if name in cls._COLUMNS:
+                    store.sums[row, cls._COLUMNS[name]] = value
+        return store
+
+    def _row(self, key):
+        key = tuple(int(k) for k in key)
+        if key in self._rows:
+            return self._rows[key]
+        if len(self._rows) < self.max_configs:
+            row = len(self._rows)
+            self.configs = np.concatenate([self.configs, [key]])
+            self.sums = np.concatenate(
+                [self.sums, np.zeros((1, len(self.FIELDS)))])
+            self._updated = np.append(self._updated, self._clock)
+        else:
+            row = int(np.argmin(self._updated))
+            del self._rows[tuple(self.configs[row])]
+            self.configs[row] = key
+            self.sums[row] = 0.0
+        self._rows[key] = row
+        return row
+
+    def add(self, key, **fields):
+        row = self._row(key)
+        self._clock += 1
+        self._updated[row] = self._clock
+        self.sums[row] *= self.decay
+        for name, value in fields.items():
+            self.sums[row, self._COLUMNS[name]] += value
+
+    def column(self, name):
+        return self.sums[:, self._COLUMNS[name]]
+
+    def copy(self):
+        store = _ProfileStore(self.max_configs, self.decay)
+        store.configs = self.configs.copy()
+        store.sums = self.sums.copy()
+        store._updated = self._updated.copy()
+        store._clock = self._clock
+        store._rows = dict(self._rows)
+        return store
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return tuple(key) in self._rows
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, key):
+        return _ProfileRow(self, self._row(key))
+
+    def keys(self):
+        return [tuple(config) for config in self.configs.tolist()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+class _ProfileRow(object):
+    # View of the sums of one configuration in a _ProfileStore.
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, name):
+        return float(self._store.sums[self._row, self._store._COLUMNS[name]])
+
+    def __setitem__(self, name, value):
+        self._store.sums[self._row, self._store._COLUMNS[name]] = value
+
+    def get(self, name, default=0.0):
+        return self[name] if name in self._store._COLUMNS else default
 
 
 class _MetricsState(adaptdl.checkpoint.State):
     def __init__(self):
         super().__init__("adaptdl-metrics")
-        self.profile = collections.defaultdict(collections.Counter)
+        self.profile = _ProfileStore()
         self.perf_params = None
         self.grad_params = None
         self.init_batch_size = None
@@ -168,6 +540,8 @@ class _MetricsState(adaptdl.checkpoint.State):
         self.local_bsz_bounds = None
         self.gradient_accumulation = False
         self.progress = 0.0  # Progress in scale-invariant iterations.
+        self.restart_times = {}  # Restart phase -> duration in seconds.
+        self.slow_nodes = {}  # Slow node -> time it was last detected.
 
     def save(self, fileobj):
         pickle.dump(self.profile, fileobj)
@@ -178,9 +552,14 @@ class _MetricsState(adaptdl.checkpoint.State):
         pickle.dump(self.local_bsz_bounds, fileobj)
         pickle.dump(self.gradient_accumulation, fileobj)
         pickle.dump(self.progress, fileobj)
+        pickle.dump(self.restart_times, fileobj)
+        pickle.dump(self.slow_nodes, fileobj)
 
     def load(self, fileobj):
         self.profile = pickle.load(fileobj)
+        if not isinstance(self.profile, _ProfileStore):
+            # Checkpoints from older versions store a dict of Counters.
+            self.profile = _ProfileStore.from_dict(self.profile)
         self.perf_params = pickle.load(fileobj)
         self.grad_params = pickle.load(fileobj)
         self.init_batch_size = pickle.load(fileobj)
@@ -188,39 +567,47 @@ class _MetricsState(adaptdl.checkpoint.State):
         self.local_bsz_bounds = pickle.load(fileobj)
         self.gradient_accumulation = pickle.load(fileobj)
         self.progress = pickle.load(fileobj)
+        self.restart_times = pickle.load(fileobj)
+        try:
+            self.slow_nodes = pickle.load(fileobj)
+        except EOFError:
+            pass  # Checkpoints from older versions have no slow nodes.
 
 
 def _metrics_state():
     global _METRICS_STATE
     if _METRICS_STATE is None:
-        _METRICS_STATE = _MetricsState()
-        adaptdl.checkpoint.load_state(_METRICS_STATE)
+        with adaptdl.checkpoint._global_scope():
+            _METRICS_STATE = _MetricsState()
+        if adaptdl.checkpoint.load_state(_METRICS_STATE):
+            manifest = adaptdl.checkpoint.load_manifest()
+            if manifest is not None:
+                _METRICS_STATE.restart_times["save"] = manifest["save_time"]
     return _METRICS_STATE
 
 def report_train_metrics(epoch, loss, **kwargs):
-    if adaptdl.env.replica_rank() > 0:
-        return
-    with open(adaptdl.env.checkpoint_path() + "/train.txt", "a") as f:
-        json.dump(dict(
-            time=time.time(),
-            progress=get_progress(),
-            epoch=epoch,
-            loss=loss,
-            **kwargs
-        ), f)
-        f.write("\n")
+    _report_metrics("train", epoch, loss, **kwargs)
 
 
 def report_valid_metrics(epoch, loss, **kwargs):
+    _report_metrics("valid", epoch, loss, **kwargs)
+
+
+def _report_metrics(name, epoch, loss, **kwargs):
+    # Records are buffered by the sink and written in batches, see
+    # adaptdl.metrics_sink.
     if adaptdl.env.replica_rank() > 0:
         return
-    with open(adaptdl.env.checkpoint_path() + "/valid.txt", "a") as f:
-        json.dump(dict(
-            time=time.time(),
-            progress=get_progress(),
-            epoch=epoch,
-            loss=loss,
-            **kwargs
-        ), f)
-        f.write("\n")
+    sink = adaptdl.metrics_sink.get_sink(name)
+    if sink is None:
+        return
+    sink.write(dict(
+        time=time.time(),
+        progress=get_progress(),
+        epoch=epoch,
+        loss=loss,
+        **kwargs
+    ))
+
+
 _METRICS_STATE = None
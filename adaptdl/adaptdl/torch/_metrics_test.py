@@ -25,7 +25,7 @@ def test_profile(num_replicas):
     from adaptdl.env import num_restarts
     from adaptdl.torch._metrics import (
             profile_step_start, profile_sync_time,
-            profile_step_commit, _metrics_state)
+            profile_step_commit, _metrics_state, _PROFILE_DECAY as decay)
     if num_restarts() == 0:
         profile = _metrics_state().profile
         assert len(profile) == 0
@@ -36,7 +36,7 @@ def test_profile(num_replicas):
         profile_step_start(2)
         profile_sync_time(1.0)
         profile_sync_time(2.0)
-        profile_step_commit()
+        profile_step_commit(0)
         # Ensure profile is updated correctly.
         profile = _metrics_state().profile
         key = (1, 1, 2)
@@ -61,19 +61,19 @@ def test_profile(num_replicas):
         profile_step_start(3)
         profile_sync_time(2.0)
         profile_sync_time(3.0)
-        profile_step_commit()
+        profile_step_commit(0)
         key = (1, num_replicas, 3)
         old_step_time = profile[key]["optim_step_time"]
         profile_step_start(3)
         profile_sync_time(3.0)
         profile_sync_time(4.0)
-        profile_step_commit()
+        profile_step_commit(0)
         # Ensure profile is updated correctly.
         assert len(profile) == 2
         assert profile[key]["accum_count"] == 0
-        assert profile[key]["optim_count"] == 2
-        assert profile[key]["optim_sync_time"] == 12.0
-        assert profile[key]["optim_step_time"] > old_step_time > 0.0
+        assert profile[key]["optim_count"] == pytest.approx(1 + decay)
+        assert profile[key]["optim_sync_time"] == pytest.approx(5 * decay + 7)
+        assert profile[key]["optim_step_time"] > old_step_time * decay > 0.0
 
 
 @pytest.mark.parametrize("num_replicas", [1, 2, 3, 4])
@@ -83,7 +83,8 @@ def test_profile_accumulation(num_replicas):
     from adaptdl.env import num_restarts
     from adaptdl.torch._metrics import (
             profile_step_start, profile_sync_time,
-            profile_step_commit, _metrics_state, _fit_perf_params)
+            profile_step_commit, _metrics_state, _fit_perf_params,
+            _PROFILE_DECAY as decay)
     if num_restarts() == 0:
         profile = _metrics_state().profile
         assert len(profile) == 0
@@ -92,32 +93,33 @@ def test_profile_accumulation(num_replicas):
         profile_sync_time(1.0)
         # Profile local_bsz=2 and commit.
         profile_step_start(2)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         profile_step_start(2)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         profile_step_start(2)
         profile_sync_time(4.0)
-        profile_step_commit(accumulation_step=False)
+        profile_step_commit(0, accumulation_step=False)
         profile_step_start(5)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         profile_step_start(5)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         profile_step_start(5)
         profile_sync_time(6.0)
-        profile_step_commit(accumulation_step=False)
+        profile_step_commit(0, accumulation_step=False)
         # Ensure profile is updated correctly.
         profile = _metrics_state().profile
         key = (1, 1, 2)
         assert len(profile) == 2
-        assert profile[key]["accum_count"] == 2
+        assert profile[key]["accum_count"] == \
+            pytest.approx((1 + decay) * decay)
         assert profile[key]["optim_count"] == 1
         assert profile[key]["optim_sync_time"] == 4.0
         assert profile[key]["accum_step_time"] > 0.0
         assert profile[key]["optim_step_time"] > 0.0
         profile_step_start(3)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         profile_step_start(3)
-        profile_step_commit(accumulation_step=True)
+        profile_step_commit(0, accumulation_step=True)
         # Check that fitting parameters works even
         # without a final accumulation_step=False commit
         for val in profile.values():
@@ -132,7 +134,8 @@ def test_profile_accumulation(num_replicas):
         # Ensure checkpoint is loaded correctly.
         key = (1, 1, 2)
         assert len(profile) == 3
-        assert profile[key]["accum_count"] == 2
+        assert profile[key]["accum_count"] == \
+            pytest.approx((1 + decay) * decay)
         assert profile[key]["optim_count"] == 1
         assert profile[key]["optim_sync_time"] == 4.0
         assert profile[key]["optim_step_time"] > 0.0
@@ -140,19 +143,154 @@ def test_profile_accumulation(num_replicas):
         profile_step_start(3)
         profile_sync_time(2.0)
         profile_sync_time(3.0)
-        profile_step_commit()
+        profile_step_commit(0)
         key = (1, num_replicas, 3)
         old_step_time = profile[key]["optim_step_time"]
         profile_step_start(3)
         profile_sync_time(3.0)
         profile_sync_time(4.0)
-        profile_step_commit()
+        profile_step_commit(0)
         # Ensure profile is updated correctly.
         if num_replicas == 1:
             assert len(profile) == 3
         else:
             assert len(profile) == 4
         assert profile[key]["accum_count"] == 0 if num_replicas > 1 else 2
-        assert profile[key]["optim_count"] == 2
-        assert profile[key]["optim_sync_time"] == 12.0
-        assert profile[key]["optim_step_time"] > old_step_time > 0.0
+        assert profile[key]["optim_count"] == pytest.approx(1 + decay)
+        assert profile[key]["optim_sync_time"] == pytest.approx(5 * decay + 7)
+        assert profile[key]["optim_step_time"] > old_step_time * decay > 0.0
+
+
+@elastic_multiprocessing
+def test_restart_times():
+    import time
+    import adaptdl._signal
+    import adaptdl.checkpoint
+    from adaptdl.env import num_restarts
+    from adaptdl.torch._metrics import (
+            profile_restart_phase, profile_restart_signal,
+            profile_first_step, _metrics_state)
+    if num_restarts() == 0:
+        adaptdl._signal.SIGNAL_TIME = time.time() - 1.0
+        profile_restart_signal()
+        adaptdl.checkpoint.save_all_states()
+        return 2
+    elif num_restarts() == 1:
+        restart_times = _metrics_state().restart_times
+        # Phases before the restart are loaded from the checkpoint.
+        assert restart_times["signal"] >= 1.0
+        assert restart_times["save"] >= 0.0
+        profile_restart_phase("torch_init", time.time() - 1.0)
+        assert restart_times["torch_init"] >= 1.0
+        profile_first_step()
+        assert restart_times["load_state"] >= 0.0
+        assert restart_times["first_step"] >= 0.0
+        # Only the first step after restarting is recorded.
+        restart_times["first_step"] = -1.0
+        profile_first_step()
+        assert restart_times["first_step"] == -1.0
+
+
+@elastic_multiprocessing
+def test_profile_data_wait():
+    import time
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_step_commit, _metrics_state,
+            _input_bound)
+    profile = _metrics_state().profile
+    assert not _input_bound()
+    # Compute-bound steps.
+    profile_step_start(2, data_wait_time=0.0)
+    time.sleep(0.1)
+    profile_step_commit(0)
+    key = (1, 1, 2)
+    assert profile[key]["data_wait_time"] == 0.0
+    assert not _input_bound()
+    # Waiting time is recorded separately from the step time.
+    step_time = profile[key]["optim_step_time"]
+    start = time.time()
+    profile_step_start(2, data_wait_time=1.0)
+    profile_step_commit(0)
+    assert profile[key]["data_wait_time"] == 1.0
+    assert profile[key]["optim_step_time"] - step_time <= time.time() - start
+    assert _input_bound()
+
+
+@elastic_multiprocessing
+def test_metrics_worker():
+    import time
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_step_commit, profile_sync_time,
+            _metrics_state, _metrics_worker, _report_sched_hints)
+    state = _metrics_state()
+    for atomic_bsz in (1, 2, 4):
+        profile_step_start(atomic_bsz)
+        time.sleep(0.01 * atomic_bsz)
+        profile_sync_time(0.001)
+        profile_step_commit(0)
+    assert state.perf_params is None
+    # Perf params are fitted in the background.
+    _report_sched_hints(0)
+    _metrics_worker().wait(1)
+    assert state.perf_params is not None
+    assert _metrics_worker().is_alive()
+
+
+@elastic_multiprocessing
+def test_stragglers():
+    import os
+    import time
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    import adaptdl.torch._metrics as metrics
+    from adaptdl.env import num_restarts, replica_rank
+    if num_restarts() == 0:
+        return 3
+    os.environ["ADAPTDL_NUM_NODES"] = "3"
+    os.environ["ADAPTDL_NODE_NAME"] = "node-{}".format(replica_rank())
+    state = metrics._metrics_state()
+    if num_restarts() == 1:
+        adaptdl.collective.initialize("0.0.0.0")
+        metrics._STRAGGLER_STEPS = 1
+        for step in range(metrics._STRAGGLER_PERSISTENCE + 2):
+            metrics.profile_step_start(1)
+            time.sleep(0.1 if replica_rank() == 2 else 0.01)
+            metrics.profile_step_commit(0)
+            if step < metrics._STRAGGLER_PERSISTENCE:
+                # Not slow for long enough yet.
+                assert not state.slow_nodes
+        assert list(state.slow_nodes) == ["node-2"]
+        adaptdl.checkpoint.save_all_states()
+        return 3
+    # Slow nodes are kept across restarts.
+    assert list(state.slow_nodes) == ["node-2"]
+    return 0
+
+
+def test_profile_store():
+    import collections
+    import pickle
+    from adaptdl.torch._metrics import _ProfileStore
+    store = _ProfileStore(max_configs=3, decay=0.5)
+    store.add((1, 1, 2), optim_step_time=2.0, optim_count=1)
+    store.add((1, 1, 2), optim_step_time=4.0, optim_count=1)
+    # Recent steps are weighted more, but the averages are still correct.
+    assert store[(1, 1, 2)]["optim_count"] == 1.5
+    assert store[(1, 1, 2)]["optim_step_time"] == 5.0
+    store.add((1, 2, 2), accum_step_time=1.0, accum_count=1)
+    store.add((1, 4, 2), accum_step_time=1.0, accum_count=1)
+    store.add((1, 1, 2), optim_step_time=2.0, optim_count=1)
+    # The least recently updated configuration is evicted.
+    store.add((1, 8, 2), accum_step_time=1.0, accum_count=1)
+    assert len(store) == 3
+    assert set(store) == {(1, 1, 2), (1, 4, 2), (1, 8, 2)}
+    assert store[(1, 8, 2)]["optim_count"] == 0.0
+    assert store.column("accum_count").tolist() == [0.0, 1.0, 1.0]
+    # Survives pickling, and converts from the older dict format.
+    store = pickle.loads(pickle.dumps(store))
+    assert store[(1, 4, 2)].get("accum_step_time") == 1.0
+    old = collections.defaultdict(collections.Counter)
+    old[(1, 2, 4)]["optim_count"] += 3
+    store = _ProfileStore.from_dict(old)
+    assert store.configs.tolist() == [[1, 2, 4]]
+    assert store[(1, 2, 4)]["optim_count"] == 3.0
@@ -0,0 +1,182 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import fcntl
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+from contextlib import contextmanager
+from torch.utils.data import Dataset
+
+import adaptdl.env
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(adaptdl.env.log_level())
+
+# Cached samples are only marked as recently used if they were last marked
+# more than this many seconds ago, to avoid a syscall for every cache hit.
+_TOUCH_INTERVAL = 10.0
+# Fraction of the size limit the cache is reduced to when evicting samples.
+_EVICT_FRACTION = 0.9
+# Temporary files older than this many seconds were left behind by processes
+# killed while writing a sample, and are removed when evicting samples.
+_TMP_MAX_AGE = 300.0
+
+
+class CachedDataset(Dataset):
+    """
+    This class is a map-style dataset which caches the samples of another
+    dataset on disk, so that expensive decoding and transformations are only
+    computed once per node, even across restarts. Samples are stored as
+    individual files, and the least recently used samples are evicted when the
+    cache grows beyond ``max_bytes``.
+
+    The cache may be read and written concurrently by all replicas and
+    dataloader workers on the same node. Random data augmentations should be
+    applied after the cache, since cached samples are returned as-is.
+
+    Arguments:
+        dataset (Dataset): The map-style dataset whose samples are cached.
+        name (str): Unique name of the cache. Datasets with the same name
+            share the same cache, so it should change whenever the samples of
+            the underlying dataset would change.
+        max_bytes (int): Maximum total size of the cached samples.
+        path (str): Directory to store the cache in. Defaults to the share
+            path of the job, or the system temporary directory if unset.
+
+    Raises:
+        ValueError: If ``max_bytes`` is not positive.
+    """
+    def __init__(self, dataset, name, max_bytes=2 ** 30, path=None):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        if path is None:
+            path = adaptdl.env.share_path() or tempfile.gettempdir()
+        self.path = os.path.join(path, "adaptdl-cache", name)
+        os.makedirs(self.path, exist_ok=True)
+        self._lock_path = os.path.join(self.path, ".lock")
+        self._usage_path = os.path.join(self.path, ".usage")
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        filename = self._filename(index)
+        sample = self._read(filename)
+        if sample is None:
+            sample = self.dataset[index]
+            self._write(filename, sample)
+        return sample
+
+    def _filename(self, index):
+        return os.path.join(self.path, "{}.pkl".format(index))
+
+    def _read(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                sample = pickle.loads(f.read())
+                mtime = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            return None  # Not cached, or evicted.
+        except Exception as exc:
+            LOG.warning("Ignoring unreadable cached sample %s: %s",
+                        filename, exc)
+            return None
+        if time.time() - mtime > _TOUCH_INTERVAL:
+            try:
+                os.utime(filename)  # Mark as recently used.
+            except FileNotFoundError:
+                pass
+        return sample
+
+    def _write(self, filename, sample):
+        data = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        # Write to a temporary file and rename it, so concurrent readers
+        # either see the whole sample or none of it.
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmpname, filename)
+        except OSError as exc:
+            LOG.warning("Failed to cache sample %s: %s", filename, exc)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        with self._lock():
+            usage = self._read_usage() + len(data)
+            if usage > self.max_bytes:
+                usage = self._evict(int(self.max_bytes * _EVICT_FRACTION))
+            self._write_usage(usage)
+
+    @contextmanager
+    def _lock(self):
+        # Exclusive lock across all processes using this cache.
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_usage(self):
+        try:
+            with open(self._usage_path) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_usage(self, usage):
+        with open(self._usage_path, "w") as f:
+            f.write(str(usage))
+
+    def _evict(self, target_bytes):
+        # Remove the least recently used samples until the total size is at
+        # most target_bytes, and return the actual total size. Sizes are
+        # re-scanned since concurrent writes may have been double-counted.
+        # Stale temporary files of interrupted writes are removed as well.
+        entries = []
+        now = time.time()
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith((".pkl", ".tmp")):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if entry.name.endswith(".tmp"):
+                        if now - stat.st_mtime > _TMP_MAX_AGE:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        usage = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if usage <= target_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            usage -= size
+        return usage
@@ -0,0 +1,112 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from adaptdl.conftest import elastic_multiprocessing
+from adaptdl.torch.cache import CachedDataset
+
+
+class _CountingDataset(torch.utils.data.Dataset):
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        self.count += 1
+        return torch.full((64,), index), np.arange(index)
+
+
+def test_cached_dataset(tmp_path):
+    dataset = _CountingDataset(10)
+    cached = CachedDataset(dataset, "test", path=str(tmp_path))
+    assert len(cached) == 10
+    for _ in range(2):
+        for index in range(10):
+            tensor, array = cached[index]
+            assert torch.all(tensor == index)
+            assert np.all(array == np.arange(index))
+    assert dataset.count == 10
+    # Another dataset with the same name reuses the cached samples.
+    other = CachedDataset(_CountingDataset(10), "test", path=str(tmp_path))
+    assert torch.all(other[3][0] == 3)
+    assert other.dataset.count == 0
+    # Corrupted samples are re-computed.
+    with open(cached._filename(3), "wb") as f:
+        f.write(b"corrupted")
+    assert torch.all(other[3][0] == 3)
+    assert other.dataset.count == 1
+    with pytest.raises(ValueError):
+        CachedDataset(dataset, "test", max_bytes=0, path=str(tmp_path))
+
+
+def test_cached_dataset_eviction(tmp_path):
+    dataset = _CountingDataset(100)
+    cached = CachedDataset(dataset, "test", path=str(tmp_path))
+    cached[0]
+    size = os.path.getsize(cached._filename(0))
+    cached = CachedDataset(dataset, "test", max_bytes=size * 10,
+                           path=str(tmp_path))
+    for index in range(1, 100):
+        os.utime(cached._filename(index - 1), (index, index))
+        cached[index]
+    files = [name for name in os.listdir(cached.path)
+             if name.endswith(".pkl")]
+    total = sum(os.path.getsize(os.path.join(cached.path, name))
+                for name in files)
+    assert total <= size * 10
+    # The most recently used samples are kept.
+    assert "99.pkl" in files and "0.pkl" not in files
+    assert cached._read_usage() == total
+
+
+def test_cached_dataset_stale_tmp(tmp_path):
+    dataset = _CountingDataset(10)
+    cached = CachedDataset(dataset, "test", max_bytes=1, path=str(tmp_path))
+    # Left behind by replicas killed while writing samples.
+    stale = os.path.join(cached.path, "stale.tmp")
+    recent = os.path.join(cached.path, "recent.tmp")
+    for filename in (stale, recent):
+        with open(filename, "wb") as f:
+            f.write(b"0" * 100)
+    os.utime(stale, (0, 0))
+    assert cached._evict(0) == 0
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)  # May still be written.
+
+
+@elastic_multiprocessing
+def test_cached_dataset_restarts():
+    from adaptdl.env import num_restarts, replica_rank
+    path = os.path.join(os.environ["ADAPTDL_CHECKPOINT_PATH"], "share")
+    dataset = _CountingDataset(20)
+    cached = CachedDataset(dataset, "test", path=path)
+    loader = torch.utils.data.DataLoader(cached, batch_size=4, num_workers=2,
+                                         collate_fn=list)
+    for batch in loader:
+        assert len(batch) == 4
+    if num_restarts() == 0:
+        return 3
+    # All samples were cached before restarting, by any replica or worker.
+    for index in range(replica_rank(), 20, 3):
+        assert torch.all(cached[index][0] == index)
+    assert dataset.count == 0
@@ -14,28 +14,51 @@
 
 
 from contextlib import contextmanager
+import bisect
 import collections
 import functools
+import itertools
 import logging
 import math
 import numpy as np
 import pickle
 import random
+import time
 import torch
 from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 
 import adaptdl.checkpoint
 import adaptdl.collective
 import adaptdl.env
+import adaptdl.trace
 from adaptdl.torch.epoch import current_epoch
 from adaptdl.torch._metrics import (
-    profile_step_start, profile_step_commit,
-    set_batch_size, get_goodput_fn, get_progress)
+    profile_step_start, profile_step_commit, profile_restart_signal,
+    profile_first_step, set_batch_size, get_goodput_fn, get_progress,
+    local_throughput, profiled_atomic_bszs, take_overhead)
 from adaptdl._signal import get_exit_flag
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
+
+# Number of timed steps per local batch size when probing evaluation batch
+# sizes, after one untimed warm-up step.
+_EVAL_PROBE_STEPS = 3
+# Fraction of GPU memory which evaluation batches are allowed to use.
+_EVAL_MEMORY_FRACTION = 0.9
+# Atomic batch sizes are no longer explored once this many different ones have
+# been profiled using the current number of nodes and replicas.
+_EXPLORE_MAX_BSZS = 3
+# Fraction of GPU memory which explored atomic batch sizes are allowed to use.
+_EXPLORE_MEMORY_FRACTION = 0.8
+# Maximum number of optimizer steps between the steps whose bookkeeping is done
+# when an overhead budget is set. Bounds the delay until replicas exit after
+# receiving an exit signal.
+_MAX_SAMPLE_INTERVAL = 100
+# Decay factor of the averaged step time and bookkeeping overhead used to
+# choose the interval between sampled steps.
+_OVERHEAD_DECAY = 0.9
 
 
 class ElasticSampler(Sampler):
@@ -59,6 +82,7 @@ class ElasticSampler(Sampler):
         self.rank = adaptdl.env.replica_rank()
         self.epoch = 0
         self.index = 0
+        self.local_bszs = None
 
     def __iter__(self):
         """
@@ -68,24 +92,29 @@ class ElasticSampler(Sampler):
 
         Returns: Iterator over data sample indices.
         """
+        size = len(self.dataset)
         if self.shuffle:
             # Deterministically shuffle based on epoch.
-            g = torch.Generator()
-            g.manual_seed(hash((self.epoch, self.index // len(self.dataset))))
-            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+            permutation = _FeistelPermutation(
+                size, hash((self.epoch, self.index // size)))
         else:
-            indices = list(range(len(self.dataset)))
+            permutation = None
 
-        base_index = self.index % len(self.dataset)
+        base_index = self.index % size
+
+        if self.local_bszs is not None:
+            return self._iter_blocks(permutation, base_index)
 
         # Subsample.
-        local_indices = indices[base_index + self.rank::self.num_replicas]
+        positions = range(base_index + self.rank, size, self.num_replicas)
 
         # Add extra samples to make it evenly divisible.
-        if len(local_indices) < len(self):
-            local_indices.append(indices[self.rank])
-        assert len(local_indices) == len(self)
-        return iter(local_indices)
+        extra = range(self.rank % size, self.rank % size + 1)
+        if len(positions) == len(self):
+            extra = extra[:0]
+        assert len(positions) + len(extra) == len(self)
+        return itertools.chain(_permuted(permutation, positions),
+                               _permuted(permutation, extra))
 
     def __len__(self):
         """
@@ -95,6 +124,10 @@ class ElasticSampler(Sampler):
         Returns (int): Number of samples.
         """
         base_index = self.index % len(self.dataset)
+        if self.local_bszs is not None:
+            total = sum(self.local_bszs)
+            return (math.ceil((len(self.dataset) - base_index) / total) *
+                    self.local_bszs[self.rank])
         return math.ceil((len(self.dataset) - base_index) / self.num_replicas)
 
     def set_epoch(self, epoch, index=0):
@@ -110,6 +143,135 @@ class ElasticSampler(Sampler):
         self.epoch = epoch
         self.index = index
 
+    def set_local_bszs(self, local_bszs):
+        """
+        Set the local batch size of each replica, to partition the samples
+        unevenly between replicas. Each consecutive block of
+        ``sum(local_bszs)`` samples is split into contiguous parts of the
+        given sizes, and the last block is padded so that every replica
+        produces the same number of full batches.
+
+        Arguments:
+            local_bszs (list): The local batch size of each replica, or
+                ``None`` to partition the samples evenly.
+        """
+        if local_bszs is not None and len(local_bszs) != self.num_replicas:
+            raise ValueError("expected {} local batch sizes, got {}"
+                             .format(self.num_replicas, len(local_bszs)))
+        self.local_bszs = None if local_bszs is None else list(local_bszs)
+
+    def _iter_blocks(self, permutation, base_index):
+        size = len(self.dataset)
+        total = sum(self.local_bszs)
+        offset = sum(self.local_bszs[:self.rank])
+        local_bsz = self.local_bszs[self.rank]
+        for block in range(math.ceil((size - base_index) / total)):
+            start = base_index + block * total + offset
+            stop = min(start + local_bsz, size)
+            yield from _permuted(permutation, range(start, stop))
+            if stop - start < local_bsz:
+                # Pad the last batch with samples from the start.
+                padding = [(offset + i) % size
+                           for i in range(local_bsz - max(stop - start, 0))]
+                if permutation is None:
+                    yield from padding
+                else:
+                    yield from permutation(padding).tolist()
+
+
+class _FeistelPermutation(object):
+    # A pseudo-random permutation of [0, size) which is evaluated lazily for
+    # any position, so it never has to be materialized in memory. Positions
+    # are encrypted with a balanced Feistel network over the smallest power of
+    # 4 which is at least size, and outputs beyond size are re-encrypted until
+    # they fall inside it (cycle walking), which preserves the bijection.
+
+    _MASK = 2 ** 64 - 1
+    _ROUNDS = 6
+
+    def __init__(self, size, seed):
+        self.size = size
+        half_bits = (max((size - 1).bit_length(), 1) + 1) // 2
+        self._half_bits = np.uint64(half_bits)
+        self._half_mask = np.uint64((1 << half_bits) - 1)
+        keys = []
+        state = seed & self._MASK
+        for _ in range(self._ROUNDS):
+            state = (state + 0x9E3779B97F4A7C15) & self._MASK
+            keys.append(self._mix(state))
+        self._keys = [np.uint64(key) for key in keys]
+
+    @classmethod
+    def _mix(cls, x):
+        # SplitMix64 finalizer, used to derive the round keys from the seed.
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & cls._MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & cls._MASK
+        return x ^ (x >> 31)
+
+    def _round(self, x, key):
+        x = (x ^ key) * np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(31)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(29)
+        return x & self._half_mask
+
+    def _encrypt(self, x):
+        left, right = x >> self._half_bits, x & self._half_mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self._half_bits) | right
+
+    def __call__(self, positions):
+        """
+        Arguments:
+            positions (np.ndarray): Positions in [0, size).
+
+        Returns (np.ndarray): The permuted indices at the given positions.
+        """
+        indices = self._encrypt(np.asarray(positions, dtype=np.uint64))
+        outside = indices >= self.size
+        while outside.any():
+            indices[outside] = self._encrypt(indices[outside])
+            outside = indices >= self.size
+        return indices.astype(np.int64)
+
+
+def _permuted(permutation, positions, chunk_size=4096):
+    # Yields permutation(position) for each position in a range, evaluated in
+    # vectorized chunks. The identity is used if permutation is None.
+    if permutation is None:
+        yield from positions
+        return
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        yield from permutation(
+            np.arange(chunk.start, chunk.stop, chunk.step)).tolist()
+
+
+def _split_batch_size(total, throughputs, min_local_bsz, max_local_bsz):
+    # Split total into local batch sizes proportional to throughputs, within
+    # the given bounds (max_local_bsz may be None). Returns None if the total
+    # cannot be split within the bounds.
+    if total < min_local_bsz * len(throughputs) or max_local_bsz is not None \
+            and total > max_local_bsz * len(throughputs):
+        return None
+    ideal = total * np.asarray(throughputs) / np.sum(throughputs)
+    local_bszs = np.floor(ideal).astype(int)
+    local_bszs = np.maximum(local_bszs, min_local_bsz)
+    if max_local_bsz is not None:
+        local_bszs = np.minimum(local_bszs, max_local_bsz)
+    # Give or take one sample at a time from the replicas furthest from their
+    # ideal local batch sizes, until the local batch sizes add up to total.
+    while local_bszs.sum() < total:
+        deficit = np.where(local_bszs < (max_local_bsz or total),
+                           ideal - local_bszs, -np.inf)
+        local_bszs[np.argmax(deficit)] += 1
+    while local_bszs.sum() > total:
+        excess = np.where(local_bszs > min_local_bsz,
+                          local_bszs - ideal, -np.inf)
+        local_bszs[np.argmax(excess)] -= 1
+    return local_bszs.tolist()
+
 
 def current_dataloader():
     """
@@ -151,6 +313,36 @@ class AdaptiveDataLoaderHelper(object):
         self._gradient_accumulation = False
         self._speedup_threshold = 1.05
         self._accum_count = 0
+        # Mid-loop batch size re-optimization.
+        self._reoptimize_steps = None
+        self._reoptimize_secs = None
+        self._reoptimize = False  # Whether all replicas agreed to re-optimize.
+        self._num_syncs = 0  # Number of times the local bsz was synced.
+        self._sync_steps = 0  # Optimizer steps since the last sync.
+        self._sync_time = time.time()  # Time of the last sync.
+        # Time spent waiting for input data since the last profiled step.
+        self._data_wait_time = 0.0
+        # Heterogeneous local batch sizes, only if supported by the loader.
+        self.supports_heterogeneous = False
+        self._heterogeneous = False
+        self._local_bszs = None  # Local batch size of each replica.
+        # Evaluation batch size probing, see autoscale_eval_batch_size.
+        self._eval_max_local_bsz = None
+        self._eval_local_bsz = None  # Chosen after probing is done.
+        self._eval_probe = None  # (local_bsz, throughput) probed previously.
+        self._probe_steps = 0
+        self._probe_start = None
+        # Exploration of unprofiled atomic batch sizes, see
+        # autoscale_batch_size.
+        self._explore_steps = None
+        self._explore_left = None  # Optimizer steps left while exploring.
+        # Sampling of per-step bookkeeping, see adaptdl.env.overhead_budget.
+        self._overhead_budget = adaptdl.env.overhead_budget()
+        self._sample_interval = 1  # Optimizer steps, agreed by all replicas.
+        self._steps_to_sample = 0  # Optimizer steps until the next sample.
+        self._sampled = True  # Whether the current step is sampled.
+        self._step_time_avg = None  # Averaged duration of each step.
+        self._overhead_avg = 0.0  # Averaged bookkeeping time of each sample.
 
     @property
     def current_index(self):
@@ -209,6 +401,24 @@ class AdaptiveDataLoaderHelper(object):
         """
         return self._state.current_local_bsz
 
+    @property
+    def local_bszs(self):
+        """
+        The local batch size of each replica if they are different, otherwise
+        ``None``. Their average is always equal to :attr:`current_local_bsz`.
+        """
+        return self._local_bszs
+
+    @property
+    def local_bsz(self):
+        """
+        The local batch size of this replica, which is different from
+        :attr:`current_local_bsz` if heterogeneous local batch sizes are used.
+        """
+        if self._local_bszs is None:
+            return self.current_local_bsz
+        return self._local_bszs[adaptdl.env.replica_rank()]
+
     @property
     def accumulation_steps(self):
         """
@@ -229,6 +439,17 @@ class AdaptiveDataLoaderHelper(object):
         """
         return not self.is_accum_step()
 
+    @property
+    def sampled(self):
+        """
+        Whether the per-step bookkeeping, e.g. profiling and gradient noise
+        scale estimation, is done in the current step. Always true, unless an
+        overhead budget is set (see :func:`adaptdl.env.overhead_budget`), in
+        which case only the optimizer steps sampled at an interval agreed upon
+        by all replicas are.
+        """
+        return self._sampled
+
     def train(self):
         """
         Set this data loader to be the one used for training. Only one data
@@ -240,7 +461,9 @@ class AdaptiveDataLoaderHelper(object):
                        self.local_bsz_bounds, self._gradient_accumulation)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False,
+                             reoptimize_steps=None, reoptimize_secs=None,
+                             heterogeneous=False, explore_steps=None):
         """
         Enables adaptive batch size. Should be invoked once after the data
         loader object is created.
@@ -249,9 +472,25 @@ class AdaptiveDataLoaderHelper(object):
             max_batch_size (int): Maximum total batch size allowed.
             local_bsz_bounds (tuple): A pair of (min_local_bsz, max_local_bsz),
                 the min and max local batch sizes allowed on each replica.
+            gradient_accumulation (bool): Whether gradient accumulation may
+                be used to reach larger batch sizes.
+            reoptimize_steps (int): If set, re-optimize the batch size in the
+                middle of a dataloader loop every this many optimizer steps.
+            reoptimize_secs (float): If set, re-optimize the batch size in the
+                middle of a dataloader loop every this many seconds.
+            heterogeneous (bool): Whether replicas may use different local
+                batch sizes, proportional to their measured throughput, so
+                faster replicas do not wait for slower ones. The total batch
+                size is unchanged, and gradients are averaged weighted by the
+                local batch sizes.
+            explore_steps (int): If set, occasionally run this many optimizer
+                steps using an atomic batch size which was not profiled with
+                the current allocation yet, so the performance model can be
+                fitted to more than one atomic batch size early on.
 
         Raises:
-            ValueError: If any of the provided batch size bounds are invalid.
+            ValueError: If any of the provided batch size bounds are invalid,
+                or if heterogeneous local batch sizes are not supported.
         """
         if not isinstance(max_batch_size, int) or \
                 max_batch_size < self.batch_size:
@@ -262,12 +501,110 @@ class AdaptiveDataLoaderHelper(object):
                 local_bsz_bounds[1] is not None and
                 local_bsz_bounds[1] < self.batch_size):
             raise ValueError("invalid local_bsz_bounds")
+        if heterogeneous and not self.supports_heterogeneous:
+            raise ValueError("heterogeneous local batch sizes are not "
+                             "supported by this dataloader")
+        if explore_steps is not None and explore_steps < 1:
+            raise ValueError("invalid explore_steps")
         self._max_batch_size = max_batch_size
         self._local_bsz_bounds = local_bsz_bounds
         self._gradient_accumulation = gradient_accumulation
+        self._reoptimize_steps = reoptimize_steps
+        self._reoptimize_secs = reoptimize_secs
+        self._heterogeneous = heterogeneous
+        self._explore_steps = explore_steps
         self.train()
 
+    def autoscale_eval_batch_size(self, max_local_bsz):
+        """
+        Enables automatic local batch sizes for a data loader which is only
+        used for evaluation. Since evaluation does not compute gradients, the
+        local batch size does not affect statistical efficiency, and the
+        largest local batch size which fits in memory and improves throughput
+        is used. It is found by probing increasing local batch sizes during
+        the first loop, starting from the local share of ``batch_size``.
+
+        Arguments:
+            max_local_bsz (int): Maximum local batch size on each replica.
+
+        Raises:
+            ValueError: If ``max_local_bsz`` is invalid, or if this data
+                loader is used for training.
+        """
+        if not isinstance(max_local_bsz, int) or max_local_bsz < 1:
+            raise ValueError("invalid max_local_bsz")
+        if self.training:
+            raise ValueError("evaluation batch size cannot be used for "
+                             "training")
+        self._eval_max_local_bsz = max_local_bsz
+
+    def _sync_eval_local_bsz(self):
+        # Use the probed evaluation batch size, or start or resume probing.
+        if self._eval_local_bsz is not None:
+            self._state.current_local_bsz = self._eval_local_bsz
+        elif self._eval_probe is None:
+            self._state.current_local_bsz = min(
+                math.ceil(self.batch_size / adaptdl.env.num_replicas()),
+                self._eval_max_local_bsz)
+        self._state.accumulation_steps = 0
+        self._probe_steps = 0
+        if torch.cuda.is_initialized():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _probe_eval_local_bsz(self):
+        """
+        Measure the throughput of the current evaluation batch size, and move
+        on to the next one if done. Must be invoked by every replica after
+        the same steps, e.g. after each step of a dataloader loop.
+
+        Returns:
+            bool: Whether the local batch size changed, in which case the loop
+            should continue from the current index.
+        """
+        if self._eval_max_local_bsz is None or self.training or \
+                self._eval_local_bsz is not None:
+            return False
+        self._probe_steps += 1
+        if self._probe_steps == 1:  # Warm-up step.
+            self._probe_start = time.time()
+            return False
+        if self._probe_steps <= _EVAL_PROBE_STEPS:
+            return False
+        local_bsz = self.current_local_bsz
+        throughput = (local_bsz * (self._probe_steps - 1) /
+                      max(time.time() - self._probe_start, 1e-8))
+        next_bsz = min(2 * local_bsz, self._eval_max_local_bsz)
+        fits = next_bsz > local_bsz
+        if torch.cuda.is_initialized():
+            # Memory usage is assumed to be at most linear in the batch size.
+            device = torch.cuda.current_device()
+            total = torch.cuda.get_device_properties(device).total_memory
+            peak = torch.cuda.max_memory_allocated() * next_bsz / local_bsz
+            fits = fits and peak <= _EVAL_MEMORY_FRACTION * total
+        # Every replica must agree on the same local batch size.
+        fits, throughput = adaptdl.collective.allreduce(
+            (fits, throughput),
+            lambda a, b: (a[0] and b[0], min(a[1], b[1])))
+        if self._eval_probe is not None and \
+                self._eval_probe[1] >= throughput:
+            # Larger batches stopped improving throughput.
+            self._eval_local_bsz = self._eval_probe[0]
+        elif not fits:
+            self._eval_local_bsz = local_bsz
+        else:
+            self._eval_probe = (local_bsz, throughput)
+            self._state.current_local_bsz = next_bsz
+        if self._eval_local_bsz is not None:
+            LOG.info("using evaluation local batch size %s",
+                     self._eval_local_bsz)
+        self._sync_eval_local_bsz()
+        return self.current_local_bsz != local_bsz
+
     def _sync_local_bsz(self):
+        if self._eval_max_local_bsz is not None and not self.training:
+            self._sync_eval_local_bsz()
+            return self.current_local_bsz
+        prev_local_bsz = self._state.current_local_bsz
         goodput_fn = get_goodput_fn()
         if self.max_batch_size is None or goodput_fn is None:
             # No autoscale batch size, just divide batch size evenly.
@@ -302,12 +639,148 @@ class AdaptiveDataLoaderHelper(object):
         self._state.current_local_bsz, self._state.accumulation_steps = \
             adaptdl.collective.broadcast((self._state.current_local_bsz,
                                           self._state.accumulation_steps))
+        self._local_bszs = None
+        explore = None
+        if self._explore_steps is not None:
+            # Don't explore again right after an exploration has ended.
+            if self._explore_left is None:
+                explore = self._explore_atomic_bsz(prev_local_bsz)
+            if torch.cuda.is_initialized():
+                torch.cuda.reset_peak_memory_stats()
+        self._explore_left = None
+        if explore is not None:
+            LOG.info("exploring atomic batch size %s for %s steps",
+                     explore[0], self._explore_steps)
+            self._state.current_local_bsz, self._state.accumulation_steps = \
+                explore
+            self._explore_left = self._explore_steps
+        elif self._heterogeneous and adaptdl.env.num_replicas() > 1:
+            self._local_bszs = self._balance_local_bszs()
+        self._num_syncs += 1
+        self._sync_steps = 0
+        self._sync_time = time.time()
         return self.current_local_bsz
 
+    def _explore_atomic_bsz(self, prev_local_bsz):
+        # Choose an atomic batch size which was not profiled using the current
+        # number of nodes and replicas, and is twice or half of one which was.
+        # Returns a pair of (atomic_bsz, accum_steps), or None if there is
+        # nothing to explore. The choice is broadcast from replica 0.
+        num_replicas = adaptdl.env.num_replicas()
+        min_bsz, max_bsz = self._local_bsz_bounds or (None, None)
+        min_bsz = min_bsz or 1
+        max_bsz = min(max_bsz or self.max_batch_size,
+                      self.max_batch_size // num_replicas)
+        if torch.cuda.is_initialized():
+            if not self._sync_steps or not prev_local_bsz:
+                return None  # Memory usage per sample is not known yet.
+            # Memory usage is assumed to be at most linear in the batch size.
+            device = torch.cuda.current_device()
+            total = torch.cuda.get_device_properties(device).total_memory
+            memory = torch.cuda.max_memory_allocated() / prev_local_bsz
+            memory = adaptdl.collective.allreduce(memory / total, max)
+            # Nothing may have been allocated, e.g. if the model is on CPU.
+            if memory > 0:
+                max_bsz = min(max_bsz,
+                              int(_EXPLORE_MEMORY_FRACTION / memory))
+        seen = profiled_atomic_bszs(adaptdl.env.num_nodes(), num_replicas)
+        if not seen or len(seen) >= _EXPLORE_MAX_BSZS:
+            return None
+        candidates = [bsz for bsz in set(2 * b for b in seen) |
+                      set(b // 2 for b in seen)
+                      if min_bsz <= bsz <= max_bsz and bsz not in seen]
+        # Prefer the candidate furthest from all profiled batch sizes, and
+        # larger ones to break ties.
+        candidates.sort(key=lambda bsz: (min(abs(math.log(bsz / b))
+                                             for b in seen), bsz),
+                        reverse=True)
+        explore = None
+        for bsz in candidates:
+            accum_steps = math.ceil(self.batch_size / (bsz * num_replicas)) - 1
+            if accum_steps == 0 or self._gradient_accumulation:
+                explore = (bsz, accum_steps)
+                break
+        return adaptdl.collective.broadcast(explore)
+
+    def _balance_local_bszs(self):
+        # Split the total batch size between replicas proportionally to their
+        # throughputs. Returns None if any replica has not been profiled yet,
+        # or if the local batch sizes would all be the same.
+        num_replicas = adaptdl.env.num_replicas()
+        throughputs = adaptdl.collective.allreduce(
+            {adaptdl.env.replica_rank(): local_throughput()},
+            lambda a, b: {**a, **b})
+        if any(throughputs[rank] is None for rank in range(num_replicas)):
+            return None
+        bounds = self._local_bsz_bounds or (None, None)
+        local_bszs = _split_batch_size(
+            self.current_local_bsz * num_replicas,
+            [throughputs[rank] for rank in range(num_replicas)],
+            bounds[0] or 1, bounds[1])
+        if local_bszs is None or len(set(local_bszs)) == 1:
+            return None
+        return local_bszs
+
+    def _reoptimize_due(self):
+        # Whether this replica wants to re-optimize the batch size. Replicas
+        # agree asynchronously in profile, see _reoptimize_local_bsz.
+        if self.max_batch_size is None:
+            return False
+        if self._reoptimize_steps is not None and \
+                self._sync_steps >= self._reoptimize_steps:
+            return True
+        return self._reoptimize_secs is not None and \
+            time.time() - self._sync_time >= self._reoptimize_secs
+
+    def _reoptimize_local_bsz(self):
+        """
+        Re-optimize the local batch size and accumulation steps in the middle
+        of a dataloader loop, if it is due for every replica and the last step
+        was an optimizer step. Must be invoked by every replica after the same
+        steps, e.g. after each step of a dataloader loop.
+
+        Returns:
+            bool: Whether the local batch size or accumulation steps changed,
+            in which case the loop should continue from the current index.
+        """
+        explored = self._explore_left is not None and self._explore_left <= 0
+        if not (self._reoptimize or explored) or self._accum_count != 0:
+            return False
+        self._reoptimize = False
+        prev = (self.current_local_bsz, self.accumulation_steps,
+                self.local_bszs)
+        self._sync_local_bsz()
+        return (self.current_local_bsz, self.accumulation_steps,
+                self.local_bszs) != prev
+
     @property
     def training(self):
         return self is AdaptiveDataLoaderHelper._training
 
+    def timed(self, iterable):
+        """
+        Wraps an iterable of input data to measure the time spent blocked
+        waiting for each item. The waiting time is profiled separately from
+        the compute time of the next step under :meth:`profile`.
+
+        Arguments:
+            iterable: The data iterable, e.g. a PyTorch DataLoader.
+
+        Returns:
+            Iterator over the same items as the given iterable.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            wait_time = time.time() - start
+            self._data_wait_time += wait_time
+            adaptdl.trace.record("data_wait", start, wait_time)
+            yield item
+
     @contextmanager
     def profile(self, commit):
         """
@@ -318,23 +791,80 @@ class AdaptiveDataLoaderHelper(object):
         Arguments:
             commit (bool): Whether to commit the profiled results.
         """
-        # Synchronize the exit signal so all replicas exit after
-        # the same iteration. Do this asynchronously to prevent
-        # unnecessary blocking on the network.
-        if self.future_exit is not None and self.future_exit.result():
-            adaptdl.checkpoint.save_all_states()
-            exit(143)  # Standard exit code response to SIGTERM.
-        self.future_exit = adaptdl.collective.allreduce_async(
-                    get_exit_flag(), lambda a, b: a or b)
-        profile_step_start(self.current_local_bsz)
-        yield
-        import datetime
-        LOG.info("at %s: commit %s", datetime.datetime.now(), commit)
-        if commit:
+        start = time.time()
+        if self._accum_count == 0:
+            # Steps are sampled as a whole, including accumulation steps.
+            self._steps_to_sample -= 1
+            self._sampled = self._steps_to_sample <= 0
+        if self._sampled:
+            # Synchronize the exit signal so all replicas exit after the same
+            # iteration. Do this asynchronously to prevent unnecessary
+            # blocking on the network. Whether the batch size should be
+            # re-optimized is agreed upon in the same way, tagged with the
+            # number of syncs so results sent before the last sync are
+            # ignored, and so is the interval until the next sampled step.
+            if self.future_exit is not None:
+                exit_flag, reoptimize, interval = self.future_exit.result()
+                if exit_flag:
+                    profile_restart_signal()
+                    adaptdl.checkpoint.save_all_states()
+                    exit(143)  # Standard exit code response to SIGTERM.
+                self._reoptimize = reoptimize == self._num_syncs
+                self._sample_interval = interval
+            self._steps_to_sample = self._sample_interval
+            self.future_exit = adaptdl.collective.allreduce_async(
+                (get_exit_flag(),
+                 self._num_syncs if self._reoptimize_due() else -1,
+                 self._propose_sample_interval()),
+                lambda a, b: (a[0] or b[0], max(a[1], b[1]), max(a[2], b[2])))
+        profile_step_start(self.current_local_bsz, self._data_wait_time,
+                           self.local_bsz)
+        self._data_wait_time = 0.0
+        step_start = time.time()
+        # Forward and backward passes, including the phases traced within.
+        with adaptdl.trace.span("step", atomic_bsz=self.current_local_bsz,
+                                accum=not self.is_optim_step()):
+            yield
+        step_end = time.time()
+        LOG.debug("profiled step, commit %s", commit)
+        if self.training:
+            profile_first_step()
+        if commit and self._sampled:
             profile_step_commit(current_epoch(), self.is_accum_step())
+        if self._overhead_budget:
+            self._update_overhead(start, step_start, step_end)
+        if self.is_optim_step():
+            self._sync_steps += 1
+            if self._explore_left is not None:
+                self._explore_left -= 1
         self._accum_count = (0 if self.is_optim_step()
                              else self._accum_count + 1)
 
+    def _update_overhead(self, start, step_start, step_end):
+        # Average the duration of each step, and the bookkeeping time of each
+        # sampled step, which is spent outside of the forward and backward
+        # passes, or reported by other components such as the gradient noise
+        # scale estimation.
+        step_time = time.time() - start
+        if self._step_time_avg is None:
+            self._step_time_avg = step_time
+        self._step_time_avg = (_OVERHEAD_DECAY * self._step_time_avg +
+                               (1 - _OVERHEAD_DECAY) * step_time)
+        if self._sampled:
+            overhead = (step_start - start + time.time() - step_end +
+                        take_overhead())
+            self._overhead_avg = (_OVERHEAD_DECAY * self._overhead_avg +
+                                  (1 - _OVERHEAD_DECAY) * overhead)
+
+    def _propose_sample_interval(self):
+        # Number of optimizer steps between sampled steps which keeps the
+        # bookkeeping overhead of this replica within the budget.
+        if not self._overhead_budget or not self._step_time_avg:
+            return 1
+        interval = math.ceil(self._overhead_avg /
+                             (self._overhead_budget * self._step_time_avg))
+        return int(min(max(interval, 1), _MAX_SAMPLE_INTERVAL))
+
     @contextmanager
     def context(self):
         """
@@ -414,9 +944,15 @@ class AdaptiveDataLoaderMixin(object):
         self._elastic = AdaptiveDataLoaderHelper(batch_size)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False,
+                             reoptimize_steps=None, reoptimize_secs=None,
+                             heterogeneous=False, explore_steps=None):
         self._elastic.autoscale_batch_size(max_batch_size, local_bsz_bounds,
-                                           gradient_accumulation)
+                                           gradient_accumulation,
+                                           reoptimize_steps, reoptimize_secs,
+                                           heterogeneous, explore_steps)
+    autoscale_batch_size.__doc__ = \
+        AdaptiveDataLoaderHelper.autoscale_batch_size.__doc__
 
     @property
     def current_local_bsz(self):
@@ -477,6 +1013,8 @@ class AdaptiveDataLoader(DataLoader, AdaptiveDataLoaderMixin):
     3.  Iterating through the dataloader is only allowed from within an epoch
         loop (see :mod:`adaptdl.torch.epoch`), and only one dataloader loop is
         allowed at any given time.
+    4.  ``persistent_workers`` defaults to ``True`` if ``num_workers > 0``, so
+        worker processes are kept alive when the batch size changes.
 
     Arguments:
         dataset (torch.util.data.Dataset): Dataset from which to load the data.
@@ -502,8 +1040,19 @@ class AdaptiveDataLoader(DataLoader, AdaptiveDataLoaderMixin):
         kwargs["sampler"] = ElasticSampler(dataset, shuffle=shuffle)
         kwargs["worker_init_fn"] = _worker_init_wrapper(
             kwargs.get("worker_init_fn"), kwargs.get("num_workers"))
+        if kwargs.get("num_workers"):
+            # Batch size changes restart the inner DataLoader loop, which would
+            # otherwise re-spawn every worker process. Persistent workers are
+            # instead reset in place with the new batch composition.
+            kwargs.setdefault("persistent_workers", True)
         super().__init__(dataset, batch_size, shuffle=False, **kwargs)
         AdaptiveDataLoaderMixin.__init__(self, batch_size)
+        self._elastic.supports_heterogeneous = True
+
+    def autoscale_eval_batch_size(self, max_local_bsz):
+        self._elastic.autoscale_eval_batch_size(max_local_bsz)
+    autoscale_eval_batch_size.__doc__ = \
+        AdaptiveDataLoaderHelper.autoscale_eval_batch_size.__doc__
 
     def __iter__(self):
         """
@@ -518,6 +1067,10 @@ class AdaptiveDataLoader(DataLoader, AdaptiveDataLoaderMixin):
         A checkpoint-restart may be triggered in-between each batch. In this
         case, the current iteration state will be saved and restored after the
         restart, and continue where it left off.
+
+        If batch size re-optimization is enabled (see
+        :meth:`autoscale_batch_size`), the batch size may also change
+        in-between batches, continuing from the current index.
         """
         epoch = current_epoch()
         num_replicas = adaptdl.env.num_replicas()
@@ -525,27 +1078,419 @@ class AdaptiveDataLoader(DataLoader, AdaptiveDataLoaderMixin):
             if self._elastic.skipdone():
                 return
             done = False
+            synced = False
             while not done:
                 self.sampler.set_epoch(
                     epoch, index=self._elastic.current_index)
-                self.batch_sampler.batch_size = self._elastic._sync_local_bsz()
-                for idx, batch in enumerate(super().__iter__()):
+                if not synced:
+                    self._elastic._sync_local_bsz()
+                self.sampler.set_local_bszs(self._elastic.local_bszs)
+                self.batch_sampler.batch_size = self._elastic.local_bsz
+                synced = False
+                for idx, batch in enumerate(
+                        self._elastic.timed(super().__iter__())):
                     with self._elastic.profile(self.training and idx >= 1):
                         yield batch
                         # Increment by the number of data samples processed
                         self._elastic.current_index += \
-                            num_replicas * self.batch_sampler.batch_size
+                            num_replicas * self._elastic.current_local_bsz
                         if self._elastic.max_batch_size is not None and \
                                 get_progress() >= len(self.dataset) * \
                                 (epoch + 1) / self.batch_size:
                             done = True
                             break
+                    if self._elastic._reoptimize_local_bsz() or \
+                            self._elastic._probe_eval_local_bsz():
+                        # Continue from the current index with the new size.
+                        synced = True
+                        break
+                if synced:
+                    continue
                 if self._elastic.max_batch_size is None:
                     done = True
                 self._elastic.current_index -= \
                     self._elastic.current_index % -len(self.dataset)
 
 
+class _BucketBatchSampler(Sampler):
+    # Yields the batches of sample indices for the local replica, formed by
+    # sorting buckets of consecutive samples (in shuffled order) by length and
+    # cutting them into batches which fit the local token budget. Every
+    # replica gets the same number of samples from each batch of sorted
+    # samples, so the total number of samples loaded so far by all replicas
+    # (index) determines the position to continue from after a restart.
+
+    def __init__(self, lengths, bucket_size, shuffle=True):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.num_replicas = adaptdl.env.num_replicas()
+        self.rank = adaptdl.env.replica_rank()
+        self.epoch = 0
+        self.index = 0
+        self.batch_size = 1  # Local budget of padded tokens per batch.
+        # Number of samples loaded by all replicas in each yielded batch.
+        self.consumed = collections.deque()
+
+    def set_epoch(self, epoch, index=0):
+        self.epoch = epoch
+        self.index = index
+
+    def _local_count(self, lengths):
+        # Largest number of samples per replica such that every replica's
+        # batch fits the budget, given the remaining sorted lengths.
+        lo, hi = 1, math.ceil(len(lengths) / self.num_replicas)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            longest = lengths[min(self.num_replicas * mid, len(lengths)) - 1]
+            if longest * mid <= self.batch_size:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def __iter__(self):
+        self.consumed.clear()
+        size = len(self.lengths)
+        if self.shuffle:
+            permutation = _FeistelPermutation(
+                size, hash((self.epoch, self.index // size)))
+        else:
+            permutation = None
+        base_index = self.index % size
+        skip = base_index % self.bucket_size
+        return self._batches(permutation, base_index - skip, skip)
+
+    def _batches(self, permutation, start, skip):
+        size = len(self.lengths)
+        for bucket_start in range(start, size, self.bucket_size):
+            positions = range(bucket_start,
+                              min(bucket_start + self.bucket_size, size))
+            indices = np.fromiter(_permuted(permutation, positions),
+                                  dtype=np.int64, count=len(positions))
+            order = np.argsort(self.lengths[indices], kind="stable")
+            indices = indices[order][skip:]
+            lengths = self.lengths[indices]
+            skip = 0
+            pos = 0
+            while pos < len(indices):
+                count = self._local_count(lengths[pos:])
+                first = pos + self.rank * count
+                batch = indices[first:first + count]
+                if len(batch) == 0:
+                    # Pad to make the number of batches the same.
+                    batch = indices[-1:]
+                consumed = min(self.num_replicas * count, len(indices) - pos)
+                self.consumed.append(consumed)
+                yield batch.tolist()
+                pos += consumed
+
+
+class AdaptiveBucketDataLoader(DataLoader, AdaptiveDataLoaderMixin):
+    """
+    This class is an :class:`AdaptiveDataLoader` for variable-length samples,
+    such as speech utterances or text sequences, which batches samples by a
+    budget of padded tokens (or frames) instead of a number of samples. The
+    ``batch_size``, the arguments of :meth:`autoscale_batch_size`, and the
+    local batch sizes profiled for the goodput model are all counted in
+    tokens, i.e. the number of samples in a batch times its longest length.
+
+    Samples are drawn in buckets of ``bucket_size`` consecutive samples (in
+    shuffled order if ``shuffle`` is set). Each bucket is sorted by length
+    and cut into batches of samples with similar lengths, so little compute
+    is wasted on padding. Each replica's batch fits the local token budget,
+    unless a single sample is longer than the budget.
+
+    Arguments:
+        dataset (torch.util.data.Dataset): Dataset from which to load the data.
+        lengths (list): The length of each sample in the dataset, in tokens.
+        batch_size (int): The target total number of padded tokens in each
+            batch across all replicas.
+        bucket_size (int): Number of samples sorted by length together.
+        shuffle (bool): Whether the data is reshuffled at every epoch.
+        **kwargs: Keyword arguments passed to ``torch.util.data.Dataloader``.
+
+    Raises:
+        ValueError: If ``lengths`` does not match the dataset, or ``sampler``
+            or ``batch_sampler`` are not ``None``.
+
+    .. automethod:: __iter__
+    """
+    def __init__(self, dataset, lengths, batch_size=1, bucket_size=1000,
+                 shuffle=False, **kwargs):
+        if kwargs.get("batch_sampler") is not None \
+                or kwargs.get("sampler") is not None:
+            raise ValueError("AdaptiveBucketDataLoader does not support "
+                             "custom 'sampler' or 'batch_sampler'")
+        if len(lengths) != len(dataset):
+            raise ValueError("lengths does not match the dataset")
+        kwargs["batch_sampler"] = _BucketBatchSampler(lengths, bucket_size,
+                                                      shuffle=shuffle)
+        kwargs["worker_init_fn"] = _worker_init_wrapper(
+            kwargs.get("worker_init_fn"), kwargs.get("num_workers"))
+        if kwargs.get("num_workers"):
+            kwargs.setdefault("persistent_workers", True)
+        super().__init__(dataset, **kwargs)
+        AdaptiveDataLoaderMixin.__init__(self, batch_size)
+        self._total_tokens = int(self.batch_sampler.lengths.sum())
+
+    def __iter__(self):
+        """
+        Iterate over batches of data, which stops under the same conditions
+        as :meth:`AdaptiveDataLoader.__iter__`, except that statistical
+        progress is measured against one pass over the dataset's tokens.
+        """
+        epoch = current_epoch()
+        size = len(self.dataset)
+        with self._elastic.context():
+            if self._elastic.skipdone():
+                return
+            done = False
+            synced = False
+            while not done:
+                self.batch_sampler.set_epoch(
+                    epoch, index=self._elastic.current_index)
+                if not synced:
+                    self._elastic._sync_local_bsz()
+                self.batch_sampler.batch_size = self._elastic.current_local_bsz
+                synced = False
+                for idx, batch in enumerate(
+                        self._elastic.timed(super().__iter__())):
+                    with self._elastic.profile(self.training and idx >= 1):
+                        yield batch
+                        # Increment by the number of data samples processed
+                        self._elastic.current_index += \
+                            self.batch_sampler.consumed.popleft()
+                        if self._elastic.max_batch_size is not None and \
+                                get_progress() >= self._total_tokens * \
+                                (epoch + 1) / self._elastic.batch_size:
+                            done = True
+                            break
+                    if self._elastic._reoptimize_local_bsz():
+                        # Continue from the current index with the new size.
+                        synced = True
+                        break
+                if synced:
+                    continue
+                if self._elastic.max_batch_size is None:
+                    done = True
+                self._elastic.current_index -= \
+                    self._elastic.current_index % -size
+
+
+class AdaptiveShardedDataLoader(AdaptiveDataLoaderMixin):
+    """
+    An elastic data loader for datasets stored as shards which can only be
+    read sequentially, such as tar-sharded streams on object storage. Supports
+    adaptive batch sizes and checkpoint-restart elasticity like
+    :class:`AdaptiveDataLoader`, without indexing samples randomly.
+
+    In each pass over the dataset, the shards are ordered deterministically
+    based on the epoch (and shuffled if ``shuffle`` is set), and the samples
+    not yet loaded are split into one contiguous range per replica, so each
+    replica reads only one or two shards at a time. The position in each
+    range is checkpointed, and the remaining samples are split evenly between
+    the new replicas after a checkpoint-restart. Every sample is loaded once
+    per pass, except that a replica with one fewer sample than the others may
+    repeat a sample in its last batch.
+
+    Arguments:
+        shards (list): Identifiers of the shards, e.g. their URLs.
+        shard_sizes (list): Number of samples in each shard.
+        open_shard (callable): Invoked as ``open_shard(shard, offset)`` with a
+            shard identifier, and returns an iterator over the samples in that
+            shard starting from sample number ``offset``.
+        batch_size (int): The target total batch size across all replicas.
+        shuffle (bool): Whether the order of shards is reshuffled at every
+            epoch.
+        collate_fn (callable): Merges a list of samples into a batch.
+
+    Raises:
+        ValueError: If ``shards`` and ``shard_sizes`` differ in length.
+
+    .. automethod:: __iter__
+    """
+    def __init__(self, shards, shard_sizes, open_shard, batch_size=1,
+                 shuffle=False, collate_fn=None):
+        if len(shards) != len(shard_sizes):
+            raise ValueError("shards and shard_sizes differ in length")
+        self.shards = list(shards)
+        self.shard_sizes = list(shard_sizes)
+        self.open_shard = open_shard
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.collate_fn = collate_fn or default_collate
+        AdaptiveDataLoaderMixin.__init__(self, batch_size)
+        self._stream = _ShardedStreamState()
+        adaptdl.checkpoint.load_state(self._stream)
+
+    def __len__(self):
+        """
+        The total number of samples in all shards.
+        """
+        return sum(self.shard_sizes)
+
+    def _read(self, epoch, ranges):
+        # Yields the samples at the given positions in the current pass.
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            seed = hash((epoch, self._stream.pass_index))
+            random.Random(seed).shuffle(order)
+        offsets = [0]
+        for idx in order:
+            offsets.append(offsets[-1] + self.shard_sizes[idx])
+        for start, end in ranges:
+            pos = start
+            while pos < end:
+                k = bisect.bisect_right(offsets, pos) - 1
+                count = min(end, offsets[k + 1]) - pos
+                shard = self.shards[order[k]]
+                samples = self.open_shard(shard, pos - offsets[k])
+                for sample in itertools.islice(samples, count):
+                    yield sample
+                    pos += 1
+                if pos < min(end, offsets[k + 1]):
+                    raise RuntimeError("shard {} has fewer samples than "
+                                       "expected".format(shard))
+
+    def __iter__(self):
+        """
+        Iterate over batches of data, which stops under the same conditions
+        as :meth:`AdaptiveDataLoader.__iter__`. The batch size may change
+        in-between batches without re-opening any shards.
+        """
+        epoch = current_epoch()
+        num_replicas = adaptdl.env.num_replicas()
+        rank = adaptdl.env.replica_rank()
+        with self._elastic.context():
+            if self._elastic.skipdone():
+                return
+            try:
+                self._elastic._sync_local_bsz()
+                done = False
+                while not done:
+                    stream = self._stream
+                    if stream.ranges is None:
+                        stream.ranges = [(0, len(self))]
+                    stream.plan = _split_ranges(stream.ranges, num_replicas)
+                    stream.consumed = 0
+                    # Number of steps is the same for all replicas.
+                    remaining = max(_ranges_len(part) for part in stream.plan)
+                    samples = self._read(epoch, stream.plan[rank])
+                    # Used to pad the last batch, if this replica runs out.
+                    last = None
+                    idx = 0
+                    while stream.consumed < remaining:
+                        start = time.time()
+                        local_bsz = self._elastic.current_local_bsz
+                        batch = list(itertools.islice(samples, local_bsz))
+                        if not batch:
+                            if last is None:
+                                last = next(self._read(epoch, [(0, 1)]))
+                            batch = [last]
+                        last = batch[-1]
+                        batch = self.collate_fn(batch)
+                        self._elastic._data_wait_time += time.time() - start
+                        commit = self.training and idx >= 1
+                        with self._elastic.profile(commit):
+                            yield batch
+                            stream.consumed = min(stream.consumed + local_bsz,
+                                                  remaining)
+                            self._elastic.current_index += \
+                                num_replicas * local_bsz
+                            if self._elastic.max_batch_size is not None and \
+                                    get_progress() >= len(self) * \
+                                    (epoch + 1) / self.batch_size:
+                                done = True
+                                break
+                        idx += 1
+                        # Applies to the next batch, no need to re-open shards.
+                        self._elastic._reoptimize_local_bsz()
+                    if self._elastic.max_batch_size is None:
+                        done = True
+                    if not done:  # Start another pass over the dataset.
+                        stream.pass_index += 1
+                        stream.ranges = stream.plan = None
+                        self._elastic.current_index -= \
+                            self._elastic.current_index % -len(self)
+            finally:
+                self._stream.reset()
+
+
+def _ranges_len(ranges):
+    return sum(end - start for start, end in ranges)
+
+
+def _split_ranges(ranges, num_parts):
+    # Split a list of disjoint (start, end) ranges into num_parts lists of
+    # ranges, which are contiguous in the concatenated order of the ranges
+    # and whose total lengths differ by at most one.
+    total = _ranges_len(ranges)
+    ranges = list(ranges)
+    idx = 0
+    parts = []
+    for part in range(num_parts):
+        size = total // num_parts + (part < total % num_parts)
+        parts.append([])
+        while size > 0:
+            start, end = ranges[idx]
+            take = min(size, end - start)
+            parts[-1].append((start, start + take))
+            size -= take
+            if start + take == end:
+                idx += 1
+            else:
+                ranges[idx] = (start + take, end)
+    return parts
+
+
+def _skip_ranges(ranges, count):
+    # The ranges remaining after skipping the first count positions.
+    remaining = []
+    for start, end in ranges:
+        skip = min(count, end - start)
+        count -= skip
+        if start + skip < end:
+            remaining.append((start + skip, end))
+    return remaining
+
+
+class _ShardedStreamState(adaptdl.checkpoint.State):
+
+    # Assume loaders are initialized in the same order in every replica. Keep
+    # a map of epoch -> number of loaders initialized so far in that epoch,
+    # and use that count to construct a unique name for the state.
+    init_count = collections.Counter()
+
+    def __init__(self):
+        if current_dataloader() is not None:
+            raise RuntimeError("dataloader may not be initialized during "
+                               "dataloader iteration")
+        epoch = current_epoch()
+        count = _ShardedStreamState.init_count[epoch]
+        super().__init__("adaptdl-sharded-epoch{}-{}".format(epoch, count))
+        _ShardedStreamState.init_count[epoch] += 1
+        self.reset()
+
+    def reset(self):
+        self.pass_index = 0  # Number of passes completed in the current loop.
+        self.ranges = None   # Positions not yet loaded in the current pass.
+        self.plan = None     # Ranges split between replicas, while loading.
+        self.consumed = 0    # Samples loaded from each part of the plan.
+
+    def remaining(self):
+        if self.plan is None:
+            return self.ranges
+        return [r for part in self.plan
+                for r in _skip_ranges(part, self.consumed)]
+
+    def save(self, fileobj):
+        pickle.dump((self.pass_index, self.remaining()), fileobj)
+
+    def load(self, fileobj):
+        self.pass_index, self.ranges = pickle.load(fileobj)
+
+
 class _AdaptiveDataLoaderState(adaptdl.checkpoint.State):
 
     # Assume dataloaders are initialized in the same order in every replica.
@@ -87,6 +87,83 @@ def test_sampler_index(num_replicas, dataset_size):
     assert set(sum(epoch_samples, [])) == set(range(dataset_size))
 
 
+@pytest.mark.parametrize("local_bszs", [[1, 2], [3, 1, 2], [5, 4, 1, 7]])
+@pytest.mark.parametrize("dataset_size", [9, 15, 25])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_sampler_local_bszs(local_bszs, dataset_size, shuffle):
+    dataset = TensorDataset(torch.rand(dataset_size))
+    sampler = ElasticSampler(dataset, shuffle=shuffle)
+    sampler.num_replicas = len(local_bszs)
+    index = dataset_size // 2
+    sampler.set_epoch(0, index)
+    sampler.set_local_bszs(local_bszs)
+    samples = []
+    for rank, local_bsz in enumerate(local_bszs):
+        sampler.rank = rank
+        samples.append(list(sampler))
+        assert len(samples[rank]) == len(sampler)
+        assert len(sampler) % local_bsz == 0
+    # Every replica takes the same number of batches.
+    num_batches = len(samples[0]) // local_bszs[0]
+    assert all(len(s) // b == num_batches
+               for s, b in zip(samples, local_bszs))
+    # Each step covers consecutive samples in the sampling order.
+    sampler.set_local_bszs(None)
+    sampler.num_replicas = 1
+    sampler.rank = 0
+    order = list(sampler)
+    pos = 0
+    for step in range(num_batches):
+        for rank, local_bsz in enumerate(local_bszs):
+            batch = samples[rank][step * local_bsz:(step + 1) * local_bsz]
+            real = batch[:max(len(order) - pos, 0)]
+            assert real == order[pos:pos + len(real)]
+            pos += local_bsz
+    with pytest.raises(ValueError):
+        sampler.set_local_bszs([1, 2])
+
+
+def test_split_batch_size():
+    from adaptdl.torch.data import _split_batch_size
+    assert _split_batch_size(12, [1.0, 1.0, 1.0], 1, None) == [4, 4, 4]
+    assert _split_batch_size(12, [1.0, 2.0, 3.0], 1, None) == [2, 4, 6]
+    local_bszs = _split_batch_size(10, [1.0, 1.0, 1.0], 1, None)
+    assert sum(local_bszs) == 10 and max(local_bszs) == 4
+    assert _split_batch_size(12, [1.0, 10.0], 3, 8) == [4, 8]
+    assert _split_batch_size(12, [1.0, 100.0], 1, None) == [1, 11]
+    assert _split_batch_size(20, [1.0, 1.0], 1, 8) is None
+    assert _split_batch_size(2, [1.0, 1.0, 1.0], 1, None) is None
+
+
+@pytest.mark.parametrize("size", [1, 2, 9, 16, 17, 1000])
+def test_feistel_permutation(size):
+    from adaptdl.torch.data import _FeistelPermutation
+    perm = _FeistelPermutation(size, 123)
+    indices = perm(range(size)).tolist()
+    assert sorted(indices) == list(range(size))
+    # Deterministic, and can be evaluated from any position.
+    assert _FeistelPermutation(size, 123)(range(size)).tolist() == indices
+    assert perm(range(size // 2, size)).tolist() == indices[size // 2:]
+    if size >= 16:
+        assert _FeistelPermutation(size, 124)(range(size)).tolist() != indices
+
+
+@pytest.mark.parametrize("num_replicas", [1, 3, 5])
+def test_sampler_resume(num_replicas, dataset_size=10000):
+    dataset = TensorDataset(torch.rand(dataset_size))
+    sampler = ElasticSampler(dataset)
+    sampler.num_replicas = num_replicas
+    sampler.set_epoch(1)
+    full = [list(sampler) for sampler.rank in range(num_replicas)]
+    # Resuming from an index continues the same ordering.
+    index = 4321 - 4321 % num_replicas
+    sampler.set_epoch(1, index)
+    for rank in range(num_replicas):
+        sampler.rank = rank
+        resumed = list(sampler)
+        assert resumed == full[rank][index // num_replicas:][:len(resumed)]
+
+
 @elastic_multiprocessing
 def test_dataloader_restarts():
     import adaptdl.checkpoint
@@ -140,6 +217,314 @@ def test_dataloader_break():
     assert idx == 9  # Run 10 batches total.
 
 
+@elastic_multiprocessing
+def test_dataloader_persistent_workers():
+    import adaptdl.collective
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.rand(100))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=10, num_workers=2)
+    pids = None
+    for epoch in remaining_epochs_until(2):
+        # Change the batch size between dataloader loops.
+        dataloader._elastic.batch_size = 10 * (epoch + 1)
+        for batch in dataloader:
+            assert batch[0].size(0) == 10 * (epoch + 1)
+        workers = dataloader._iterator._workers
+        if pids is None:
+            pids = [worker.pid for worker in workers]
+        # The same worker processes are re-used for the new batch size.
+        assert [worker.pid for worker in workers] == pids
+        assert all(worker.is_alive() for worker in workers)
+
+
+@elastic_multiprocessing
+def test_dataloader_reoptimize():
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    import adaptdl.torch.data
+    from adaptdl.env import num_restarts, num_replicas
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+
+    class GoodputFunction(object):
+        # Suggests a larger local batch size each time it is optimized.
+        def __init__(self):
+            self.local_bsz = 0
+
+        def optimize(self, *args, **kwargs):
+            self.local_bsz += 2
+            return 2.0, self.local_bsz, 0
+
+        def __call__(self, *args, **kwargs):
+            return 1.0
+
+    goodput_fn = GoodputFunction()
+    adaptdl.torch.data.get_goodput_fn = lambda: goodput_fn
+    dataset = TensorDataset(torch.rand(1000))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=2)
+    dataloader.autoscale_batch_size(1000, reoptimize_steps=5)
+    for epoch in remaining_epochs_until(1):
+        sizes = []
+        index = dataloader._elastic._state.current_index
+        for idx, batch in enumerate(dataloader):
+            # Progress is counted using the batch sizes actually loaded.
+            assert dataloader._elastic.current_index == \
+                index + num_replicas() * sum(sizes)
+            assert batch[0].size(0) == dataloader.current_local_bsz
+            sizes.append(batch[0].size(0))
+            if num_restarts() == 0 and idx == 20:
+                adaptdl.checkpoint.save_all_states()
+                return 2
+            if idx == 20:
+                break
+        # The batch size changed in the middle of the loop.
+        assert sizes == sorted(sizes) and len(set(sizes)) >= 3
+
+
+@elastic_multiprocessing
+def test_dataloader_heterogeneous():
+    import adaptdl.collective
+    import adaptdl.torch.data
+    from adaptdl.env import num_restarts, replica_rank
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+
+    class GoodputFunction(object):
+        def optimize(self, *args, **kwargs):
+            return 1.0, 6, 0
+
+        def __call__(self, *args, **kwargs):
+            return 1.0
+
+    goodput_fn = GoodputFunction()
+    adaptdl.torch.data.get_goodput_fn = lambda: goodput_fn
+    # Replica 1 is twice as fast as replica 0.
+    adaptdl.torch.data.local_throughput = lambda: 1.0 + replica_rank()
+    dataset = TensorDataset(torch.arange(100))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=2)
+    dataloader.autoscale_batch_size(1000, heterogeneous=True)
+    if num_restarts() == 0:
+        return 2
+    for epoch in remaining_epochs_until(1):
+        samples = []
+        for idx, batch in enumerate(dataloader):
+            assert dataloader._elastic.local_bszs == [4, 8]
+            assert batch[0].size(0) == 4 * (1 + replica_rank())
+            assert dataloader._elastic.current_index == 12 * idx
+            samples.extend(batch[0].tolist())
+            if idx == 4:
+                break
+        samples = adaptdl.collective.allreduce(samples)
+        assert sorted(samples) == list(range(60))
+    with pytest.raises(ValueError):
+        adaptdl.torch.data.AdaptiveShardedDataLoader(
+            [], [], None).autoscale_batch_size(1000, heterogeneous=True)
+
+
+@elastic_multiprocessing
+def test_dataloader_explore():
+    import adaptdl.collective
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.arange(256))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=8)
+    dataloader.autoscale_batch_size(64, explore_steps=3)
+    # Each pass over the dataset re-syncs the batch size. Nothing is profiled
+    # during the first pass, then larger atomic batch sizes are explored
+    # until enough different ones were profiled.
+    expected = ([8] * 32 + [16] * 3 + [8] * 26 + [32] * 3 + [8] * 20 +
+                [8] * 32)
+    for epoch in remaining_epochs_until(1):
+        sizes = []
+        for batch in dataloader:
+            sizes.append(batch[0].size(0))
+            if len(sizes) == len(expected):
+                break
+        assert sizes == expected
+    with pytest.raises(ValueError):
+        dataloader.autoscale_batch_size(64, explore_steps=0)
+
+
+@elastic_multiprocessing
+def test_dataloader_explore_cuda():
+    from unittest import mock
+    import adaptdl.collective
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.arange(256))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=8)
+    dataloader.autoscale_batch_size(64, explore_steps=3)
+    # No GPU memory is allocated, e.g. if the model is on CPU.
+    with mock.patch.multiple(
+            torch.cuda, is_initialized=lambda: True, current_device=lambda: 0,
+            get_device_properties=lambda device: mock.Mock(
+                total_memory=2 ** 30),
+            max_memory_allocated=lambda: 0,
+            reset_peak_memory_stats=lambda: None):
+        for epoch in remaining_epochs_until(1):
+            sizes = []
+            for batch in dataloader:
+                sizes.append(batch[0].size(0))
+                if len(sizes) == 150:
+                    break
+    assert set(sizes) == {8, 16, 32}
+
+
+@elastic_multiprocessing
+def test_dataloader_overhead_budget():
+    import os
+    import adaptdl.collective
+    from adaptdl.env import num_restarts
+    from adaptdl.torch.epoch import remaining_epochs_until
+    if num_restarts() == 0:
+        return 2
+    os.environ["ADAPTDL_OVERHEAD_BUDGET"] = "0.01"
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.arange(1000))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=4)
+    for epoch in remaining_epochs_until(1):
+        sampled = []
+        for batch in dataloader:
+            sampled.append(dataloader._elastic.sampled)
+    # The steps are almost all bookkeeping, so few of them are sampled, and
+    # all replicas sample the same steps.
+    assert sampled[:2] == [True, True]
+    assert sum(sampled) < len(sampled) / 2
+    assert 1 < dataloader._elastic._sample_interval <= 100
+    all_sampled = adaptdl.collective.allreduce([sampled])
+    assert all_sampled[0] == all_sampled[1]
+    return 0
+
+
+@elastic_multiprocessing
+def test_dataloader_eval_bsz():
+    import time
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    from adaptdl.env import num_restarts
+    from adaptdl.torch.epoch import remaining_epochs_until
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.arange(1000))
+    dataloader = AdaptiveDataLoader(dataset, batch_size=4)
+    dataloader.autoscale_eval_batch_size(48)
+    if num_restarts() == 0:
+        return 2
+    for epoch in remaining_epochs_until(1):
+        sizes = []
+        samples = []
+        for batch in dataloader:
+            time.sleep(0.01)  # Throughput increases with batch size.
+            sizes.append(batch[0].size(0))
+            samples.extend(batch[0].tolist())
+        # Probed 2, 4, 8, 16, 32 then 48 samples, kept the largest.
+        assert sizes[:20] == [2] * 4 + [4] * 4 + [8] * 4 + [16] * 4 + [32] * 4
+        assert set(sizes[20:-1]) == {48}
+        samples = adaptdl.collective.allreduce(samples)
+        assert set(samples) == set(range(1000))
+        # Probing is not repeated in later loops.
+        assert dataloader.current_local_bsz is None
+        assert {batch[0].size(0) for batch in dataloader} == {48, 20}
+    with pytest.raises(ValueError):
+        dataloader.autoscale_eval_batch_size(0)
+
+
+@elastic_multiprocessing
+def test_sharded_dataloader():
+    import os
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    from adaptdl.env import (checkpoint_path, num_restarts, num_replicas,
+                             replica_rank)
+    from adaptdl.torch.data import AdaptiveShardedDataLoader
+    from adaptdl.torch.epoch import remaining_epochs_until
+    shard_sizes = [7, 0, 3, 12, 5, 9, 1]
+    opened = []
+
+    def open_shard(shard, offset):
+        opened.append((shard, offset))
+        return iter(range(shard * 100 + offset,
+                          shard * 100 + shard_sizes[shard]))
+
+    log_file = os.path.join(checkpoint_path(), "samples-{}-{}".format(
+        num_restarts(), replica_rank()))
+    if num_restarts() == 3:
+        # Check every sample was loaded once per epoch, allowing for one
+        # padding sample per replica at the end of each loop.
+        samples = collections.Counter()
+        for name in os.listdir(checkpoint_path()):
+            if name.startswith("samples-"):
+                with open(os.path.join(checkpoint_path(), name)) as f:
+                    samples.update(int(line) for line in f)
+        expected = {shard * 100 + offset
+                    for shard, size in enumerate(shard_sizes)
+                    for offset in range(size)}
+        assert set(samples) == expected
+        assert sum(samples.values()) <= 2 * (len(expected) + 3)
+        return
+    adaptdl.collective.initialize("0.0.0.0")
+    dataloader = AdaptiveShardedDataLoader(
+        list(range(len(shard_sizes))), shard_sizes, open_shard,
+        batch_size=6, shuffle=True, collate_fn=list)
+    for epoch in remaining_epochs_until(2):
+        opened.clear()
+        for idx, batch in enumerate(dataloader):
+            if num_restarts() == 0 and epoch == 0 and idx == 2:
+                adaptdl.checkpoint.save_all_states()
+                return 3
+            if num_restarts() == 1 and epoch == 1 and idx == 1:
+                adaptdl.checkpoint.save_all_states()
+                return 2
+            assert len(batch) <= dataloader.current_local_bsz
+            with open(log_file, "a") as f:
+                f.write("".join("{}\n".format(sample) for sample in batch))
+        # Each replica opens few shards, rather than reading all of them.
+        assert len(opened) <= len(shard_sizes) // num_replicas() + 2
+    if num_restarts() == 2:
+        return 1
+
+
+@elastic_multiprocessing
+def test_bucket_dataloader():
+    import os
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    from adaptdl.env import (checkpoint_path, num_restarts, num_replicas,
+                             replica_rank)
+    from adaptdl.torch.data import AdaptiveBucketDataLoader
+    from adaptdl.torch.epoch import remaining_epochs_until
+    lengths = [(idx * 37) % 50 + 1 for idx in range(200)]
+    log_file = os.path.join(checkpoint_path(), "samples-{}-{}".format(
+        num_restarts(), replica_rank()))
+    if num_restarts() == 2:
+        samples = collections.Counter()
+        for name in os.listdir(checkpoint_path()):
+            if name.startswith("samples-"):
+                with open(os.path.join(checkpoint_path(), name)) as f:
+                    samples.update(int(line) for line in f)
+        # Every sample is loaded, with few padding samples.
+        assert set(samples) == set(range(len(lengths)))
+        assert sum(samples.values()) <= len(lengths) + 10
+        return
+    adaptdl.collective.initialize("0.0.0.0")
+    dataset = TensorDataset(torch.arange(len(lengths)))
+    dataloader = AdaptiveBucketDataLoader(dataset, lengths, batch_size=240,
+                                          bucket_size=50, shuffle=True)
+    for epoch in remaining_epochs_until(1):
+        for idx, batch in enumerate(dataloader):
+            if num_restarts() == 0 and idx == 3:
+                adaptdl.checkpoint.save_all_states()
+                return 2
+            samples = batch[0].tolist()
+            # Batches fit the local budget of padded tokens.
+            budget = dataloader.current_local_bsz
+            assert budget == 240 // num_replicas()
+            assert len(samples) * max(lengths[i] for i in samples) <= budget
+            with open(log_file, "a") as f:
+                f.write("".join("{}\n".format(i) for i in samples))
+    return 1
+
+
 @elastic_multiprocessing
 def test_bptt_iterator():
     import adaptdl.checkpoint
@@ -166,3 +551,64 @@ def test_bptt_iterator():
             assert batch.text.shape == (5, 5) or batch.text.shape == (4, 5)
     if adaptdl.env.num_replicas() == 2:
         assert idx == 8
+
+
+@elastic_multiprocessing
+def test_bptt_iterator_cache():
+    import os
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    from adaptdl.env import num_restarts, replica_rank
+    adaptdl.collective.initialize("0.0.0.0")
+    os.environ["ADAPTDL_SHARE_PATH"] = os.path.join(
+        os.environ["ADAPTDL_CHECKPOINT_PATH"], "share")
+    cache_file = os.path.join(adaptdl.env.share_path(), "adaptdl-cache",
+                              "text.bin")
+    # 493 words, padded to 50 rows of 10 words or 99 rows of 5 words.
+    TEXT = torchtext.data.Field(tokenize=get_tokenizer("basic_english"))
+    fields = [('text', TEXT)]
+    words = ["word{}".format(idx % 7) for idx in range(493)]
+    examples = [torchtext.data.Example.fromlist([words], fields)]
+    dataset = torchtext.data.Dataset(examples, fields)
+    TEXT.build_vocab(dataset)
+
+    def expected(batch_size):
+        # Data numericalized and padded as by BPTTIterator without a cache.
+        text = dataset[0].text
+        size = math.ceil(len(text) / batch_size) * batch_size
+        text = text + [TEXT.pad_token] * (size - len(text))
+        return TEXT.numericalize([text]).view(batch_size, -1).t()
+
+    # Iterators must be created in the same order after restarting.
+    first = AdaptiveBPTTIterator(dataset, batch_size=10, bptt_len=5,
+                                 cache_name="text")
+    second = AdaptiveBPTTIterator(dataset, batch_size=10, bptt_len=5,
+                                  cache_name="text")
+    resumed = AdaptiveBPTTIterator(dataset, batch_size=10, bptt_len=5,
+                                   cache_name="text")
+    if num_restarts() == 0:
+        data = expected(10)
+        batches = [batch.text for batch in first]
+        assert os.path.isfile(cache_file)
+        assert len(batches) == 10
+        for idx, text in enumerate(batches):
+            # The last batch is shorter, as it has no target for its last row.
+            assert torch.equal(text, data[idx * 5:idx * 5 + text.size(0)])
+        # Loaded from the cache written by the first iterator.
+        cached = [batch.text for batch in second]
+        assert len(cached) == 10
+        for text, cached_text in zip(batches, cached):
+            assert torch.equal(text, cached_text)
+        for idx, batch in enumerate(resumed):
+            if idx == 2:
+                adaptdl.checkpoint.save_all_states()
+                return 2
+    else:
+        data = expected(5)
+        # Two batches of 5 out of 50 rows were done with 1 replica, resume
+        # from the same fraction of the text.
+        start = math.ceil(10 * data.size(0) / 50)
+        for idx, batch in enumerate(resumed):
+            if idx == 0:
+                offset = start + 5 * replica_rank()
+                assert torch.equal(batch.text, data[offset:offset + 5])
@@ -86,11 +86,11 @@ import logging
 import pickle
 
 import adaptdl.checkpoint
+import adaptdl.env
 
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 def remaining_epochs_until(epoch):
@@ -170,7 +170,8 @@ class _EpochState(adaptdl.checkpoint.State):
 def _epoch_state():
     global _EPOCH_STATE
     if _EPOCH_STATE is None:
-        _EPOCH_STATE = _EpochState()
+        with adaptdl.checkpoint._global_scope():
+            _EPOCH_STATE = _EpochState()
         adaptdl.checkpoint.load_state(_EPOCH_STATE)
     return _EPOCH_STATE
 
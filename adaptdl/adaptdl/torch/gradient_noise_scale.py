@@ -1,19 +1,22 @@
 import functools
 import logging
 import math
+import time
 import numpy as np
 import torch.distributed
 import torch.optim
 
 from torch.autograd import Variable
 
+import adaptdl.env
+import adaptdl.trace
 import adaptdl.utils
+from adaptdl.torch._metrics import profile_overhead
 
 __all__ = ["GradientNoiseScale"]
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 def _average_groups(grads1, grads2):
@@ -55,7 +58,10 @@ class GradientNoiseScale(object):
         self._num_replicas = (num_replicas if num_replicas is not None
                               else torch.distributed.get_world_size())
         self._accum_scale = accum_scale or self._num_replicas
+        self._local_bszs = None
         self._prev_grads = None
+        self._sampled = True  # Whether to update estimates in this step.
+        self._skipped_steps = 0  # Optimizer steps since the last update.
 
         self.reset_accumulation()
 
@@ -103,6 +109,31 @@ class GradientNoiseScale(object):
             self.reset_accumulation()
             self._accum_scale = accum_scale
 
+    def set_sampled(self, sampled):
+        """
+        Sets whether the estimates are updated in the current step, which
+        should be the same for all replicas and accumulation steps of the same
+        optimizer step. Estimates are updated in every step by default.
+
+        Arguments:
+            sampled (bool): Whether to update the estimates.
+        """
+        self._sampled = sampled
+
+    def set_local_bszs(self, local_bszs):
+        """
+        Set the local batch size of each replica, if they are different. The
+        local gradients are then assumed to be averaged weighted by their
+        local batch sizes.
+
+        Arguments:
+            local_bszs (list): The local batch size of each replica, or
+                ``None`` if they are all the same.
+        """
+        if local_bszs != self._local_bszs:
+            self.reset_accumulation()
+            self._local_bszs = local_bszs
+
     @property
     def raw_sqr_avg(self):
         view = self._state["sqr_avg"].view()
@@ -169,17 +200,18 @@ class GradientNoiseScale(object):
     def _backward_hook(self, idx, param, grad):
         # This method should be invoked once for each parameter during the
         # backward pass, before gradients are synchronized between replicas.
-        if self._local_sqr is None:
-            self._local_sqr = torch.zeros(len(self._optimizer.param_groups),
-                                          device=grad.device,
-                                          dtype=torch.float64)
-
-        # Get the preconditioning matrix for the optimizer
-        preconditioner = self._calculate_preconditioner(idx, param)
-
-        # Update the local gradient square sum
-        self._local_sqr[idx] += \
-            (grad.detach() / preconditioner).pow(2).sum(dtype=torch.float64)
+        if self._sampled:
+            if self._local_sqr is None:
+                self._local_sqr = torch.zeros(
+                    len(self._optimizer.param_groups), device=grad.device,
+                    dtype=torch.float64)
+
+            # Get the preconditioning matrix for the optimizer
+            preconditioner = self._calculate_preconditioner(idx, param)
+
+            # Update the local gradient square sum
+            self._local_sqr[idx] += (grad.detach() / preconditioner).pow(2) \
+                .sum(dtype=torch.float64)
         if not self._callback_queued:
             Variable._execution_engine.queue_callback(self._queue_callback)
         self._callback_queued = True
@@ -199,7 +231,7 @@ class GradientNoiseScale(object):
             # Asynchronously sum the local squared-gradient statistics. The
             # actual gradient averaging should also be happening at the same
             # time, until self._final_callback is invoked.
-            if self._num_replicas > 1:
+            if self._num_replicas > 1 and self._sampled:
                 self._async_op = torch.distributed.all_reduce(self._local_sqr,
                                                               async_op=True)
             Variable._execution_engine.queue_callback(self._final_callback)
@@ -212,6 +244,23 @@ class GradientNoiseScale(object):
     def _final_callback(self):
         # This method should be invoked once the gradients have been
         # synchronized between all replicas and accumulation steps.
+        if not self._sampled:
+            # Only average the accumulated gradients.
+            for group in self._optimizer.param_groups:
+                for param in group["params"]:
+                    if param.grad is not None:
+                        param.grad.div_(self._accum_count)
+            # Gradients of the next sampled step are not consecutive with
+            # those of the last sampled step.
+            self._prev_grads = None
+            self._skipped_steps += 1
+            return
+        start = time.time()
+        with adaptdl.trace.span("gns"):
+            self._update_estimates()
+        profile_overhead(time.time() - start)
+
+    def _update_estimates(self):
         if self._num_replicas > 1:
             self._async_op.wait()
         grads = []
@@ -244,6 +293,11 @@ class GradientNoiseScale(object):
         if count > 1:
             # Average local squared-norm samples.
             local_sqr = self._local_sqr.cpu().numpy() / count
+            if self._local_bszs is not None:
+                # Local gradients from smaller batches are noisier. Use the
+                # number of equal-sized batches with the same total noise.
+                local_bszs = np.asarray(self._local_bszs, dtype=float)
+                count *= np.mean(local_bszs) * np.mean(1.0 / local_bszs)
             # Gradient is squared in local_sqr, so need to square the
             # mixed precision scale as well
             local_sqr = (local_sqr / mixed_precision_scale ** 2)
@@ -268,7 +322,9 @@ class GradientNoiseScale(object):
         if count > 1:
             grad_sqr = (count * total_sqr - local_sqr) / (count - 1)
             grad_var = (local_sqr - total_sqr) * scale / (count - 1)
-            theta = self._smoothing ** scale
+            # Each update stands for the optimizer steps skipped before it.
+            theta = self._smoothing ** (scale * (self._skipped_steps + 1))
+            self._skipped_steps = 0
             self._update_avg('sqr_avg', grad_sqr, theta)
             self._update_avg('var_avg', grad_var, theta)
 
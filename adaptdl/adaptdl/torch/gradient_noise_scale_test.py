@@ -64,3 +64,30 @@ def test_nan():
             f"non-finite adascale parameters:"
             f"{gns.sqr_avg()}, {gns.var_avg()}"
         )
+
+
+def test_unsampled():
+    params = torch.tensor([1.0, 2.0], requires_grad=True)
+    sgd = torch.optim.SGD([params], lr=0.1)
+    adp = Mock(require_backward_grad_sync=True)
+    gns = GradientNoiseScale(adp, sgd, accum_scale=1.0, num_replicas=1)
+
+    def step(sampled, targets):
+        gns.set_sampled(sampled)
+        gns.reset_accumulation()
+        for idx, target in enumerate(targets):
+            adp.require_backward_grad_sync = idx == len(targets) - 1
+            ((params - target) ** 2).sum().backward()
+
+    step(True, [0.0])
+    step(True, [1.0])
+    sqr_avg, var_avg = gns.sqr_avg(), gns.var_avg()
+    # Accumulated gradients are still averaged, but estimates are unchanged.
+    step(False, [0.0, 2.0])
+    assert torch.allclose(params.grad, torch.tensor([0.0, 2.0]))
+    assert gns.sqr_avg() == sqr_avg and gns.var_avg() == var_avg
+    # The next sampled step is not differenced against an older one.
+    step(True, [3.0])
+    assert gns.sqr_avg() == sqr_avg and gns.var_avg() == var_avg
+    step(True, [4.0])
+    assert gns.sqr_avg() != sqr_avg
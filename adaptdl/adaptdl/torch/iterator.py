@@ -15,7 +15,10 @@
 
 import math
 import logging
+import os
+import tempfile
 
+import torch
 from torchtext.data import BPTTIterator
 from torchtext.data.dataset import Dataset
 from torchtext.data.batch import Batch
@@ -25,15 +28,16 @@ import adaptdl.collective
 import adaptdl.env
 from adaptdl.torch.data import AdaptiveDataLoaderMixin
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
+LOG.setLevel(adaptdl.env.log_level())
 
 
 class AdaptiveBPTTIterator(BPTTIterator, AdaptiveDataLoaderMixin):
     def __init__(self, dataset, batch_size, bptt_len, **kwargs):
         max_batch_size = kwargs.pop("max_batch_size", None)
         local_bsz_bounds = kwargs.pop("local_bsz_bounds", None)
+        # Name to persist the numericalized dataset under in the share path.
+        self.cache_name = kwargs.pop("cache_name", None)
 
         BPTTIterator.__init__(self, dataset=dataset, batch_size=batch_size,
                               bptt_len=bptt_len, **kwargs)
@@ -46,6 +50,9 @@ class AdaptiveBPTTIterator(BPTTIterator, AdaptiveDataLoaderMixin):
             self._elastic.autoscale_batch_size(max_batch_size,
                                                local_bsz_bounds)
 
+        self._tokens = None  # Numericalized text, padded to any batch size.
+        self._num_tokens = None  # Number of tokens before padding.
+
     # The start index changes when there is a rescaling. We recompute a new
     # start index based on how much we covered before the restart
     def _recompute_start(self, prev_curr, prev_end, curr_end):
@@ -53,6 +60,44 @@ class AdaptiveBPTTIterator(BPTTIterator, AdaptiveDataLoaderMixin):
             return prev_curr
         return math.ceil(prev_curr * curr_end / prev_end)
 
+    def _numericalize(self, TEXT):
+        # Numericalizes the text once, or loads it from the share path.
+        text = self.dataset[0].text
+        path = adaptdl.env.share_path()
+        if self.cache_name is None or path is None:
+            return TEXT.numericalize([text]).view(-1)
+        path = os.path.join(path, "adaptdl-cache", self.cache_name + ".bin")
+        try:
+            return torch.from_file(path, size=os.path.getsize(path) // 8,
+                                   dtype=torch.int64)
+        except (FileNotFoundError, RuntimeError):
+            pass
+        tokens = TEXT.numericalize([text]).view(-1).to(torch.int64)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write and rename so other replicas never load a partial file.
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            tokens.numpy().tofile(f)
+        os.replace(tmpname, path)
+        return tokens
+
+    def _data(self, TEXT):
+        # Returns the numericalized text as a (length, batch_size) view,
+        # padded so that length * batch_size is at least the number of tokens.
+        if self._tokens is None:
+            self._tokens = self._numericalize(TEXT)
+            if self.device is not None:
+                self._tokens = self._tokens.to(self.device)
+            self._num_tokens = self._tokens.numel()
+        size = (math.ceil(self._num_tokens / self.batch_size) *
+                self.batch_size)
+        if self._tokens.numel() < size:
+            pad = TEXT.numericalize([[TEXT.pad_token]]).view(-1)
+            self._tokens = torch.cat([
+                self._tokens[:self._num_tokens],
+                pad.to(self._tokens).expand(size - self._num_tokens)])
+        return self._tokens[:size].view(self.batch_size, -1).t()
+
     def __iter__(self):
         with self._elastic.context():
             if self._elastic.skipdone():
@@ -60,15 +105,9 @@ class AdaptiveBPTTIterator(BPTTIterator, AdaptiveDataLoaderMixin):
 
             self.batch_size = self._elastic._sync_local_bsz()
 
-            text = self.dataset[0].text
             TEXT = self.dataset.fields['text']
             TEXT.eos_token = None
-            text = text + ([TEXT.pad_token] *
-                           int(math.ceil(len(text) / self.batch_size) *
-                               self.batch_size - len(text)))
-            data = TEXT.numericalize(
-                [text], device=self.device)
-            data = data.view(self.batch_size, -1).t().contiguous()
+            data = self._data(TEXT)
             dataset = Dataset(examples=self.dataset.examples, fields=[
                 ('text', TEXT), ('target', TEXT)])
             end = data.size(0)  # current length of dataset
@@ -109,8 +148,10 @@ class AdaptiveBPTTIterator(BPTTIterator, AdaptiveDataLoaderMixin):
                         batch_text = data[i:i + seq_len]
                         batch_target = data[i + 1:i + 1 + seq_len]
                         if TEXT.batch_first:
-                            batch_text = batch_text.t().contiguous()
-                            batch_target = batch_target.t().contiguous()
+                            batch_text = batch_text.t()
+                            batch_target = batch_target.t()
+                        batch_text = batch_text.contiguous()
+                        batch_target = batch_target.contiguous()
                         yield Batch.fromvars(
                             dataset, self.batch_size,
                             text=batch_text,
@@ -27,6 +27,7 @@ from torch.nn.parallel import DistributedDataParallel
 
 import adaptdl.checkpoint
 import adaptdl.env
+import adaptdl.trace
 import adaptdl.utils
 from adaptdl.torch.data import current_dataloader
 from adaptdl.torch.scaling_rules import AdaScale, AdamScale, ScalingRuleBase
@@ -84,6 +85,14 @@ class AdaptiveDataParallel(DistributedDataParallel):
             self.gns = GradientNoiseScale(self, optimizer, mp_scaler=mp_scaler)
         self.scaling_rule.initialize(self, optimizer, patch_optimizer=True)
 
+        # Scale local gradients before they are averaged between replicas, so
+        # the average is weighted by heterogeneous local batch sizes. Must be
+        # registered after the GradientNoiseScale hooks, which expect the
+        # unscaled local gradients.
+        self._grad_scale = 1.0
+        for param in model.parameters():
+            param.register_hook(self._scale_grad_hook)
+
         self._state = _AdaptiveDataParallelState(
             model, optimizer, lr_scheduler, mp_scaler, name)
         adaptdl.checkpoint.load_state(self._state)
@@ -98,8 +107,19 @@ class AdaptiveDataParallel(DistributedDataParallel):
             accum_scale = (dataloader.current_local_bsz *
                            adaptdl.env.num_replicas() / dataloader.batch_size)
             self.gns.set_accum_scale(accum_scale)
+            self.gns.set_local_bszs(dataloader.local_bszs)
+            self.gns.set_sampled(dataloader.sampled)
+            self._grad_scale = (dataloader.local_bsz /
+                                dataloader.current_local_bsz)
+        else:
+            self.gns.set_sampled(True)
+            self._grad_scale = 1.0
         return super().forward(*args, **kwargs)
 
+    def _scale_grad_hook(self, grad):
+        if self._grad_scale != 1.0:
+            return grad * self._grad_scale
+
     @adaptdl.utils.print_exc
     def _backward_hook(self, param, grad):
         # This method should be invoked once for each parameter during the
@@ -141,9 +161,11 @@ class AdaptiveDataParallel(DistributedDataParallel):
             sync_end = torch.cuda.Event(enable_timing=True)
             sync_end.record()
             sync_end.synchronize()
-            profile_sync_time(self._sync_start.elapsed_time(sync_end) / 1e3)
+            sync_time = self._sync_start.elapsed_time(sync_end) / 1e3
         else:
-            profile_sync_time(time.time() - self._sync_start)
+            sync_time = time.time() - self._sync_start
+        profile_sync_time(sync_time)
+        adaptdl.trace.record("grad_sync", time.time() - sync_time, sync_time)
 
         dataloader = current_dataloader()
         if dataloader is None:
@@ -19,6 +19,7 @@ import warnings
 
 from types import MethodType
 
+import adaptdl.trace
 from adaptdl.torch.data import current_dataloader
 
 
@@ -92,7 +93,8 @@ class ScalingRuleBase(object):
         """
         @functools.wraps(self._optimizer.step)
         def step_wrapper(optim, *args, **kwargs):
-            return self.step(*args, **kwargs)
+            with adaptdl.trace.span("optimizer"):
+                return self.step(*args, **kwargs)
 
         @functools.wraps(self._optimizer.zero_grad)
         def zero_wrapper(optim, *args, **kwargs):
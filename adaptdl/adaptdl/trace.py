@@ -0,0 +1,181 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module records a timeline of the phases of each training step, such as
+waiting for input data, gradient synchronization, optimizer steps, collective
+operations, and checkpoints. Tracing is opt-in, enabled by setting the
+environment variable ``ADAPTDL_TRACE_STEPS`` to the number of most recent steps
+to keep. The timeline is written in the Chrome trace format, one file per
+replica and restart, which can be opened in Perfetto or ``chrome://tracing``.
+Timestamps are wall-clock times, so the files written by different replicas
+and restarts of the same job can be loaded together.
+"""
+
+import atexit
+import collections
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import adaptdl.env
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(adaptdl.env.log_level())
+
+# Upper bound on the average number of events recorded per step, used to size
+# the ring buffer from the number of steps to keep.
+_EVENTS_PER_STEP = 32
+
+_TRACER = None
+_TRACER_LOCK = threading.Lock()
+
+
+class _NullSpan(object):
+    # Shared no-op context manager returned by span() when tracing is
+    # disabled, to avoid any overhead beyond a function call.
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Tracer(object):
+    def __init__(self, steps):
+        self.events = collections.deque(maxlen=steps * _EVENTS_PER_STEP)
+        self.rank = adaptdl.env.replica_rank()
+        self.restart = adaptdl.env.num_restarts()
+
+    def record(self, name, start, duration, category, args):
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": start * 1e6, "dur": duration * 1e6,
+                 "pid": self.rank, "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        self.events.append(event)  # Atomic, oldest events are dropped.
+
+    def flush(self):
+        path = adaptdl.env.tensorboard_logdir() or \
+            adaptdl.env.checkpoint_path()
+        if path is None:
+            return None
+        metadata = {"name": "process_name", "ph": "M", "pid": self.rank,
+                    "args": {"name": "replica {} (restart {})"
+                             .format(self.rank, self.restart)}}
+        trace = {"traceEvents": [metadata] + list(self.events),
+                 "displayTimeUnit": "ms"}
+        filename = os.path.join(path, "adaptdl-trace-{}-{}.json"
+                                .format(self.restart, self.rank))
+        # Write to a temporary file and rename it, so a trace is never left
+        # partially written if the replica is killed while flushing.
+        tmpname = None
+        try:
+            os.makedirs(path, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=path, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(trace, f)
+            os.replace(tmpname, filename)
+        except OSError as exc:
+            LOG.warning("Failed to write trace %s: %s", filename, exc)
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+            return None
+        return filename
+
+
+def _tracer():
+    global _TRACER
+    if _TRACER is None:
+        with _TRACER_LOCK:
+            if _TRACER is None:
+                steps = adaptdl.env.trace_steps()
+                _TRACER = _Tracer(steps) if steps > 0 else False
+                if _TRACER:
+                    atexit.register(flush)
+    return _TRACER
+
+
+def enabled():
+    """
+    Returns:
+        bool: Whether tracing is enabled for the current replica.
+    """
+    return bool(_tracer())
+
+
+def record(name, start, duration, category="step", **args):
+    """
+    Records a phase which was already measured, e.g. asynchronously. Does
+    nothing if tracing is disabled.
+
+    Arguments:
+        name (str): Name of the phase.
+        start (float): Wall-clock time the phase started, in seconds.
+        duration (float): Duration of the phase, in seconds.
+        category (str): Category of the phase.
+        **args: Additional JSON-serializable values shown with the phase.
+    """
+    tracer = _tracer()
+    if tracer:
+        tracer.record(name, start, duration, category, args)
+
+
+@contextlib.contextmanager
+def _span(tracer, name, category, args):
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.record(name, start, time.time() - start, category, args)
+
+
+def span(name, category="step", **args):
+    """
+    Context manager which records the time spent within it as a phase. Does
+    nothing if tracing is disabled.
+
+    Arguments:
+        name (str): Name of the phase.
+        category (str): Category of the phase.
+        **args: Additional JSON-serializable values shown with the phase.
+    """
+    tracer = _tracer()
+    if not tracer:
+        return _NULL_SPAN
+    return _span(tracer, name, category, args)
+
+
+def flush():
+    """
+    Writes the recorded phases of the current replica as a Chrome trace to the
+    TensorBoard log directory, or the checkpoint path if unset. Invoked
+    automatically whenever a checkpoint is saved and when the replica exits.
+
+    Returns:
+        str: Path of the written trace, or ``None`` if tracing is disabled or
+            there is nowhere to write it.
+    """
+    tracer = _tracer()
+    if tracer:
+        return tracer.flush()
+    return None
@@ -0,0 +1,77 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+import adaptdl.trace
+from adaptdl.conftest import elastic_multiprocessing
+
+
+def test_disabled(monkeypatch, tmp_path):
+    monkeypatch.delenv("ADAPTDL_TRACE_STEPS", raising=False)
+    monkeypatch.setenv("ADAPTDL_CHECKPOINT_PATH", str(tmp_path))
+    monkeypatch.setattr(adaptdl.trace, "_TRACER", None)
+    with adaptdl.trace.span("step"):
+        pass
+    adaptdl.trace.record("data_wait", 0.0, 1.0)
+    assert not adaptdl.trace.enabled()
+    assert adaptdl.trace.flush() is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_ring_buffer(monkeypatch, tmp_path):
+    monkeypatch.setenv("ADAPTDL_TRACE_STEPS", "1")
+    monkeypatch.setenv("ADAPTDL_TENSORBOARD_LOGDIR", str(tmp_path))
+    monkeypatch.setattr(adaptdl.trace, "_TRACER", None)
+    for idx in range(2 * adaptdl.trace._EVENTS_PER_STEP):
+        adaptdl.trace.record("data_wait", idx, 0.5, idx=idx)
+    with adaptdl.trace.span("allreduce", "collective"):
+        pass
+    filename = adaptdl.trace.flush()
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    assert events[0]["ph"] == "M"
+    events = events[1:]
+    # Only the most recent events are kept.
+    assert len(events) == adaptdl.trace._EVENTS_PER_STEP
+    assert events[-1]["name"] == "allreduce"
+    assert events[-1]["cat"] == "collective"
+    assert events[-2]["args"]["idx"] == 2 * len(events) - 1
+    assert events[-2]["ts"] == (2 * len(events) - 1) * 1e6
+    assert events[-2]["dur"] == 0.5e6
+
+
+@elastic_multiprocessing
+def test_checkpoint():
+    import os
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    from adaptdl.env import checkpoint_path, num_restarts, replica_rank
+    os.environ["ADAPTDL_TRACE_STEPS"] = "10"
+    # Replicas are forked from the test process, so drop the tracer and the
+    # collective which earlier tests may have set up in it.
+    adaptdl.trace._TRACER = None
+    adaptdl.collective._REDUCER = None
+    adaptdl.collective.initialize("0.0.0.0")
+    adaptdl.collective.allreduce(1)
+    adaptdl.checkpoint.save_all_states()
+    filename = os.path.join(checkpoint_path(), "adaptdl-trace-{}-{}.json"
+                            .format(num_restarts(), replica_rank()))
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    assert [event["name"] for event in events[1:]] == \
+        ["allreduce", "checkpoint"]
+    assert all(event["pid"] == replica_rank() for event in events)
+    return [2, 0][num_restarts()]
@@ -52,6 +52,7 @@ trainloader.autoscale_batch_size(4096, local_bsz_bounds=(32, 1024),
 
 validset = torchvision.datasets.CIFAR10(root="/mnt", train=False, download=False, transform=transform_test)
 validloader = adaptdl.torch.AdaptiveDataLoader(validset, batch_size=100, shuffle=False, num_workers=2)
+validloader.autoscale_eval_batch_size(1024)
 
 # Model
 print('==> Building model..')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the per-step overhead of AdaptDL relative to plain
+# DistributedDataParallel, using small models on CPU with the gloo backend so
+# that the bookkeeping done on every step is not hidden by compute time.
+
+import argparse
+import os
+import time
+
+import portpicker
+import torch
+import torch.distributed
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def build(args):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Linear(args.features, args.hidden), torch.nn.ReLU(),
+        torch.nn.Linear(args.hidden, 1))
+    num_samples = (args.warmup + args.steps) * args.batch_size
+    dataset = TensorDataset(torch.randn(num_samples, args.features),
+                            torch.randn(num_samples, 1))
+    return model, dataset
+
+
+def train(model, optimizer, dataloader, args):
+    # Returns the average duration of each step after the warm-up steps.
+    start = None
+    for idx, (inputs, targets) in enumerate(dataloader):
+        if idx == args.warmup:
+            start = time.time()
+        optimizer.zero_grad()
+        loss = torch.nn.functional.mse_loss(model(inputs), targets)
+        loss.backward()
+        optimizer.step()
+    return (time.time() - start) / (idx + 1 - args.warmup)
+
+
+def run_ddp(rank, args, port, results):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank,
+        world_size=args.replicas)
+    model, dataset = build(args)
+    model = DistributedDataParallel(model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    sampler = DistributedSampler(dataset, shuffle=True)
+    dataloader = DataLoader(dataset, args.batch_size // args.replicas,
+                            sampler=sampler, drop_last=True)
+    step_time = train(model, optimizer, dataloader, args)
+    if rank == 0:
+        results.put(step_time)
+
+
+def run_adaptdl(rank, args, port, budget, results):
+    os.environ.update({
+        "ADAPTDL_MASTER_ADDR": "127.0.0.1",
+        "ADAPTDL_MASTER_PORT": str(port),
+        "ADAPTDL_NUM_REPLICAS": str(args.replicas),
+        "ADAPTDL_REPLICA_RANK": str(rank),
+        "ADAPTDL_OVERHEAD_BUDGET": str(budget),
+    })
+    os.environ.pop("ADAPTDL_CHECKPOINT_PATH", None)
+    import adaptdl.torch
+    adaptdl.torch.init_process_group("gloo")
+    model, dataset = build(args)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    model = adaptdl.torch.AdaptiveDataParallel(model, optimizer)
+    dataloader = adaptdl.torch.AdaptiveDataLoader(
+        dataset, args.batch_size, shuffle=True, drop_last=True)
+    for epoch in adaptdl.torch.remaining_epochs_until(1):
+        step_time = train(model, optimizer, dataloader, args)
+    if rank == 0:
+        results.put(step_time)
+
+
+def measure(target, args, *extra):
+    context = mp.get_context("spawn")
+    results = context.SimpleQueue()
+    port = portpicker.pick_unused_port()
+    mp.spawn(target, (args, port) + extra + (results,),
+             nprocs=args.replicas)
+    return results.get()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--features", type=int, default=32)
+    parser.add_argument("--hidden", type=int, default=64)
+    parser.add_argument("--budgets", type=float, nargs="+",
+                        default=[0.0, 0.05],
+                        help="overhead budgets to run AdaptDL with, "
+                             "0 does the bookkeeping on every step")
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    ddp_time = measure(run_ddp, args)
+    print("{:<24} {:>10} {:>10}".format("mode", "ms/step", "overhead"))
+    print("{:<24} {:>10.3f} {:>10}".format("ddp", ddp_time * 1e3, "-"))
+    for budget in args.budgets:
+        step_time = measure(run_adaptdl, args, budget)
+        print("{:<24} {:>10.3f} {:>9.1f}%".format(
+            f"adaptdl (budget={budget})", step_time * 1e3,
+            (step_time / ddp_time - 1) * 100))
@@ -2,6 +2,7 @@
 
 import argparse
 import json
+import os
 import time
 from kubernetes import client, config, watch
 
@@ -9,7 +10,12 @@ from kubernetes import client, config, watch
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("output", type=str, help="path to output file")
+    parser.add_argument("--checkpoint-root", type=str, default=None,
+                        help="directory containing the checkpoint path of "
+                             "each job, to also record its latest metrics")
     args = parser.parse_args()
+    if args.checkpoint_root is not None:
+        from adaptdl.metrics_sink import read_metrics
 
     config.load_kube_config()
     objs_api = client.CustomObjectsApi()
@@ -32,6 +38,13 @@ if __name__ == "__main__":
                 "submission_time": obj["metadata"]["creationTimestamp"],
                 "completion_time": obj.get("status", {}).get("completionTimestamp", None),
             })
+            if args.checkpoint_root is not None:
+                # Latest records written by the job's metrics sinks.
+                path = os.path.join(args.checkpoint_root, obj["metadata"]["name"])
+                for name in ["train", "valid"]:
+                    records = read_metrics(path, name)
+                    record["submitted_jobs"][-1][name + "_metrics"] = \
+                        records[-1] if records else None
         with open(args.output, "a") as f:
             json.dump(record, f)
             f.write("\n")
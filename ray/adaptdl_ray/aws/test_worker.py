@@ -15,6 +15,8 @@
 
 import ray
 import pytest
+from adaptdl_ray.aws.utils import \
+    _checkpoint_obj_to_dir, _serialize_checkpoint
 from adaptdl_ray.aws.worker import run_adaptdl, listen_for_spot_termination
 import asyncio
 import os
@@ -148,6 +150,21 @@ def test_worker(ray_fix):
         assert result == 5
 
 
+def test_checkpoint_chunks(ray_fix, tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    contents = {"empty": b"", "small": b"abc", "sub/large": os.urandom(1000)}
+    for name, data in contents.items():
+        (src / name).write_bytes(data)
+    checkpoint = _serialize_checkpoint(str(src), chunk_size=100)
+    assert set(checkpoint) == set(contents)
+    assert len(checkpoint["sub/large"]) == 10
+    dst = tmp_path / "dst"
+    _checkpoint_obj_to_dir(str(dst), checkpoint, prefetch=2)
+    for name, data in contents.items():
+        assert (dst / name).read_bytes() == data
+
+
 async def test_spot_instance_termination(ray_fix):
     endpoint = TerminationEndpoint.remote()
     endpoint.start_server.remote()
@@ -16,25 +16,72 @@
 from enum import Enum
 import os
 
+import ray
+
+
+# Checkpoint files are moved through the object store in chunks of this size,
+# so neither the sending nor the receiving worker holds a whole file in memory.
+CHECKPOINT_CHUNK_SIZE = 16 * 1024 * 1024
+# Number of chunks a receiving worker fetches ahead of the one being written.
+CHECKPOINT_PREFETCH_CHUNKS = 4
+
 
 # Adapted from Ray Tune
-def _checkpoint_obj_to_dir(checkpoint_dir, checkpoint_obj):
+def _checkpoint_obj_to_dir(checkpoint_dir, checkpoint_obj,
+                           prefetch=CHECKPOINT_PREFETCH_CHUNKS):
+    """
+    Write a checkpoint object produced by `_serialize_checkpoint` into
+    `checkpoint_dir`. Chunks are written as soon as they arrive, and at most
+    `prefetch` chunks beyond the one being written are pulled to this node.
+    """
     for (path, data) in checkpoint_obj.items():
         file_path = os.path.join(checkpoint_dir, path)
         directory = os.path.dirname(file_path)
         os.makedirs(directory, exist_ok=True)
         with open(file_path, "wb") as f:
-            f.write(data)
+            if isinstance(data, bytes):
+                # Checkpoint objects from older workers hold raw bytes.
+                f.write(data)
+                continue
+            for idx, chunk_ref in enumerate(data):
+                window = data[idx + 1:idx + 1 + prefetch]
+                if window:
+                    # Start pulling the next chunks while this one is written.
+                    ray.wait(window, num_returns=len(window), timeout=0,
+                             fetch_local=True)
+                f.write(ray.get(chunk_ref))
     return
 
 
-def _serialize_checkpoint(checkpoint_dir):
+def _serialize_checkpoint(checkpoint_dir, owner=None,
+                          chunk_size=CHECKPOINT_CHUNK_SIZE):
+    """
+    Place the contents of `checkpoint_dir` into the object store.
+
+    Arguments:
+        checkpoint_dir (str): Directory to serialize.
+        owner (ray.actor.ActorHandle): Actor which should own the chunks, so
+            they outlive the worker which created them.
+        chunk_size (int): Maximum number of bytes per object.
+
+    Returns:
+        dict: Mapping from each relative file path to the list of ObjectRefs
+            holding its contents in order.
+    """
     data = {}
     for basedir, _, file_names in os.walk(checkpoint_dir):
         for file_name in file_names:
             path = os.path.join(basedir, file_name)
+            chunks = []
             with open(path, "rb") as f:
-                data[os.path.relpath(path, checkpoint_dir)] = f.read()
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk and chunks:
+                        break
+                    chunks.append(ray.put(chunk, _owner=owner))
+                    if len(chunk) < chunk_size:
+                        break
+            data[os.path.relpath(path, checkpoint_dir)] = chunks
     return data
 
 
@@ -136,10 +136,11 @@ def run_adaptdl(job_key, job_uid, rank, replicas,
         # next generation of workers can resume
         logging.info(f"Worker {rank} received system exit")
         if rank == 0:
-            checkpoint_obj = _serialize_checkpoint(checkpoint_path)
-            logging.info("checkpoint created")
-            checkpoint_obj_ref = ray.put(checkpoint_obj)
+            # Chunks are owned by the controller so they survive this worker.
+            checkpoint_obj = _serialize_checkpoint(
+                checkpoint_path, owner=controller)
             logging.info("checkpoint placed")
+            checkpoint_obj_ref = ray.put(checkpoint_obj)
             result = ray.get(
                 controller.register_checkpoint.remote(checkpoint_obj_ref))
             logging.info(f"checkpoint registered: {result}")
@@ -25,6 +25,8 @@ from adaptdl_sched.policy.pollux import PolluxPolicy
 from adaptdl_sched.policy.dummy import DummyPolicy
 from adaptdl_sched.policy.speedup import SpeedupFunction
 from adaptdl_sched.policy.utils import JobInfo, NodeInfo
+from adaptdl_sched.prior_store import (PriorStore, apply_prior, get_hardware,
+                                       get_resource_type)
 from adaptdl_sched.resources import (get_node_unrequested, get_pod_requests,
                                      set_default_resources)
 from adaptdl_sched.utils import patch_job_status
@@ -43,6 +45,9 @@ class AdaptDLAllocator(object):
         self._custom_resource = ("adaptdl.petuum.com", "v1",
                                  "", "adaptdljobs")
         self._cluster_expander = expander
+        # Performance model priors shared between jobs of each application.
+        self._prior_store = PriorStore()
+        self._node_hardware = {}  # Node name -> hardware, see get_hardware.
 
         # Select the policy to use
         # Options: "pollux", "dummy"
@@ -178,6 +183,7 @@ class AdaptDLAllocator(object):
                     LOG.warning(f"node {node.metadata.name} "
                                 "has no free pods available.")
                 node_infos[node.metadata.name] = NodeInfo(resources, False)
+            self._node_hardware[node.metadata.name] = get_hardware(node)
         # For cluster autoscaling: to determine if additional nodes would be
         # helpful, add a few "virtual" nodes which only become available in
         # "eta" seconds. Currently, we only consider as many virtual nodes as
@@ -196,6 +202,17 @@ class AdaptDLAllocator(object):
             set_default_resources(job["spec"]["template"]["spec"])
         resources = get_pod_requests(job["spec"]["template"]["spec"])
         hints = job.get("status", {}).get("train", {})
+        job_name = job["metadata"]["name"]
+        job_application = job_name.split("-")[0]
+        if job_application not in APPLICATION_NAMES:
+            raise ValueError(f"Unknown application: {job_application}")
+        # Until the job has profiled enough, its performance model is based on
+        # other jobs of the same application.
+        prior = self._prior_store.get(
+            job_application, get_resource_type(resources),
+            self._get_job_hardware(job),
+            exclude=(job["metadata"]["namespace"], job_name))
+        hints = apply_prior(hints, prior)
         max_replicas = max(2 * hints.get("maxProfiledReplicas", 0), 1)
         if job["spec"].get("maxReplicas"):
             max_replicas = min(max_replicas, job["spec"]["maxReplicas"])
@@ -213,7 +230,7 @@ class AdaptDLAllocator(object):
                     max_replicas = int(max_batch_size / min_local_bsz)
             perf_params = PerfParams(*[hints["perfParams"][k]
                                        for k in PERF_PARAMS.keys()])
-            if "gradParams" in hints:
+            if hints.get("gradParams"):
                 grad_params = GradParams(hints["gradParams"]["norm"],
                                          hints["gradParams"]["var"])
             else:
@@ -229,11 +246,7 @@ class AdaptDLAllocator(object):
             speedup_fn = lambda n, r: r  # noqa: E731
         creation_ts = dateutil.parser.isoparse(
                 job["metadata"]["creationTimestamp"])
-        
-        job_name = job["metadata"]["name"]
-        job_application = job_name.split("-")[0]
-        if job_application not in APPLICATION_NAMES:
-            raise ValueError(f"Unknown application: {job_application}")
+
         job_epoch = hints.get("epoch", None)
         if job_epoch is None:
             raise ValueError(f"Epoch is not set for job: {job_name}")
@@ -242,14 +255,61 @@ class AdaptDLAllocator(object):
                 max_replicas, preemptible)
         job_info.epoch = job_epoch
         job_info.application = job_application
+        job_info.restart_cost = self._get_restart_cost(job)
+        job_info.avoid_nodes = frozenset(hints.get("slowNodes") or ())
         return job_info
 
+    def _get_job_hardware(self, job):
+        # Hardware of the first node allocated to the job, or None.
+        allocation = job.get("status", {}).get("allocation")
+        if not allocation:
+            return None
+        return self._node_hardware.get(allocation[0])
+
+    def _observe_job(self, job):
+        # Records the hints of a running or completed job as a prior for
+        # other jobs of the same application.
+        application = job["metadata"]["name"].split("-")[0]
+        if application not in APPLICATION_NAMES:
+            return
+        spec = set_default_resources(job["spec"]["template"]["spec"])
+        self._prior_store.observe(
+            (job["metadata"]["namespace"], job["metadata"]["name"]),
+            application, get_resource_type(get_pod_requests(spec)),
+            self._get_job_hardware(job),
+            job.get("status", {}).get("train", {}))
+
+    def _get_restart_cost(self, job):
+        # Total measured time (in seconds) taken by the latest restart of the
+        # job, or None if the job has not reported a complete restart yet.
+        # Trainer-side phases are reported by the job in its hints, and the
+        # pod deletion and creation phases are measured by the controller.
+        status = job.get("status", {})
+        trainer_times = status.get("train", {}).get("restartTimes") or {}
+        controller_times = status.get("restartTimes") or {}
+        if "first_step" not in trainer_times or \
+                "create" not in controller_times:
+            return None
+        # Pod deletion waits for the trainer to save its checkpoint and exit,
+        # so it already includes the signal and save phases.
+        stop_time = max(controller_times.get("delete", 0.0),
+                        trainer_times.get("signal", 0.0) +
+                        trainer_times.get("save", 0.0))
+        start_time = controller_times["create"] + sum(
+            trainer_times.get(key, 0.0) for key in
+            ("discover", "collective_init", "torch_init", "load_state",
+             "first_step"))
+        return stop_time + start_time
+
     async def _find_jobs_and_allocations(self):
         job_list = await self._objs_api.list_namespaced_custom_object(
             "adaptdl.petuum.com", "v1", "", "adaptdljobs")
         job_infos = {}
         allocations = {}
 
+        for job in job_list["items"]:
+            self._observe_job(job)
+
         for job in job_list["items"]:
             if job.get("status", {}).get("phase") \
                     not in ["Pending", "Running", "Starting", "Stopping"]:
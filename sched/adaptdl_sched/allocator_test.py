@@ -0,0 +1,68 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from unittest import mock
+
+import pytest
+
+from adaptdl.sched_hints import PERF_PARAMS
+from adaptdl_sched.allocator import AdaptDLAllocator
+
+
+@pytest.fixture
+def allocator():
+    with mock.patch("kubernetes_asyncio.client.CoreV1Api"), \
+            mock.patch("kubernetes_asyncio.client.CustomObjectsApi"):
+        yield AdaptDLAllocator(None)
+
+
+def _job(name, hints, allocation=None):
+    container = {"name": "main",
+                 "resources": {"limits": {"nvidia.com/gpu": 1}}}
+    return {"metadata": {"name": name, "namespace": "default",
+                         "creationTimestamp": "2020-01-01T00:00:00Z"},
+            "spec": {"template": {"spec": {"containers": [container]}}},
+            "status": {"train": hints, "allocation": allocation}}
+
+
+def _hints(**kwargs):
+    hints = {"epoch": 1, "initBatchSize": 128, "maxProfiledReplicas": 2,
+             "perfParams": {key: 1.0 for key in PERF_PARAMS}}
+    hints.update(kwargs)
+    return hints
+
+
+def test_job_info_prior(allocator):
+    # The performance model of new jobs is taken from other jobs of the same
+    # application, even if they have not measured their gradients yet.
+    allocator._observe_job(_job("cifar10-a", _hints()))
+    job_info = allocator._get_job_info(
+        _job("cifar10-b", {"epoch": 0, "initBatchSize": 128}))
+    assert job_info.max_replicas == 4
+    assert job_info.speedup_fn(1, 1) == pytest.approx(1.0)
+    allocator._observe_job(_job("cifar10-a", _hints(
+        gradParams={"norm": 1.0, "var": 1.0})))
+    job_info = allocator._get_job_info(
+        _job("cifar10-b", {"epoch": 0, "initBatchSize": 128}))
+    assert job_info.speedup_fn(1, 1) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("allocation", [None, [], ["node-0"]])
+def test_job_info_input_bound(allocator, allocation):
+    # Input-bound jobs are only reported, each replica runs its own input
+    # pipeline so they are not limited to their current number of replicas.
+    job_info = allocator._get_job_info(
+        _job("cifar10-a", _hints(inputBound=True), allocation))
+    assert job_info.max_replicas == 4
@@ -16,6 +16,7 @@
 import asyncio
 import collections
 import copy
+import dateutil.parser
 import jsonpatch
 import kubernetes_asyncio as kubernetes
 import logging
@@ -156,6 +157,8 @@ class AdaptDLController(object):
             elif self._count_ready_pods(pods) == replicas:
                 # all pods are running
                 job["status"]["phase"] = "Running"
+                self._record_restart_time(job, "create", "Starting",
+                                          current_ts)
         elif phase == "Running":
             if self._detect_restart(pods, allocation) or \
                     not pods:
@@ -168,6 +171,10 @@ class AdaptDLController(object):
             else:
                 # all pods successfully deleted
                 job["status"]["phase"] = "Pending"
+                self._record_restart_time(job, "delete", "Stopping",
+                                          current_ts)
+        if job["status"]["phase"] != phase:
+            job["status"]["phaseTimestamp"] = current_ts
         # Set replicas and ready replicas.
         if allocation:
             job["status"]["replicas"] = len(allocation)
@@ -183,6 +190,18 @@ class AdaptDLController(object):
             LOG.info("Patch AdaptDLJob %s: %s", job_name, patch)
             await patch_job_status(self._objs_api, namespace, job_name, patch)
 
+    def _record_restart_time(self, job, key, phase, current_ts):
+        # Record how long the job spent in the given phase, which is ending,
+        # as part of the time taken to restart the job.
+        phase_ts = job["status"].get("phaseTimestamp")
+        if phase_ts is None:
+            return
+        if isinstance(phase_ts, str):
+            phase_ts = dateutil.parser.isoparse(phase_ts)
+        restart_times = dict(job["status"].get("restartTimes") or {})
+        restart_times[key] = (current_ts - phase_ts).total_seconds()
+        job["status"]["restartTimes"] = restart_times
+
     def _count_ready_pods(self, pods):
         count = 0
         for pod in pods:
@@ -381,6 +400,10 @@ class AdaptDLController(object):
                 "name": "ADAPTDL_MASTER_PORT",
                 "value": str(47000 + group),
             })
+            container["env"].append({
+                "name": "ADAPTDL_NODE_NAME",
+                "value": node.metadata.name,
+            })
             container["env"].append({
                 "name": "ADAPTDL_NUM_NODES",
                 "value": str(len(set(allocation))),
@@ -60,7 +60,9 @@ class DummyPolicy(object):
             # Calculate total GPUs this job had in its previous allocation
             gpus_in_prev_alloc = len(prev_alloc) * gpus_per_replica
                 
-            if gpus_in_prev_alloc == self._num_gpus_per_job:
+            # Move jobs off nodes they reported to be slow.
+            if gpus_in_prev_alloc == self._num_gpus_per_job and \
+                    not job_info.avoid_nodes.intersection(prev_alloc):
                 # Check if this previous allocation can be preserved
                 can_preserve = True
                 # Count how many replicas were on each node in the previous allocation for this job
@@ -94,6 +96,8 @@ class DummyPolicy(object):
             # Try to allocate the job
             current_alloc = []
             for node_name, gpus in available_gpus.items():
+                if node_name in job_info.avoid_nodes:
+                    continue
                 while len(current_alloc) < num_replicas and gpus >= gpus_per_replica:
                     current_alloc.append(node_name)
                     gpus -= gpus_per_replica
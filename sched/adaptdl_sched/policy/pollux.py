@@ -188,8 +188,13 @@ class PolluxPolicy(object):
             states = np.expand_dims(base_state, 0)
         else:
             states = self._adapt_prev_states(jobs, nodes)
+        # Nodes which each job should not be placed on. Template nodes are
+        # new, so they are never avoided.
+        avoid = np.array([[key in job.avoid_nodes for key in nodes] +
+                          len(nodes) * [False] for job in jobs.values()],
+                         dtype=bool).reshape(base_state.shape)
         problem = Problem(list(jobs.values()), list(nodes.values()) +
-                          len(nodes) * [node_template], base_state)
+                          len(nodes) * [node_template], base_state, avoid)
         algorithm = NSGA2(
             pop_size=100,
             # pymoo expects a flattened 2-D array.
@@ -227,7 +232,7 @@ class PolluxPolicy(object):
 
 
 class Problem(pymoo.core.problem.Problem):
-    def __init__(self, jobs, nodes, base_state):
+    def __init__(self, jobs, nodes, base_state, avoid=None):
         """
         Multi-objective optimization problem used by PolluxPolicy to determine
         resource allocations and desired cluster size. Optimizes for the best
@@ -246,11 +251,18 @@ class Problem(pymoo.core.problem.Problem):
                 cluster, in decreasing order of allocation preference.
             base_state (numpy.array): base optimization state corresponding to
                 the current cluster allocations. Shape: (num_jobs x num_nodes).
+            avoid (numpy.array): whether each job should not be assigned any
+                replicas on each node, e.g. because the node was reported to
+                be slow by the job. Shape: (num_jobs x num_nodes).
         """
         assert base_state.shape == (len(jobs), len(nodes))
+        if avoid is None:
+            avoid = np.zeros(base_state.shape, dtype=bool)
+        assert avoid.shape == base_state.shape
         self._jobs = jobs
         self._nodes = nodes
         self._base_state = base_state
+        self._avoid = avoid
         self._pinned_indices = [i for i, job in enumerate(self._jobs)
                                 if not job.preemptible and
                                 np.any(self._base_state[i])]
@@ -279,7 +291,17 @@ class Problem(pymoo.core.problem.Problem):
                     self._get_avail_resource(
                         n, node, rtype) // job.resources[rtype]
                     for rtype in rtypes if job.resources.get(rtype, 0) > 0)
+        self._max_replicas[self._avoid] = 0
+        # Fraction of speedup lost when a job is restarted. Jobs which have
+        # reported a measured restart cost are penalized by the fraction of
+        # the restart horizon spent restarting, otherwise a constant penalty
+        # equivalent to a 30 second restart is used.
         self._restart_penalty = 0.1
+        self._restart_horizon = 300.0
+        self._restart_penalties = np.array([
+            self._restart_penalty if job.restart_cost is None
+            else min(job.restart_cost / self._restart_horizon, 1.0)
+            for job in jobs])
         # Lower bound each job by min_replicas from job spec
         self._min_replicas = np.zeros(base_state.shape, dtype=np.int)
         for j, job in enumerate(jobs):
@@ -358,7 +380,8 @@ class Problem(pymoo.core.problem.Problem):
         scaled_speedups = speedups * self._dominant_share * len(self._nodes)
         # Penalize job restarts.
         restart_mask = np.any(states != self._base_state, axis=2)
-        scaled_speedups[restart_mask] *= 1.0 - self._restart_penalty
+        scaled_speedups *= 1.0 - np.where(restart_mask,
+                                          self._restart_penalties, 0.0)
         out["F"] = np.column_stack([-np.sum(scaled_speedups, axis=1),
                                     self._get_cluster_sizes(states)])
 
@@ -397,6 +420,8 @@ class Problem(pymoo.core.problem.Problem):
     def _repair(self, pop, **kwargs):
         states = pop.get("X")
         states = states.reshape(states.shape[0], *self._base_state.shape)
+        # Remove replicas from nodes avoided by their jobs.
+        states[:, self._avoid] = 0
         # Copy previous allocations for pinned jobs
         states[:, self._pinned_indices] = \
             self._base_state[self._pinned_indices, :]
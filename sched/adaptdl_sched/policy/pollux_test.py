@@ -13,13 +13,14 @@
 # limitations under the License.
 
 
+import numpy as np
 import pytest
 import time
 
 from collections import Counter
 from datetime import datetime, timedelta
 from adaptdl.goodput import GoodputFunction, PerfParams, GradParams
-from adaptdl_sched.policy.pollux import PolluxPolicy
+from adaptdl_sched.policy.pollux import PolluxPolicy, Problem
 from adaptdl_sched.policy.speedup import SpeedupFunction
 from adaptdl_sched.policy.utils import JobInfo, NodeInfo
 
@@ -182,3 +183,40 @@ def test_unusable_node():
     assert max(len(alloc) for alloc in allocations.values()) == 1
     # Check two jobs were allocated.
     assert sum(len(alloc) for alloc in allocations.values()) == 2
+
+
+def test_restart_penalty():
+    nodes = [NodeInfo({"gpu": 2, "pods": 32}, preemptible=False)]
+    speedup_fn = lambda n, r: r  # noqa: E731
+    now = datetime.now()
+    jobs = [JobInfo({"gpu": 1, "pods": 1}, speedup_fn,
+                    now + timedelta(minutes=i), 0, max_replicas=2)
+            for i in range(3)]
+    jobs[1].restart_cost = 15.0
+    jobs[2].restart_cost = 3000.0
+    base_state = np.array([[1], [1], [1]])
+    problem = Problem(jobs, nodes, base_state)
+    # Unmeasured jobs use the default, measured jobs scale with their cost.
+    assert np.allclose(problem._restart_penalties, [0.1, 0.05, 1.0])
+    # Restarting a job with a high restart cost loses all of its speedup.
+    out = {}
+    problem._evaluate(np.array([[1, 1, 2], [2, 1, 1]]), out)
+    assert out["F"][0, 0] > out["F"][1, 0]
+
+
+def test_avoid_nodes():
+    nodes = {
+        "slow": NodeInfo({"gpu": 4, "pods": 32}, preemptible=False),
+        "fast": NodeInfo({"gpu": 4, "pods": 32}, preemptible=False),
+    }
+    template = NodeInfo({"gpu": 4, "pods": 32}, preemptible=True)
+    speedup_fn = lambda n, r: r  # noqa: E731
+    now = datetime.now()
+    jobs = {i: JobInfo({"gpu": 1, "pods": 1}, speedup_fn,
+                       now + timedelta(minutes=i), 0, max_replicas=4)
+            for i in range(2)}
+    jobs[0].avoid_nodes = frozenset(["slow"])
+    policy = PolluxPolicy()
+    # Job 0 is currently placed on the node it reported to be slow.
+    allocations, _ = policy.optimize(jobs, nodes, {0: ["slow"] * 2}, template)
+    assert "slow" not in allocations.get(0, [])
@@ -36,6 +36,10 @@ class JobInfo(object):
         self.preemptible = preemptible
         self.epoch = None
         self.application = None
+        self.restart_cost = None  # Measured restart time in seconds.
+        # Nodes reported by the job to be slower than its other nodes, which
+        # its replicas should not be placed on.
+        self.avoid_nodes = frozenset()
 
 
 class NodeInfo(object):
@@ -0,0 +1,175 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+
+import numpy as np
+
+from adaptdl.sched_hints import PERF_PARAMS
+
+# Hints of a job which are shared with other jobs of the same application.
+_PRIOR_HINTS = ("perfParams", "gradParams", "maxProfiledReplicas")
+# Number of most recently observed jobs kept for each key of the store.
+_MAX_JOBS = 16
+# A job's own performance parameters fully override the prior once it has
+# profiled this many replicas. Before that, they are blended with the prior.
+_TRUSTED_REPLICAS = 4
+# Node labels which identify the hardware of a node, in order of preference.
+_HARDWARE_LABELS = ("nvidia.com/gpu.product",
+                    "node.kubernetes.io/instance-type",
+                    "beta.kubernetes.io/instance-type")
+# Resources which every replica requests, and do not determine its type.
+_COMMON_RESOURCES = ("cpu", "memory", "pods", "ephemeral-storage")
+
+
+def get_resource_type(resources):
+    """
+    Returns the type of resource a job is accelerated by, i.e. the name of the
+    first requested resource other than CPU, memory, and pods, or ``cpu``.
+    """
+    for name in sorted(resources):
+        if name not in _COMMON_RESOURCES and resources[name] > 0:
+            return name
+    return "cpu"
+
+
+def get_hardware(node):
+    """
+    Returns the hardware of a Kubernetes node according to its labels, e.g.
+    its GPU product or instance type, or ``None`` if it is unknown.
+    """
+    labels = node.metadata.labels or {}
+    for label in _HARDWARE_LABELS:
+        if labels.get(label):
+            return labels[label]
+    return None
+
+
+class PriorStore(object):
+    """
+    Store of performance model priors shared between the jobs of the same
+    application, keyed by application, resource type, and hardware. It is
+    filled with the latest hints of running and completed jobs, so that new
+    jobs which have not profiled yet can be allocated according to how other
+    jobs of the same application performed, instead of assuming perfectly
+    linear scaling.
+
+    Arguments:
+        max_jobs (int): Number of most recently observed jobs kept per key.
+    """
+    def __init__(self, max_jobs=_MAX_JOBS):
+        self._max_jobs = max_jobs
+        self._entries = {}  # key -> OrderedDict(job_key -> hints)
+        self._job_keys = {}  # job_key -> key it is recorded under
+
+    def observe(self, job_key, application, resource_type, hardware, hints):
+        """
+        Records the hints of a job, replacing its previously recorded hints.
+        Ignored if the job has not fitted its performance model yet. If the
+        hardware is unknown, the job keeps the hardware it was recorded with.
+
+        Arguments:
+            job_key (tuple): Namespace and name of the job.
+            application (str): Application of the job.
+            resource_type (str): Type of resource the job is accelerated by.
+            hardware (str): Hardware the job runs on, or ``None``.
+            hints (dict): Scheduling hints reported by the job.
+        """
+        if not {"perfParams", "initBatchSize"} <= hints.keys() or \
+                not hints["perfParams"]:
+            return
+        prev_key = self._job_keys.get(job_key)
+        if prev_key is not None:
+            if hardware is None:
+                hardware = prev_key[2]  # E.g. completed and deallocated.
+            self._entries[prev_key].pop(job_key, None)
+        key = (application, resource_type, hardware)
+        entry = self._entries.setdefault(key, collections.OrderedDict())
+        entry[job_key] = {name: hints.get(name) for name in _PRIOR_HINTS}
+        self._job_keys[job_key] = key
+        while len(entry) > self._max_jobs:
+            self._job_keys.pop(entry.popitem(last=False)[0])
+
+    def get(self, application, resource_type, hardware=None, exclude=None):
+        """
+        Returns the prior hints of a job, with performance and gradient
+        parameters averaged over the recorded jobs. Jobs which ran on the
+        given hardware are preferred, otherwise jobs on any hardware are used.
+
+        Arguments:
+            application (str): Application of the job.
+            resource_type (str): Type of resource the job is accelerated by.
+            hardware (str): Hardware the job runs on, or ``None``.
+            exclude (tuple): Key of a job whose own hints are left out.
+
+        Returns:
+            dict: Prior hints, or ``None`` if no similar job was recorded.
+        """
+        keys = [(application, resource_type, hardware)]
+        if not self._entries.get(keys[0]):
+            keys = [key for key in self._entries
+                    if key[:2] == (application, resource_type)]
+        observations = [hints for key in keys
+                        for job_key, hints in self._entries[key].items()
+                        if job_key != exclude]
+        if not observations:
+            return None
+        grad_params = [obs["gradParams"] for obs in observations
+                       if obs.get("gradParams")]
+        return {
+            "perfParams": {
+                key: float(np.mean([obs["perfParams"][key]
+                                    for obs in observations]))
+                for key in PERF_PARAMS},
+            "gradParams": {
+                key: float(np.mean([params[key] for params in grad_params]))
+                for key in ("norm", "var")} if grad_params else None,
+            "maxProfiledReplicas": max(
+                obs.get("maxProfiledReplicas") or 0 for obs in observations),
+        }
+
+
+def apply_prior(hints, prior):
+    """
+    Combines the hints of a job with a prior. Performance and gradient
+    parameters missing from the job are taken from the prior, and the
+    performance parameters of the job are blended with those of the prior,
+    weighted by how many replicas the job has profiled, so its own
+    measurements gradually override the prior. Batch size limits are always
+    the job's own, since they are configured by each job.
+
+    Arguments:
+        hints (dict): Scheduling hints reported by the job.
+        prior (dict): Prior hints returned by ``PriorStore.get``, or ``None``.
+
+    Returns:
+        dict: The combined hints.
+    """
+    if prior is None:
+        return hints
+    combined = dict(hints)
+    for key in ("perfParams", "gradParams"):
+        if combined.get(key) is None and prior[key] is not None:
+            combined[key] = prior[key]
+    profiled_replicas = hints.get("maxProfiledReplicas") or 0
+    if hints.get("perfParams"):
+        weight = min(profiled_replicas / _TRUSTED_REPLICAS, 1.0)
+        combined["perfParams"] = {
+            key: (weight * hints["perfParams"][key] +
+                  (1 - weight) * prior["perfParams"][key])
+            for key in PERF_PARAMS}
+    combined["maxProfiledReplicas"] = max(profiled_replicas,
+                                          prior["maxProfiledReplicas"])
+    return combined
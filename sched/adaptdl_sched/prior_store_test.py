@@ -0,0 +1,98 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from adaptdl.sched_hints import PERF_PARAMS
+from adaptdl_sched.prior_store import (PriorStore, apply_prior,
+                                       get_resource_type)
+
+
+def _hints(value, replicas, **kwargs):
+    hints = {"perfParams": {key: value for key in PERF_PARAMS},
+             "gradParams": {"norm": value, "var": value},
+             "initBatchSize": 128, "maxBatchSize": 1024,
+             "localBszBounds": [32, 256], "gradientAccumulation": True,
+             "maxProfiledReplicas": replicas}
+    hints.update(kwargs)
+    return hints
+
+
+def test_resource_type():
+    assert get_resource_type({"cpu": 1000, "memory": 2 ** 30}) == "cpu"
+    assert get_resource_type({"cpu": 1000, "nvidia.com/gpu": 1}) == \
+        "nvidia.com/gpu"
+
+
+def test_prior_store():
+    store = PriorStore(max_jobs=2)
+    assert store.get("cifar10", "nvidia.com/gpu") is None
+    # Jobs which have not fitted their performance model are ignored.
+    store.observe(("ns", "a"), "cifar10", "nvidia.com/gpu", "t4",
+                  {"initBatchSize": 128, "perfParams": None})
+    assert store.get("cifar10", "nvidia.com/gpu") is None
+    store.observe(("ns", "a"), "cifar10", "nvidia.com/gpu", "t4",
+                  _hints(1.0, 2))
+    store.observe(("ns", "b"), "cifar10", "nvidia.com/gpu", "t4",
+                  _hints(3.0, 4))
+    store.observe(("ns", "c"), "cifar10", "nvidia.com/gpu", "v100",
+                  _hints(9.0, 8))
+    prior = store.get("cifar10", "nvidia.com/gpu", "t4")
+    assert prior["perfParams"]["alpha_c"] == pytest.approx(2.0)
+    assert prior["gradParams"]["var"] == pytest.approx(2.0)
+    assert prior["maxProfiledReplicas"] == 4
+    assert "maxBatchSize" not in prior
+    # A job is never its own prior.
+    prior = store.get("cifar10", "nvidia.com/gpu", "t4", exclude=("ns", "b"))
+    assert prior["perfParams"]["alpha_c"] == pytest.approx(1.0)
+    # Unknown hardware falls back to jobs on any hardware.
+    prior = store.get("cifar10", "nvidia.com/gpu")
+    assert prior["perfParams"]["alpha_c"] == pytest.approx(13.0 / 3)
+    assert store.get("ncf", "nvidia.com/gpu") is None
+    assert store.get("cifar10", "cpu") is None
+    # Deallocated jobs keep their hardware.
+    store.observe(("ns", "a"), "cifar10", "nvidia.com/gpu", None,
+                  _hints(5.0, 2))
+    prior = store.get("cifar10", "nvidia.com/gpu", "t4")
+    assert prior["perfParams"]["alpha_c"] == pytest.approx(4.0)
+    # Only the most recently observed jobs are kept.
+    store.observe(("ns", "d"), "cifar10", "nvidia.com/gpu", "t4",
+                  _hints(7.0, 2))
+    prior = store.get("cifar10", "nvidia.com/gpu", "t4")
+    assert prior["perfParams"]["alpha_c"] == pytest.approx(6.0)
+
+
+def test_apply_prior():
+    prior = _hints(2.0, 8)
+    assert apply_prior({"epoch": 0}, None) == {"epoch": 0}
+    # New jobs use the prior, but keep their own batch size limits.
+    hints = apply_prior({"epoch": 0, "initBatchSize": 64}, prior)
+    assert hints["epoch"] == 0 and hints["initBatchSize"] == 64
+    assert hints["perfParams"] == prior["perfParams"]
+    assert "localBszBounds" not in hints
+    assert hints["maxProfiledReplicas"] == 8
+    # Jobs keep their own batch size limits, and their own performance
+    # parameters are weighted by the number of profiled replicas.
+    hints = apply_prior(_hints(1.0, 1, localBszBounds=None,
+                               gradParams=None), prior)
+    assert hints["localBszBounds"] is None
+    assert hints["gradParams"] == prior["gradParams"]
+    assert hints["perfParams"]["beta_n"] == pytest.approx(1.75)
+    hints = apply_prior(_hints(1.0, 4), prior)
+    assert hints["perfParams"]["beta_n"] == pytest.approx(1.0)
+    assert hints["gradParams"]["norm"] == 1.0
+    # Priors of jobs which have not measured gradients leave them unset.
+    hints = apply_prior({"epoch": 0}, dict(prior, gradParams=None))
+    assert "gradParams" not in hints